@@ -0,0 +1,4 @@
+#! /usr/bin/env python
+
+import cc.logarchive
+cc.logarchive.main()
@@ -0,0 +1,68 @@
+"""Background thread that writes queued records in batches.
+"""
+
+import Queue
+import threading
+import time
+
+import skytools
+
+__all__ = ['BatchWriter']
+
+
+class BatchWriter (threading.Thread):
+    """ Collects records from queue into batches and writes them out.
+
+    Batch is written when it has batch_records records or flush_interval
+    seconds have passed since last write.  None in queue stops the thread
+    after remaining records are written.
+
+    Subclasses implement write_batch() and may override prepare(), which
+    converts each record as it arrives, and finish().
+    """
+
+    log = skytools.getLogger ('BatchWriter')
+
+    def __init__ (self, name, queue, batch_records, flush_interval, stat_inc):
+        super(BatchWriter, self).__init__(name = name)
+        self.queue = queue
+        self.batch_records = batch_records
+        self.flush_interval = flush_interval
+        self.stat_inc = stat_inc
+
+    def run (self):
+        self.log.info ("%s running", self.name)
+        buf = []
+        last = time.time()
+        while True:
+            wait = max (0.01, last + self.flush_interval - time.time())
+            try:
+                msg = self.queue.get (True, wait)
+                if msg is None:
+                    break
+                buf.append (self.prepare (msg))
+            except Queue.Empty:
+                pass
+            except Exception:
+                self.log.exception ('cannot prepare record, dropping it')
+            now = time.time()
+            if buf and (len(buf) >= self.batch_records or now - last >= self.flush_interval):
+                self.write_batch (buf)
+                buf = []
+                last = now
+        if buf:
+            self.write_batch (buf)
+        self.finish()
+        self.log.info ("%s stopped", self.name)
+
+    def prepare (self, msg):
+        """ Convert record for batch. """
+        return msg
+
+    def write_batch (self, buf):
+        """ Write out list of prepared records. """
+        raise NotImplementedError
+
+    def finish (self):
+        """ Called after last batch is written. """
+        pass
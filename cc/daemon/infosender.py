@@ -3,8 +3,12 @@
 """Read infofiles.
 """
 
+import errno
+import fnmatch
 import glob
+import hashlib
 import os, os.path
+import Queue
 import sys
 import threading
 import time
@@ -13,16 +17,40 @@ import skytools
 
 import cc.util
 from cc import json
+from cc.crypto import CryptoContext
 from cc.daemon import CCDaemon
 from cc.message import is_msg_req_valid
 from cc.reqs import InfofileMessage
 
+# fast hash for detecting rewrites of unchanged contents
+try:
+    import xxhash
+    fast_hash = xxhash.xxh64
+except ImportError:
+    try:
+        from pyblake2 import blake2b as fast_hash
+    except ImportError:
+        fast_hash = getattr (hashlib, 'blake2b', hashlib.md5)
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
 
 class InfoStamp:
     def __init__(self, fn, st):
         self.filename = fn
         self.filestat = st
         self.modified = 1
+        # delta mode state
+        self.blocks = None          # block hashes of last sent version
+        self.content_hash = None    # sha1 of last sent version
+        self.full_time = 0          # last time full content was sent
+        self.sending = 0            # jobs in send pipeline
+        # dedup state
+        self.digest = None          # fast hash of last sent version
+        self.send_time = 0
 
     def check_send(self, st):
         if (st.st_mtime != self.filestat.st_mtime
@@ -37,6 +65,70 @@ class InfoStamp:
             return 0
 
 
+class InfoJob:
+    """ Message on its way through compress-and-send pipeline """
+    def __init__(self, msg, body, size, compression, level, use_blob):
+        self.seq = 0
+        self.msg = msg
+        self.body = body
+        self.size = size            # bytes read from file
+        self.compression = compression
+        self.level = level
+        self.use_blob = use_blob
+        self.delta_saved = None
+        self.fs = None              # InfoStamp of source file
+        self.sent_state = {}        # its new attributes when sent
+        self.blob = None
+        self.cmsg = None
+        self.clen = 0
+        self.error = None
+        self.t_read = time.time()
+        self.t_start = self.t_done = None
+
+    def run(self, xtx):
+        """ Compress and sign, errors are left for sender to report. """
+        try:
+            self.compress()
+            self.sign (xtx)
+        except Exception, e:
+            self.error = e
+            self.t_done = time.time()
+
+    def compress(self):
+        self.t_start = time.time()
+        self.blob = cc.util.compress (self.body, self.compression, {'level': self.level})
+        self.clen = len(self.blob)
+        self.body = None
+
+    def sign(self, xtx):
+        if self.use_blob:
+            self.cmsg = xtx.create_cmsg (self.msg, self.blob)
+        else:
+            self.msg.data = self.blob.encode('base64')
+            self.cmsg = xtx.create_cmsg (self.msg)
+        self.blob = None
+        self.t_done = time.time()
+
+
+class InfoCompressor (threading.Thread):
+    """ Compresses and signs jobs from inq, passes them to outq. """
+
+    def __init__(self, name, xtx, inq, outq):
+        super(InfoCompressor, self).__init__(name=name)
+        self.setDaemon (True)
+        self.xtx = xtx
+        self.inq = inq
+        self.outq = outq
+
+    def run(self):
+        while True:
+            job = self.inq.get()
+            if job is None:
+                break
+            job.run (self.xtx)
+            self.outq.put (job)
+
+
 class InfofileCollector(CCDaemon):
 
     log = skytools.getLogger('d:InfofileCollector')
@@ -50,13 +142,18 @@ class InfofileCollector(CCDaemon):
         if self.compression not in (None, '', 'none', 'gzip', 'bzip2'):
             self.log.error ("unknown compression: %s", self.compression)
         self.compression_level = self.cf.getint ('compression-level', '')
-        self.maint_period = self.cf.getint ('maint-period', 60 * 60)
+        self.use_inotify = self.cf.getbool ('use-inotify', True)
         self.stats_period = self.cf.getint ('stats-period', 30)
         self.msg_suffix = self.cf.get ('msg-suffix', '')
         if self.msg_suffix and not is_msg_req_valid (self.msg_suffix):
             self.log.error ("invalid msg-suffix: %s", self.msg_suffix)
             self.msg_suffix = None
         self.use_blob = self.cf.getbool ('use-blob', True)
+        self.chunk_bytes = cc.util.hsize_to_bytes (self.cf.get ('chunk-bytes', '0'))
+        self.delta_block_bytes = cc.util.hsize_to_bytes (self.cf.get ('delta-block-bytes', '0'))
+        self.delta_full_period = self.cf.getint ('delta-full-period', 5 * 60)
+        self.dedup_period = self.cf.getint ('dedup-period', 0)
+        self.compress_threads = self.cf.getint ('compress-threads', 0)
 
     def startup(self):
         super(InfofileCollector, self).startup()
@@ -64,50 +161,343 @@ class InfofileCollector(CCDaemon):
         # fn -> stamp
         self.infomap = {}
 
-        # activate periodic maintenance
-        self.do_maint()
+        # last directory listing
+        self.fnlist = []
+        self.dir_mtime = None
+
+        self.notifier = None
+        if self.use_inotify and pyinotify and '/' not in self.infomask:
+            self.start_inotify()
+
+        self.pool = []
+        if self.compress_threads > 0:
+            self.start_pool()
+
+    def start_pool(self):
+        """ Launch compress/sign threads, jobs are sent in submit order. """
+        self.inq = Queue.Queue (self.compress_threads * 2)
+        self.outq = Queue.Queue()
+        self.done = {}          # seq -> finished job waiting for its turn
+        self.next_seq = 0
+        self.send_seq = 0
+        for i in range (self.compress_threads):
+            w = InfoCompressor ("%s.compress-%i" % (self.job_name, i),
+                                CryptoContext (self.cf), self.inq, self.outq)
+            self.pool.append (w)
+            w.start()
 
     def process_file(self, fs):
         f = open(fs.filename, 'rb')
         st = os.fstat(f.fileno())
         if fs.check_send(st):
+            if self.chunk_bytes > 0 and st.st_size > self.chunk_bytes:
+                digest = None
+                if self.dedup_period > 0:
+                    digest = self.hash_file (f)
+                    if self.is_unchanged (fs, digest, st.st_size):
+                        f.close()
+                        return
+                fs.modified = 0
+                fs.blocks = None
+                self.log.debug('Sending in chunks: %s', fs.filename)
+                self.send_file_chunked(fs, f, st.st_size, digest)
+                self.stat_inc('count')
+                f.close()
+                return
             body = f.read()
             if len(body) != st.st_size:
                 return
+            digest = None
+            if self.dedup_period > 0:
+                digest = fast_hash (body).digest()
+                if self.is_unchanged (fs, digest, len(body)):
+                    f.close()
+                    return
             fs.modified = 0
             self.log.debug('Sending: %s', fs.filename)
-            self.send_file(fs, body)
+            self.send_file(fs, body, digest)
             self.stat_inc('count')
         f.close()
 
-    def send_file(self, fs, body):
-        cfb = cc.util.compress (body, self.compression, {'level': self.compression_level})
-        self.log.debug ("file compressed from %i to %i", len(body), len(cfb))
-        if self.use_blob:
-            data = ''
-            blob = cfb
+    def hash_file(self, f):
+        """ Return fast hash of file contents, leave file at start. """
+        h = fast_hash()
+        while True:
+            buf = f.read (self.chunk_bytes)
+            if not buf:
+                break
+            h.update (buf)
+        f.seek (0)
+        return h.digest()
+
+    def is_unchanged(self, fs, digest, size):
+        """ Check whether contents match last sent version (and it is not
+        yet time for forced resend).  Digest of new version is remembered
+        when it is sent (see send_job).
+        """
+        now = time.time()
+        if digest == fs.digest and now - fs.send_time < self.dedup_period:
+            self.log.debug ('%s: contents unchanged, not sending', fs.filename)
+            fs.modified = 0
+            self.stat_inc ('infosender.dedup.suppressed')
+            self.stat_inc ('infosender.dedup.bytes_saved', size)
+            return True
+        return False
+
+    def send_file(self, fs, body, digest = None):
+        blocks = state = None
+        if self.delta_block_bytes > 0:
+            blocks, base_hash, state = self.make_delta (fs, body)
+        if digest is not None:
+            state = state or {}
+            state['digest'] = digest
+            state['send_time'] = time.time()
+        if blocks is not None:
+            bs = self.delta_block_bytes
+            part = ''.join ([body[i*bs : (i+1)*bs] for i in blocks])
+            self.log.debug ("sending %i changed blocks of %s", len(blocks), fs.filename)
         else:
-            data = cfb.encode('base64')
-            blob = None
+            part = body
         msg = InfofileMessage(
                 filename = fs.filename.replace('\\', '/'),
                 mtime = fs.filestat.st_mtime,
                 comp = self.compression,
-                data = data)
+                data = '')
+        if blocks is not None:
+            msg.delta = ','.join ([str (i) for i in blocks])
+            msg.block_size = self.delta_block_bytes
+            msg.base_hash = base_hash
+            msg.content_hash = state['content_hash']
+            msg.size = len(body)
         if self.msg_suffix:
             msg.req += '.' + self.msg_suffix
-        self.ccpublish (msg, blob)
-        self.stat_inc ('infosender.bytes.read', len(body))
-        self.stat_inc ('infosender.bytes.sent', len(cfb))
+        job = InfoJob (msg, part, len(body), self.compression, self.compression_level, self.use_blob)
+        job.fs = fs
+        job.sent_state = state or {}
+        fs.sending += 1
+        if blocks is not None:
+            job.delta_saved = len(body) - len(part)
+        self.submit (job)
+
+    def submit(self, job, done = False):
+        """ Pass job to compress pool (unless done) and send finished ones. """
+        if not self.pool:
+            if not done:
+                job.run (self.xtx)
+            self.send_job (job)
+            return
+        job.seq = self.next_seq
+        self.next_seq += 1
+        if done:
+            self.outq.put (job)
+        else:
+            while True:
+                try:
+                    self.inq.put (job, True, 0.1)
+                    break
+                except Queue.Full:
+                    self.flush_jobs()
+        self.flush_jobs()
+
+    def flush_jobs(self, wait = False):
+        """ Send finished jobs in submit order, with wait until all are sent. """
+        while self.send_seq < self.next_seq:
+            try:
+                job = self.outq.get (wait)
+            except Queue.Empty:
+                break
+            self.done[job.seq] = job
+            while self.send_seq in self.done:
+                try:
+                    self.send_job (self.done.pop (self.send_seq))
+                finally:
+                    # failed job is resent on next scan, do not stall the rest
+                    self.send_seq += 1
+
+    def send_job(self, job):
+        """ Publish finished job, blocks when CC socket reaches HWM. """
+        if job.error:
+            self.log.error ('%s: %s', job.msg.filename, job.error)
+            self.stat_inc ('infosender.errors')
+            self.send_failed (job)
+            return
+        self.log.debug ("%s: sending %i bytes (read %i)", job.msg.filename, job.clen, job.size)
+        if not self.cc:
+            self.connect_cc()
+        try:
+            job.cmsg.send_to (self.cc)
+        except:
+            self.send_failed (job)
+            raise
+        if job.fs is not None:
+            job.fs.sending -= 1
+            for k, v in job.sent_state.items():
+                setattr (job.fs, k, v)
+        now = time.time()
+        self.stat_inc ('infosender.bytes.read', job.size)
+        self.stat_inc ('infosender.bytes.sent', job.clen)
+        self.stat_inc ('infosender.time.queued', job.t_start - job.t_read)
+        self.stat_inc ('infosender.time.compress', job.t_done - job.t_start)
+        self.stat_inc ('infosender.time.send', now - job.t_done)
+        if job.delta_saved is not None:
+            self.stat_inc ('infosender.delta.count')
+            self.stat_inc ('infosender.delta.bytes_saved', job.delta_saved)
+
+    def send_failed(self, job):
+        """ File is marked for resend on next scan.  Receiver state is
+        unknown now, so next send must be full one and must not be
+        suppressed by dedup.  State may be shared by all chunks of
+        transfer, so it is cleared for the rest too.
+        """
+        if job.fs is not None:
+            job.fs.sending -= 1
+            job.fs.modified = 1
+            job.fs.blocks = job.fs.content_hash = None
+            job.fs.digest = None
+            job.sent_state.clear()
+
+    def make_delta(self, fs, body):
+        """ Return (changed blocks, base hash, new delta state), blocks
+        are None if full content should be sent.  New state is applied
+        to fs only after message is sent (see send_job).
+        """
+        bs = self.delta_block_bytes
+        blocks = [hashlib.md5 (body[i : i+bs]).digest() for i in xrange (0, len(body), bs)]
+        state = {'blocks': blocks, 'content_hash': hashlib.sha1 (body).hexdigest()}
+        old, base_hash = fs.blocks, fs.content_hash
+
+        now = time.time()
+        if old is None or fs.sending or now - fs.full_time >= self.delta_full_period:
+            # no base, or it is not yet known to be sent
+            state['full_time'] = now
+            return None, None, state
+        changed = [i for i, h in enumerate (blocks) if i >= len(old) or h != old[i]]
+        if len(changed) * bs * 2 > len(body):
+            # not worth it
+            state['full_time'] = now
+            return None, None, state
+        return changed, base_hash, state
+
+    def send_file_chunked(self, fs, f, size, digest = None):
+        """ Send file in chunks of chunk-bytes, reading one chunk at a time. """
+        nchunks = (size + self.chunk_bytes - 1) // self.chunk_bytes
+        xfer_id = "%s:%f:%f" % (fs.filename, fs.filestat.st_mtime, time.time())
+        xhash = hashlib.sha1()
+        # shared by all chunks, so failure of one drops it for the rest
+        state = {}
+        if digest is not None:
+            state = {'digest': digest, 'send_time': time.time()}
+        for i in range (nchunks):
+            body = f.read (self.chunk_bytes)
+            if len(body) != min (self.chunk_bytes, size - i * self.chunk_bytes):
+                self.log.info ('%s: file changed while sending', fs.filename)
+                fs.modified = 1
+                fs.digest = None
+                state.clear()
+                return
+            msg = InfofileMessage(
+                    filename = fs.filename.replace('\\', '/'),
+                    mtime = fs.filestat.st_mtime,
+                    comp = self.compression,
+                    data = '',
+                    xfer_id = xfer_id,
+                    chunk = i,
+                    chunks = nchunks,
+                    size = size)
+            if self.msg_suffix:
+                msg.req += '.' + self.msg_suffix
+            # transfer hash covers compressed chunks in order, so they
+            # are processed here and only sending goes through pipeline
+            job = InfoJob (msg, body, len(body), self.compression, self.compression_level, self.use_blob)
+            job.fs = fs
+            job.sent_state = state
+            fs.sending += 1
+            job.compress()
+            xhash.update (job.blob)
+            if i == nchunks - 1:
+                msg.xfer_hash = xhash.hexdigest()
+            job.sign (self.xtx)
+            self.submit (job, True)
+            self.stat_inc ('infosender.chunks')
+
+    def start_inotify(self):
+        """ Watch infodir for changes instead of scanning it. """
+        self.log.info ("using inotify on %s", self.infodir)
+        self.events = set()
+        self.rescan = True
+        wm = pyinotify.WatchManager()
+        mask = (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MODIFY | pyinotify.IN_ATTRIB |
+                pyinotify.IN_MOVED_TO | pyinotify.IN_MOVED_FROM | pyinotify.IN_DELETE)
+        wm.add_watch (self.infodir, mask)
+        self.notifier = pyinotify.Notifier (wm, self.on_inotify)
+
+    def on_inotify(self, ev):
+        if ev.mask & pyinotify.IN_Q_OVERFLOW:
+            self.log.warning ("inotify queue overflow, rescanning")
+            self.rescan = True
+        elif ev.name:
+            self.events.add (os.path.join (self.infodir, ev.name))
+
+    def list_files(self):
+        """ List matching files; directory is re-read only when its mtime changes. """
+        if '/' in self.infomask:
+            # subdirectories are not tracked
+            self.fnlist = glob.glob (os.path.join (self.infodir, self.infomask))
+            self.forget_missing()
+            return self.fnlist
+        try:
+            dmt = os.stat (self.infodir).st_mtime
+        except OSError, e:
+            self.log.info ('%s: %s', self.infodir, e)
+            return []
+        # changes within mtime granularity could be missed, relist recent ones
+        if dmt != self.dir_mtime or time.time() - dmt < 2:
+            self.dir_mtime = dmt
+            self.fnlist = glob.glob (os.path.join (self.infodir, self.infomask))
+            self.forget_missing()
+            self.stat_inc ('infosender.dir_scans')
+        return self.fnlist
+
+    def changed_files(self):
+        """ Files with inotify events and ones waiting to settle. """
+        if self.notifier.check_events (0):
+            self.notifier.read_events()
+            self.notifier.process_events()
+        if self.rescan:
+            self.rescan = False
+            self.events.clear()
+            self.fnlist = glob.glob (os.path.join (self.infodir, self.infomask))
+            self.forget_missing()
+            return self.fnlist
+        names = self.events
+        self.events = set()
+        names.update ([fn for fn, fs in self.infomap.iteritems() if fs.modified])
+        return [fn for fn in names if fnmatch.fnmatch (os.path.basename (fn), self.infomask)]
+
+    def forget_missing(self):
+        """ Drop files not in last listing from our cache """
+        for fn in set(self.infomap) - set(self.fnlist):
+            self.forget (fn)
+
+    def forget(self, fn):
+        if fn in self.infomap:
+            self.log.debug ("forgetting file %s", fn)
+            del self.infomap[fn]
 
     def find_new(self):
-        fnlist = glob.glob (os.path.join (self.infodir, self.infomask))
+        if self.notifier:
+            fnlist = self.changed_files()
+        else:
+            fnlist = self.list_files()
         newlist = []
         for fn in fnlist:
             try:
                 st = os.stat(fn)
             except OSError, e:
-                self.log.info('%s: %s', fn, e)
+                if e.errno == errno.ENOENT:
+                    self.forget (fn)
+                else:
+                    self.log.info('%s: %s', fn, e)
                 continue
             if fn not in self.infomap:
                 fstamp = InfoStamp(fn, st)
@@ -127,6 +517,8 @@ class InfofileCollector(CCDaemon):
                 self.process_file(fs)
             except (OSError, IOError), e:
                 self.log.info('%s: %s', fs.filename, e)
+        if self.pool:
+            self.flush_jobs (True)
         self.stat_inc('changes', len(newlist))
 
     def work (self):
@@ -140,19 +532,6 @@ class InfofileCollector(CCDaemon):
         """ Called from signal handler """
         super(InfofileCollector, self).stop()
         self.log.info ("stopping")
-        self.maint_timer.cancel()
-
-    def do_maint (self):
-        """ Drop removed files from our cache """
-        self.log.info ("cleanup")
-        current = glob.glob (os.path.join (self.infodir, self.infomask))
-        removed = set(self.infomap) - set(current)
-        for fn in removed:
-            self.log.debug ("forgetting file %s", fn)
-            del self.infomap[fn]
-        self.log.info ("current: %i, removed: %i", len(current), len(removed))
-        self.maint_timer = threading.Timer (self.maint_period, self.do_maint)
-        self.maint_timer.start()
 
 
 if __name__ == '__main__':
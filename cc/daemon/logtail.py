@@ -18,7 +18,9 @@ In rotated mode:
 
 from __future__ import with_statement
 
+import collections
 import cStringIO
+import errno
 import glob
 import os
 import re
@@ -26,13 +28,26 @@ import sys
 import time
 
 import skytools
+import zmq
 
 import cc.util
 from cc.daemon import CCDaemon
-from cc.message import is_msg_req_valid
+from cc.message import CCMessage, is_msg_req_valid
 from cc.reqs import LogtailMessage
 
 
+class TailFrag (object):
+    """ Sent but not yet acknowledged fragment """
+    __slots__ = ('fpos', 'msg', 'blob', 'stime', 'resends')
+
+    def __init__ (self, fpos, msg, blob):
+        self.fpos = fpos
+        self.msg = msg
+        self.blob = blob
+        self.stime = time.time()
+        self.resends = 0
+
+
 class LogfileTailer (CCDaemon):
     """ Logfile tailer for rotated log files """
 
@@ -76,6 +91,24 @@ class LogfileTailer (CCDaemon):
         self.buf_maxbytes = cc.util.hsize_to_bytes (self.cf.get ('buffer-bytes', '0'))
         self.buf_maxlines = self.cf.getint ('buffer-lines', -1)
         self.buf_maxdelay = 1.0
+        bulk_read = self.cf.getbool ('bulk-read', False)
+        if hasattr (self, 'bulkbuf') and bulk_read != self.bulk_read:
+            self.log.warning ("bulk-read cannot be changed on reload, restart needed")
+            bulk_read = self.bulk_read
+        self.bulk_read = bulk_read
+
+        # position checkpointing; saved on every fragment if both are 0.
+        # Data after last checkpoint is re-sent after tailer restart,
+        # TailWriter drops it only while it still has the file open.
+        self.ckpt_period = self.cf.getfloat ('checkpoint-period', 0)
+        self.ckpt_bytes = cc.util.hsize_to_bytes (self.cf.get ('checkpoint-bytes', '0'))
+        self.ckpt_fsync = self.cf.getbool ('checkpoint-fsync', False)
+
+        # flow control: max number of unacked fragments, 0 means disabled
+        self.flow_window = self.cf.getint ('flow-window', 0)
+        self.ack_timeout = self.cf.getfloat ('ack-timeout', 30.0)
+        # resends before old file is given up on rotation
+        self.ack_resends = self.cf.getint ('ack-resends', 5)
 
         # compensate for our config class weakness
         if self.buf_maxbytes <= 0: self.buf_maxbytes = None
@@ -84,11 +117,22 @@ class LogfileTailer (CCDaemon):
         if self.buf_maxbytes is None and self.buf_maxlines is None:
             self.buf_maxbytes = 1024 * 1024
 
+        if self.bulk_read:
+            if self.buf_maxlines is not None:
+                self.log.warning ("buffer-lines not supported with bulk-read, ignoring it")
+                self.buf_maxlines = None
+            if self.buf_maxbytes is None:
+                self.buf_maxbytes = 1024 * 1024
+
         if self.compression not in (None, '', 'none'):
             if self.buf_maxbytes < self.BUF_MINBYTES:
                 self.log.info ("buffer-bytes too low, adjusting: %i -> %i", self.buf_maxbytes, self.BUF_MINBYTES)
                 self.buf_maxbytes = self.BUF_MINBYTES
 
+        if getattr (self, 'bulkbuf', None) is not None:
+            # running already, apply new buffer-bytes
+            self.resize_bulkbuf()
+
     def startup (self):
         super(LogfileTailer, self).startup()
 
@@ -102,8 +146,16 @@ class LogfileTailer (CCDaemon):
         self.buffer = cStringIO.StringIO()
         self.buflines = 0
         self.bufseek = None
+        # preallocated read buffer, filled by readinto()
+        self.bulkbuf = None
+        self.bulkfill = 0
+        if self.bulk_read:
+            self.resize_bulkbuf()
         self.saved_fpos = None
         self.save_file = None
+        self.ckpt_time = 0
+        self.ckpt_pending = 0   # bytes sent since last checkpoint
+        self.ack_window = collections.deque()
         self.logf_dev = self.logf_ino = None
 
         sfn = self.get_save_filename()
@@ -132,7 +184,7 @@ class LogfileTailer (CCDaemon):
                 self.logfile = self.saved_fpos = None
         except IOError:
             pass
-        self.save_file = open (sfn, "a")
+        self.save_file = sfn
 
     def count_lag_bytes (self):
         files = self.get_all_filenames()
@@ -183,10 +235,25 @@ class LogfileTailer (CCDaemon):
         """ Return the name of save file """
         return os.path.splitext(self.pidfile)[0] + ".save"
 
-    def save_file_pos (self):
-        self.save_file.truncate (0)
-        self.save_file.write ("%i\t%s" % (self.bufseek, self.logfile))
-        self.log.debug ("saved offset %i for %s", self.bufseek, self.logfile)
+    def save_file_pos (self, force = False):
+        """ Checkpoint current position if due (or forced) """
+        if self.bufseek is None or self.logfile is None:
+            return
+        if self.ack_window:
+            fpos = self.ack_window[0].fpos
+        else:
+            fpos = self.bufseek
+        if not force and (self.ckpt_period > 0 or self.ckpt_bytes > 0):
+            due = (self.ckpt_period > 0 and time.time() - self.ckpt_time >= self.ckpt_period)
+            due = due or (self.ckpt_bytes > 0 and self.ckpt_pending >= self.ckpt_bytes)
+            if not due:
+                return
+        cc.util.write_atomic (self.save_file, "%i\t%s" % (fpos, self.logfile),
+                              mode = 't', fsync = self.ckpt_fsync)
+        self.ckpt_time = time.time()
+        self.ckpt_pending = 0
+        self.stat_inc ('checkpoints')
+        self.log.debug ("saved offset %i for %s", fpos, self.logfile)
 
     def is_new_file_available (self):
         if self.op_mode in (None, '', 'classic'):
@@ -200,7 +267,7 @@ class LogfileTailer (CCDaemon):
     def try_open_file (self, name):
         """ Try open log file; sleep a bit if unavailable. """
         if name:
-            assert self.buffer.tell() == 0
+            assert self.get_frag_size (True) == 0
             try:
                 self.logf = open (name, 'rb')
                 self.logfile = name
@@ -239,19 +306,19 @@ class LogfileTailer (CCDaemon):
                 self.log.info ("started at file position %i", self.logfpos)
                 self.first = False
 
-            if self.file_mode == 'binary':
-                line = self.logf.read (self.buf_maxbytes)
+            if self.flow_window > 0:
+                self.process_acks()
+                if len(self.ack_window) >= self.flow_window:
+                    # out of credits, pause reading
+                    self.stat_inc ('flow_paused')
+                    self.process_acks (0.1)
+                    continue
+
+            if self.bulk_read:
+                got = self.read_bulk()
             else:
-                line = self.logf.readline()
-            if line:
-                s = len(line)
-                self.logfpos += s
-                self.tailed_bytes += s
-                self.buffer.write(line)
-                self.buflines += 1
-                if ((self.buf_maxbytes is not None and self.buffer.tell() >= self.buf_maxbytes) or
-                        (self.buf_maxlines is not None and self.buflines >= self.buf_maxlines)):
-                    self.send_frag()
+                got = self.read_line()
+            if got:
                 if self.probesleft < self.PROBESLEFT:
                     self.log.info ("DEBUG: new data in old log (!)")
                 continue
@@ -259,12 +326,14 @@ class LogfileTailer (CCDaemon):
             # reset EOF condition for next attempt
             self.logf.seek (0, os.SEEK_CUR)
 
-            if self.buffer.tell() > 0 and self.compression in (None, '', 'none'):
+            if self.get_frag_size() > 0 and self.compression in (None, '', 'none'):
                 self.send_frag()
             elif self.is_new_file_available():
                 if self.probesleft <= 0:
                     self.log.trace ("new log, closing old one")
-                    self.send_frag()
+                    self.send_frag (True)
+                    self.wait_acks()
+                    self.save_file_pos (True)
                     self.logf.close()
                     self.logf = None
                 else:
@@ -275,22 +344,88 @@ class LogfileTailer (CCDaemon):
                 self.log.trace ("waiting")
                 time.sleep (0.1)
 
-    def send_frag (self):
-        bufsize = self.buffer.tell()
+    def read_line (self):
+        """ Read next line (or block in binary mode) into buffer, send it when full.
+        Returns number of bytes read (0 on EOF).
+        """
+        if self.file_mode == 'binary':
+            line = self.logf.read (self.buf_maxbytes)
+        else:
+            line = self.logf.readline()
+        if line:
+            s = len(line)
+            self.logfpos += s
+            self.tailed_bytes += s
+            self.buffer.write(line)
+            self.buflines += 1
+            if ((self.buf_maxbytes is not None and self.buffer.tell() >= self.buf_maxbytes) or
+                    (self.buf_maxlines is not None and self.buflines >= self.buf_maxlines)):
+                self.send_frag()
+            return s
+        return 0
+
+    def read_bulk (self):
+        """ Read directly into preallocated buffer, send it when full.
+        Returns number of bytes read (0 on EOF).
+        """
+        n = self.logf.readinto (self.bulkview[self.bulkfill:])
+        if n:
+            self.logfpos += n
+            self.tailed_bytes += n
+            self.bulkfill += n
+            if self.bulkfill >= len(self.bulkbuf):
+                self.send_frag()
+        return n
+
+    def resize_bulkbuf (self):
+        """ Allocate bulk read buffer of buffer-bytes, keeping data in it.
+        Buffer is not made smaller than its data, it shrinks after send.
+        """
+        size = max (self.buf_maxbytes, self.bulkfill)
+        if self.bulkbuf is not None and len(self.bulkbuf) == size:
+            return
+        buf = bytearray (size)
+        if self.bulkfill:
+            buf[:self.bulkfill] = self.bulkbuf[:self.bulkfill]
+        self.bulkbuf = buf
+        self.bulkview = memoryview (buf)
+        self.log.debug ("bulk read buffer is %i bytes", size)
+
+    def get_frag_size (self, final = False):
+        """ Return number of buffered bytes ready to be sent.
+        In bulk text mode only complete lines are sent, unless final
+        or there is no line end in full buffer.
+        """
+        if not self.bulk_read:
+            return self.buffer.tell()
+        if final or self.file_mode == 'binary':
+            return self.bulkfill
+        n = self.bulkbuf.rfind ('\n', 0, self.bulkfill) + 1
+        if n == 0 and self.bulkfill >= len(self.bulkbuf):
+            n = self.bulkfill
+        return n
+
+    def send_frag (self, final = False):
+        bufsize = self.get_frag_size (final)
         if bufsize == 0:
             return
         start = time.time()
+        if self.bulk_read:
+            # zero-copy view, zmq copies it on (blocking) send
+            raw = buffer (self.bulkbuf, 0, bufsize)
+        else:
+            raw = self.buffer.getvalue()
         if self.compression in (None, '', 'none'):
-            buf = self.buffer.getvalue()
+            buf = raw
         else:
-            buf = cc.util.compress (self.buffer.getvalue(), self.compression,
+            buf = cc.util.compress (raw, self.compression,
                                     {'level': self.compression_level})
             self.log.debug ("compressed from %i to %i", bufsize, len(buf))
         if self.use_blob:
             data = ''
             blob = buf
         else:
-            data = buf.encode('base64')
+            data = str(buf).encode('base64')
             blob = None
         msg = LogtailMessage(
                 filename = self.logfile,
@@ -302,6 +437,11 @@ class LogfileTailer (CCDaemon):
                 st_ino = self.logf_ino)
         if self.msg_suffix:
             msg.req += '.' + self.msg_suffix
+        if self.flow_window > 0:
+            msg.want_ack = 1
+            if isinstance (blob, buffer):
+                blob = str(blob) # kept for resending
+            self.ack_window.append (TailFrag (self.bufseek, msg, blob))
         self.ccpublish (msg, blob)
         elapsed = time.time() - start
         self.log.debug ("sent %i bytes in %f s", len(buf), elapsed)
@@ -309,11 +449,81 @@ class LogfileTailer (CCDaemon):
         self.stat_inc ('count')
         self.stat_inc ('tailed_bytes', bufsize)
         self.bufseek += bufsize
-        self.buffer.truncate(0)
-        self.buflines = 0
-        assert self.bufseek == self.logfpos
+        self.ckpt_pending += bufsize
+        if self.bulk_read:
+            # keep incomplete line for next fragment
+            rest = self.bulkfill - bufsize
+            if rest:
+                self.bulkbuf[:rest] = self.bulkbuf[bufsize:self.bulkfill]
+            self.bulkfill = rest
+            if len(self.bulkbuf) != self.buf_maxbytes:
+                self.resize_bulkbuf()
+        else:
+            self.buffer.truncate(0)
+            self.buflines = 0
+        assert self.bufseek + self.get_frag_size (True) == self.logfpos
         self.save_file_pos()
 
+    def process_acks (self, timeout = 0):
+        """ Receive acks from TailWriter, resend fragments not acked in time.
+        Waits up to timeout seconds for first ack.
+        """
+        if not self.cc:
+            return
+        ms = int (timeout * 1000)
+        while self.cc.poll (ms, zmq.POLLIN):
+            ms = 0
+            try:
+                cmsg = CCMessage (self.cc.recv_multipart (zmq.NOBLOCK))
+            except zmq.ZMQError, e:
+                if e.errno == errno.EAGAIN:
+                    break
+                raise
+            if cmsg.get_dest() != 'logtail.ack':
+                self.log.warning ("unexpected msg: %s", cmsg.get_dest())
+                continue
+            msg = cmsg.get_payload (self.xtx)
+            if msg:
+                self.handle_ack (msg)
+
+        if self.ack_window:
+            now = time.time()
+            if now - self.ack_window[0].stime > self.ack_timeout:
+                self.log.warning ("no ack for %i fragments in %f s, resending", len(self.ack_window), self.ack_timeout)
+                for fr in self.ack_window:
+                    self.ccpublish (fr.msg, fr.blob)
+                    fr.stime = now
+                    fr.resends += 1
+                    self.stat_inc ('resent')
+
+    def wait_acks (self):
+        """ Wait until all fragments of current file are acked,
+        give up after ack-resends unsuccessful resends.
+        """
+        while self.ack_window and not self.last_sigint:
+            if self.ack_window[0].resends >= self.ack_resends:
+                self.log.error ("no ack for %i fragments of %s after %i resends, giving up",
+                                len(self.ack_window), self.logfile, self.ack_resends)
+                self.stat_inc ('ack_lost', len(self.ack_window))
+                self.ack_window.clear()
+                break
+            self.process_acks (0.1)
+
+    def handle_ack (self, msg):
+        """ Release acked fragment and all before it (acks come in order) """
+        if msg.filename != self.logfile or msg.st_ino != self.logf_ino:
+            self.log.debug ("ack for other file: %s", msg.filename)
+            return
+        for i, fr in enumerate (self.ack_window):
+            if fr.fpos == msg.fpos:
+                break
+        else:
+            self.log.debug ("unknown ack: %i", msg.fpos)
+            return
+        for n in range (i + 1):
+            self.ack_window.popleft()
+        self.stat_inc ('acked', i + 1)
+
     def work (self):
         self.connect_cc()
         self.log.info ("Watching %s", os.path.join (self.logdir, self.logmask))
@@ -321,6 +531,7 @@ class LogfileTailer (CCDaemon):
             self.tail()
         except (IOError, OSError), e:
             self.log.error ("%s", e)
+        self.save_file_pos (True)
         return 1
 
     def stop (self):
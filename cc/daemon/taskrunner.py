@@ -21,6 +21,7 @@ from cc.daemon import CCDaemon
 from cc.message import CCMessage
 from cc.reqs import TaskRegisterMessage, TaskReplyMessage
 from cc.stream import CCStream
+from cc.timer import get_timer_wheel
 
 import zmq
 from zmq.eventloop.ioloop import IOLoop, PeriodicCallback
@@ -51,8 +52,8 @@ class TaskState (object):
 
     def start (self):
         self.start_time = time.time()
-        self.timer = PeriodicCallback (self.watchdog, self.timer_tick * 1000, self.ioloop)
-        self.timer.start()
+        self.wheel = get_timer_wheel (self.ioloop)
+        self.timer = self.wheel.call_later (self.timer_tick, self.watchdog)
 
     def stop (self):
         try:
@@ -62,17 +63,22 @@ class TaskState (object):
             self.log.exception ('signal_pidfile failed: %s', self.pidfile)
 
     def watchdog (self):
-        live = skytools.signal_pidfile (self.pidfile, 0)
-        if live:
-            self.log.debug ('%s is alive', self.name)
-            if self.heartbeat:
-                self.send_reply ('running')
-        else:
-            self.log.info ('%s is over', self.name)
-            self.dead_since = time.time()
-            self.timer.stop()
-            self.timer = None
-            self.send_reply ('stopped')
+        self.timer = None
+        live = True
+        try:
+            live = skytools.signal_pidfile (self.pidfile, 0)
+            if live:
+                self.log.debug ('%s is alive', self.name)
+                if self.heartbeat:
+                    self.send_reply ('running')
+            else:
+                self.log.info ('%s is over', self.name)
+                self.dead_since = time.time()
+                self.send_reply ('stopped')
+        finally:
+            # keep watching even if reply failed
+            if live:
+                self.timer = self.wheel.call_later (self.timer_tick, self.watchdog)
 
     def ccpublish (self, msg):
         assert isinstance (msg, TaskReplyMessage)
@@ -0,0 +1,212 @@
+"""Disk-backed FIFO queue for multipart messages.
+
+Messages are appended to segment files (<name>.<seq>.dat), each with
+an index file (<name>.<seq>.idx) of record end offsets.  Segment is
+sealed when it reaches segment size, reader may follow writer in the
+last segment.  Sealed segments are deleted when fully consumed, the
+one being written is kept until writer moves to next one.
+
+Records are read with seek/read, not mmap: the reader usually follows
+the writer in a growing file, which would need remapping after every
+append, and each record is read only once anyway.
+
+Queue contents survive restart, partially consumed segment is
+replayed again from start.
+"""
+
+import errno
+import glob
+import os, os.path
+import struct
+
+import skytools
+
+__all__ = ['DiskQueue']
+
+IDX_ENTRY = struct.Struct ('!Q')
+REC_COUNT = struct.Struct ('!I')
+
+
+class DiskSegment (object):
+    """ One segment file with its index """
+
+    def __init__ (self, fn_base, seq):
+        self.seq = seq
+        self.dat_fn = "%s.%08d.dat" % (fn_base, seq)
+        self.idx_fn = "%s.%08d.idx" % (fn_base, seq)
+        self.count = 0          # records written
+        self.size = 0           # bytes written
+        self.dat = None         # file objects (when writing)
+        self.idx = None
+        self.rf = None          # file object (when reading)
+        self.offsets = []       # record end offsets
+        self.rpos = 0           # next record to read
+
+    def recover (self):
+        """ Load index of existing segment, drop partial records. """
+        try:
+            dsize = os.path.getsize (self.dat_fn)
+            f = open (self.idx_fn, 'rb')
+            ibuf = f.read()
+            f.close()
+        except (IOError, OSError):
+            return False
+        n = len(ibuf) // IDX_ENTRY.size
+        ends = struct.unpack ('!%dQ' % n, ibuf[ : n * IDX_ENTRY.size])
+        while n > 0 and ends[n-1] > dsize:
+            n -= 1
+        self.count = n
+        self.offsets = list (ends[:n])
+        self.size = n and ends[n-1] or 0
+        if n > 0 and (dsize > self.size or len(ibuf) > n * IDX_ENTRY.size):
+            # cut off partially written tail, so appends stay consistent
+            for fn, size in ((self.dat_fn, self.size), (self.idx_fn, n * IDX_ENTRY.size)):
+                f = open (fn, 'r+b')
+                f.truncate (size)
+                f.close()
+        return n > 0
+
+    def append (self, rec):
+        if not self.dat:
+            self.dat = open (self.dat_fn, 'ab')
+            self.idx = open (self.idx_fn, 'ab')
+        self.dat.write (rec)
+        self.size += len(rec)
+        self.idx.write (IDX_ENTRY.pack (self.size))
+        self.offsets.append (self.size)
+        self.count += 1
+
+    def seal (self):
+        """ Stop writing to segment. """
+        if self.dat:
+            self.dat.close()
+            self.idx.close()
+            self.dat = self.idx = None
+
+    def read (self):
+        """ Return next record or None if segment is exhausted. """
+        if self.rpos >= self.count:
+            return None
+        if self.dat:
+            self.dat.flush()
+        if self.rf is None:
+            self.rf = open (self.dat_fn, 'rb')
+        start = self.rpos and self.offsets[self.rpos - 1] or 0
+        end = self.offsets[self.rpos]
+        self.rpos += 1
+        self.rf.seek (start)
+        return self.rf.read (end - start)
+
+    def exhausted (self):
+        return self.rpos >= self.count
+
+    def close (self):
+        self.seal()
+        if self.rf is not None:
+            self.rf.close()
+            self.rf = None
+
+    def remove (self):
+        self.close()
+        for fn in (self.dat_fn, self.idx_fn):
+            try:
+                os.unlink (fn)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+
+class DiskQueue (object):
+    """ Append-only FIFO of multipart messages on disk """
+
+    log = skytools.getLogger ('DiskQueue')
+
+    def __init__ (self, qdir, name, maxbytes = 0, segbytes = 16 * 1024 * 1024):
+        if not os.path.isdir (qdir):
+            os.makedirs (qdir)
+        self.fn_base = os.path.join (qdir, name)
+        self.maxbytes = maxbytes
+        self.segbytes = segbytes
+        self.segments = []
+        self.count = 0
+        self.bytes = 0
+
+        for fn in sorted (glob.glob (self.fn_base + '.*.dat')):
+            try:
+                seq = int (fn[len(self.fn_base) + 1 : -4])
+            except ValueError:
+                continue
+            seg = DiskSegment (self.fn_base, seq)
+            if seg.recover():
+                self.segments.append (seg)
+                self.count += seg.count
+                self.bytes += seg.size
+            else:
+                seg.remove()
+        if self.count:
+            self.log.info ("recovered %i msgs (%i bytes) from %s", self.count, self.bytes, qdir)
+
+    def __len__ (self):
+        return self.count
+
+    def push (self, zmsg):
+        """ Append message, return False if queue is full. """
+        rec = [REC_COUNT.pack (len(zmsg))]
+        for p in zmsg:
+            rec.append (REC_COUNT.pack (len(p)))
+            rec.append (p)
+        rec = ''.join (rec)
+        if self.maxbytes > 0 and self.bytes + len(rec) > self.maxbytes:
+            return False
+        seg = self.segments and self.segments[-1]
+        if not seg or seg.size >= self.segbytes:
+            if seg:
+                seg.seal()
+                if seg.exhausted():
+                    seg.remove()
+                    self.segments.pop()
+            seq = seg and seg.seq + 1 or 1
+            seg = DiskSegment (self.fn_base, seq)
+            self.segments.append (seg)
+        seg.append (rec)
+        self.count += 1
+        self.bytes += len(rec)
+        return True
+
+    def pop (self):
+        """ Return oldest message or None if queue is empty. """
+        while self.segments:
+            seg = self.segments[0]
+            rec = seg.read()
+            if rec is not None:
+                break
+            if seg is self.segments[-1]:
+                # writer still appends to it
+                return None
+            seg.remove()
+            self.segments.pop (0)
+        else:
+            return None
+        if seg.exhausted() and seg is not self.segments[-1]:
+            seg.remove()
+            self.segments.pop (0)
+        self.count -= 1
+        self.bytes -= len(rec)
+        n, = REC_COUNT.unpack_from (rec, 0)
+        pos = REC_COUNT.size
+        zmsg = []
+        for i in range (n):
+            plen, = REC_COUNT.unpack_from (rec, pos)
+            pos += REC_COUNT.size
+            zmsg.append (rec[pos : pos + plen])
+            pos += plen
+        return zmsg
+
+    def close (self):
+        for seg in self.segments:
+            if seg.exhausted():
+                # consumed, do not replay it after restart
+                seg.remove()
+            else:
+                seg.close()
+        self.segments = []
@@ -57,8 +57,14 @@ _short_names = {
     'filter': 'cc.handler.filter',
     'infowriter': 'cc.handler.infowriter',
     'jobmgr': 'cc.handler.jobmgr',
+    'livetail': 'cc.handler.livetail',
     'locallogger': 'cc.handler.locallogger',
+    'logarchiver': 'cc.handler.logarchiver',
+    'logsampler': 'cc.handler.logsampler',
+    'logsink': 'cc.handler.logsink',
     'proxy': 'cc.handler.proxy',
+    'shaper': 'cc.handler.shaper',
+    'tailsearch': 'cc.handler.tailsearch',
     'tailwriter': 'cc.handler.tailwriter',
     'taskrouter': 'cc.handler.taskrouter',
 }
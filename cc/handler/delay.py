@@ -2,58 +2,153 @@
 Delays all received messages, then dispatches them to another handler.
 """
 
-import collections
+import fnmatch
+import heapq
 import time
 
 import skytools
-from zmq.eventloop.ioloop import PeriodicCallback
 
+from cc.diskqueue import DiskQueue
 from cc.handler import CCHandler
+from cc.message import CCMessage
+from cc.util import hsize_to_bytes, stat_put
 
 __all__ = ['Delay']
 
 CC_HANDLER = 'Delay'
 
 class Delay (CCHandler):
-    """ Delays all received messages, then dispatches them to another handler. """
+    """ Delays all received messages, then dispatches them to another handler.
+
+    Delay may be set per destination (route-delays = pattern:seconds, ...).
+    Messages are kept in heap ordered by due time and dispatched at their
+    deadline.  Above max-bytes, messages are spilled to disk (if spill-dir
+    is set) or dropped.
+    """
 
     CC_ROLES = ['local', 'remote']
 
     log = skytools.getLogger ('h:Delay')
 
-    tick = 250 # ms
-
     def __init__ (self, hname, hcf, ccscript):
         super(Delay, self).__init__(hname, hcf, ccscript)
 
         self.fwd_hname = self.cf.get ('forward-to')
-        self.delay = self.cf.getint ('delay', 0)
+        self.delay = self.cf.getfloat ('delay', 0)
+        self.route_delays = []
+        for item in self.cf.getlist ('route-delays', []):
+            pat, secs = item.rsplit (':', 1)
+            self.route_delays.append ((pat.strip(), float (secs)))
+        self.max_bytes = hsize_to_bytes (self.cf.get ('max-bytes', '0'))
 
         self.fwd_handler = ccscript.get_handler (self.fwd_hname)
-        self.queue = collections.deque()
+        self.heap = []          # (due, seq, recv time, cmsg)
+        self.seq = 0
+        self.bytes = 0
+        self.timeout = None     # ioloop timeout for heap head
+        self.timeout_due = None
+        self.spill = self.make_spill()
+        if self.spill:
+            self.refill()
 
-        self.timer = PeriodicCallback (self.process_queue, self.tick, self.ioloop)
-        self.timer.start()
+    def make_spill (self):
+        """ Create disk queue for messages over max-bytes, if configured. """
+        spill_dir = self.cf.getfile ('spill-dir', '')
+        if not spill_dir:
+            return None
+        maxbytes = hsize_to_bytes (self.cf.get ('spill-max-bytes', '1 GB'))
+        segbytes = hsize_to_bytes (self.cf.get ('spill-segment-bytes', '16 MB'))
+        self.log.info ("spilling to %s (max %i bytes)", spill_dir, maxbytes)
+        return DiskQueue (spill_dir, self.hname.replace(':', '_'), maxbytes, segbytes)
+
+    def get_delay (self, dest):
+        for pat, secs in self.route_delays:
+            if fnmatch.fnmatchcase (dest, pat):
+                return secs
+        return self.delay
 
     def handle_msg (self, cmsg):
         """ Got message from client -- queue it """
-        self.queue.append ((time.time() + self.delay, cmsg))
+        now = time.time()
+        due = now + self.get_delay (cmsg.get_dest())
+        size = cmsg.get_size()
+        # while older msgs are spilled, new ones go behind them
+        if (self.max_bytes > 0 and self.bytes + size > self.max_bytes) or self.spill:
+            if self.spill is not None and self.spill.push ([repr(due), repr(now)] + cmsg.zmsg):
+                self.stat_inc ('delay.count.spilled')
+                self.stat_inc ('delay.bytes.spilled', size)
+                self.refill()
+            else:
+                self.stat_inc ('delay.count.dropped')
+                self.stat_inc ('delay.bytes.dropped', size)
+            return
+        self.push (due, now, cmsg, size)
+
+    def push (self, due, rtime, cmsg, size):
+        heapq.heappush (self.heap, (due, self.seq, rtime, cmsg))
+        self.seq += 1
+        self.bytes += size
+        self.schedule()
+
+    def schedule (self):
+        """ Make sure we wake up at deadline of heap head. """
+        due = self.heap[0][0]
+        if self.timeout is not None:
+            if self.timeout_due <= due:
+                return
+            self.ioloop.remove_timeout (self.timeout)
+        self.timeout = self.ioloop.add_timeout (due, self.process_queue)
+        self.timeout_due = due
 
     def process_queue (self):
+        self.timeout = None
         now = time.time()
-        try:
-            while (self.queue[0][0] <= now):
-                at, cmsg = self.queue.popleft()
-                size = cmsg.get_size()
-                try:
-                    self.fwd_handler.handle_msg (cmsg)
-                    stat = 'ok'
-                except Exception:
-                    self.log.exception ('crashed, dropping msg: %s', cmsg.get_dest())
-                    stat = 'crashed'
-                self.stat_inc ('delay.count')
-                self.stat_inc ('delay.bytes', size)
-                self.stat_inc ('delay.count.%s' % stat)
-                self.stat_inc ('delay.bytes.%s' % stat, size)
-        except IndexError:
-            pass
+        while self.heap and self.heap[0][0] <= now:
+            due, seq, rtime, cmsg = heapq.heappop (self.heap)
+            size = cmsg.get_size()
+            self.bytes -= size
+            try:
+                self.fwd_handler.handle_msg (cmsg)
+                stat = 'ok'
+            except Exception:
+                self.log.exception ('crashed, dropping msg: %s', cmsg.get_dest())
+                stat = 'crashed'
+            self.stat_inc ('delay.count')
+            self.stat_inc ('delay.bytes', size)
+            self.stat_inc ('delay.count.%s' % stat)
+            self.stat_inc ('delay.bytes.%s' % stat, size)
+            self.stat_inc ('delay.wait', now - rtime)
+            self.stat_inc ('delay.lag', now - due)
+        self.refill()
+        stat_put ('delay.queue.count', len(self.heap))
+        stat_put ('delay.queue.bytes', self.bytes)
+        if self.spill is not None:
+            stat_put ('delay.queue.spilled', len(self.spill))
+        if self.heap:
+            self.schedule()
+
+    def refill (self):
+        """ Move spilled messages back to memory while there is room. """
+        while self.spill and (self.max_bytes <= 0 or self.bytes < self.max_bytes):
+            zmsg = self.spill.pop()
+            cmsg = CCMessage (zmsg[2:])
+            self.push (float (zmsg[0]), float (zmsg[1]), cmsg, cmsg.get_size())
+
+    def stop (self):
+        """ Keep queued messages on disk, if possible. """
+        super(Delay, self).stop()
+        if self.timeout is not None:
+            self.ioloop.remove_timeout (self.timeout)
+            self.timeout = None
+        if self.spill is not None:
+            count = size = 0
+            for due, seq, rtime, cmsg in sorted (self.heap):
+                if not self.spill.push ([repr(due), repr(rtime)] + cmsg.zmsg):
+                    count += 1
+                    size += cmsg.get_size()
+            if count:
+                self.log.warning ("spill full, dropped %i queued msgs (%i bytes)", count, size)
+                self.stat_inc ('delay.count.dropped', count)
+                self.stat_inc ('delay.bytes.dropped', size)
+            self.heap = []
+            self.spill.close()
@@ -26,34 +26,38 @@ class Filter (CCHandler):
         self.fwd_hname = self.cf.get ('forward-to')
         self.fwd_handler = ccscript.get_handler (self.fwd_hname)
 
-        self.includes = _hint_list (self.cf.getlist ('include', []))
-        self.excludes = _hint_list (self.cf.getlist ('exclude', []))
+        self.includes = PatternSet (self.cf.getlist ('include', []))
+        self.excludes = PatternSet (self.cf.getlist ('exclude', []))
+        self.cache_size = self.cf.getint ('cache-size', 10000)
+        self.cache = {}     # dest -> pass?
+
+    def check_dest (self, dest):
+        """ Decide if dest should be passed, with caching. """
+        try:
+            return self.cache[dest]
+        except KeyError:
+            pass
+        ok = not self.excludes.match (dest) and (not self.includes or self.includes.match (dest))
+        if len(self.cache) >= self.cache_size:
+            self.cache.clear()
+        self.cache[dest] = ok
+        return ok
 
     def handle_msg (self, cmsg):
         """ Got message from client -- process it.
         """
         dest = cmsg.get_dest()
         size = cmsg.get_size()
-        stat = '?'
 
-        for exc, wild in self.excludes:
-            if (not wild and dest == exc) or fnmatch.fnmatchcase (dest, exc):
-                stat = 'dropped'
-                break
+        if not self.check_dest (dest):
+            stat = 'dropped'
         else:
-            if self.includes:
-                for inc, wild in self.includes:
-                    if (not wild and dest == inc) or fnmatch.fnmatchcase (dest, inc):
-                        break
-                else:
-                    stat = 'dropped'
-            if stat != 'dropped':
-                try:
-                    self.fwd_handler.handle_msg (cmsg)
-                    stat = 'ok'
-                except Exception:
-                    self.log.exception ('crashed, dropping msg: %s', dest)
-                    stat = 'crashed'
+            try:
+                self.fwd_handler.handle_msg (cmsg)
+                stat = 'ok'
+            except Exception:
+                self.log.exception ('crashed, dropping msg: %s', dest)
+                stat = 'crashed'
 
         self.stat_inc ('filter.count')
         self.stat_inc ('filter.bytes', size)
@@ -61,9 +65,35 @@ class Filter (CCHandler):
         self.stat_inc ('filter.bytes.%s' % stat, size)
 
 
-def _hint_list (ilist):
-    olist = []
-    for item in ilist:
-        wild = re.search ('\?|\*', item) is not None
-        olist.append ((item, wild))
-    return olist
+class PatternSet (object):
+    """ List of fnmatch patterns compiled into set of exact names
+    and single combined regex for wildcard ones.
+    """
+
+    def __init__ (self, patterns):
+        self.exact = set()
+        wild = []
+        for pat in patterns:
+            if re.search ('[][?*]', pat):
+                wild.append (_translate (pat))
+            else:
+                self.exact.add (pat)
+        self.rx = None
+        if wild:
+            self.rx = re.compile ('|'.join (['(?:%s)' % w for w in wild]), re.S)
+
+    def __len__ (self):
+        return len(self.exact) + (self.rx is not None)
+
+    def match (self, dest):
+        if dest in self.exact:
+            return True
+        return self.rx is not None and self.rx.match (dest) is not None
+
+
+def _translate (pat):
+    """ fnmatch.translate() without trailing inline flags, so results can be joined. """
+    rx = fnmatch.translate (pat)
+    if rx.endswith ('(?ms)'):
+        rx = rx[:-5]
+    return rx
@@ -1,6 +1,8 @@
 import errno
+import hashlib
 import os, os.path
 import threading
+import time
 
 import skytools
 import zmq
@@ -8,7 +10,10 @@ import zmq
 import cc.util
 from cc.handler import CCHandler
 from cc.handler.proxy import BaseProxyHandler
+from cc.json import Struct
 from cc.message import CCMessage
+from cc.reqs import ReplyMessage
+from cc.util import HashRing, PathCache
 
 __all__ = ['InfoWriter']
 
@@ -34,6 +39,8 @@ class InfoWriter (BaseProxyHandler):
         super(InfoWriter, self).startup()
 
         self.workers = []
+        self.ready = set()  # workers that have connected
+        self.pending = {}   # wname -> msgs waiting for worker to connect
         self.wparams = {} # passed to workers
 
         self.wparams['dstdir'] = self.cf.getfile ('dstdir')
@@ -51,11 +58,20 @@ class InfoWriter (BaseProxyHandler):
             if self.wparams['compression'] not in ('gzip', 'bzip2'):
                 self.log.error ("unsupported compression: %s", self.wparams['compression'])
             self.wparams['compression_level'] = self.cf.getint ('compression-level', '')
+        self.wparams['xfer_timeout'] = self.cf.getint ('transfer-timeout', 5 * 60)
+        self.wparams['pathcache'] = PathCache (self.wparams['dstdir'], self.wparams['dstmask'],
+                                               self.cf.getint ('path-cache-size', 10000))
+        self.wparams['coalesce_window'] = self.cf.getfloat ('coalesce-window', 0)
+        self.wparams['write_sync'] = self.cf.get ('write-sync', 'none')
+        if self.wparams['write_sync'] not in ('none', 'fdatasync', 'fsync'):
+            self.log.error ("unknown write-sync: %s", self.wparams['write_sync'])
+        if self.wparams['write_sync'] == 'none':
+            self.wparams['write_sync'] = None
 
     def make_socket (self):
         """ Create socket for sending msgs to workers. """
         url = 'inproc://workers'
-        sock = self.zctx.socket (zmq.XREQ)
+        sock = self.zctx.socket (zmq.XREP)
         port = sock.bind_to_random_port (url)
         self.worker_url = "%s:%d" % (url, port)
         return sock
@@ -70,6 +86,40 @@ class InfoWriter (BaseProxyHandler):
             w.stat_inc = self.stat_inc # XXX
             self.workers.append (w)
             w.start()
+        self.ring = HashRing ([w.name for w in self.workers])
+
+    def handle_msg (self, cmsg):
+        """ Got message from client, pass it to a worker.
+        Messages for same destination file go to the same worker.
+        Message is verified here once, worker gets decoded payload.
+        """
+        data = cmsg.get_payload (self.xtx)
+        if not data: return
+
+        fn = data['filename'].replace('\\', '/')
+        key = self.wparams['dstmask'] % {
+                'hostname': data['hostname'].replace('/', '_'),
+                'filepath': fn,
+                'filename': os.path.basename(fn)}
+        w = self.workers[self.ring.lookup (key)]
+
+        zmsg = [w.name, '', cmsg.get_dest(), data.dump_json(), '']
+        blob = cmsg.get_part3()
+        if blob is not None:
+            zmsg.append (blob)
+        if w.name in self.ready:
+            self.stream.send_multipart (zmsg)
+        else:
+            self.pending.setdefault (w.name, []).append (zmsg)
+
+    def on_recv (self, zmsg):
+        """ Got message from worker (announces itself on startup). """
+        wname = zmsg[0]
+        if wname not in self.ready:
+            self.log.debug ("%s ready", wname)
+            self.ready.add (wname)
+            for m in self.pending.pop (wname, []):
+                self.stream.send_multipart (m)
 
     def stop (self):
         """ Signal workers to shut down. """
@@ -106,10 +156,21 @@ class InfoWriter_Worker (threading.Thread):
         self.looping = True
 
     def startup (self):
-        self.master = self.zctx.socket (zmq.XREP)
+        self.master = self.zctx.socket (zmq.XREQ)
+        self.master.setsockopt (zmq.IDENTITY, self.name)
         self.master.connect (self.master_url)
         self.poller = zmq.Poller()
         self.poller.register (self.master, zmq.POLLIN)
+        self.xfers = {} # dstfn -> chunked transfer state
+        self.xfer_seq = 0
+        self.skipped = {} # dstfn -> xfer_id of transfer skipped at first chunk
+        self.xfer_check = time.time()
+        self.pending = {} # dstfn -> [due, mtime, body, mode] of coalesced write
+        # files are routed to us by destination, so we can remember their state
+        self.mtimes = {} # dstfn -> mtime of our last write
+        # let master know we are connected
+        rcm = self.xtx.create_cmsg (ReplyMessage (worker = self.name))
+        rcm.send_to (self.master)
 
     def run (self):
         self.log.info ("%s running", self.name)
@@ -122,7 +183,15 @@ class InfoWriter_Worker (threading.Thread):
         self.shutdown()
 
     def work (self):
-        socks = dict (self.poller.poll (1000))
+        timeout = 1000
+        if self.pending:
+            due = min ([pw[0] for pw in self.pending.itervalues()])
+            timeout = max (0, min (timeout, (due - time.time()) * 1000))
+        socks = dict (self.poller.poll (timeout))
+        if self.pending:
+            self.flush_pending()
+        if time.time() - self.xfer_check > 60:
+            self.expire_xfers()
         if self.master in socks and socks[self.master] == zmq.POLLIN:
             zmsg = self.master.recv_multipart()
         else: # timeout
@@ -137,8 +206,8 @@ class InfoWriter_Worker (threading.Thread):
     def handle_msg (self, cmsg):
         """ Got message from master, process it. """
 
-        data = cmsg.get_payload(self.xtx)
-        if not data: return
+        # already verified by master
+        data = Struct.from_json (cmsg.get_part1())
 
         mtime = data['mtime']
         mode = data['mode']
@@ -158,32 +227,43 @@ class InfoWriter_Worker (threading.Thread):
             fn += comp_ext[self.compression]
 
         # decide destination file
-        dstfn = os.path.normpath (os.path.join (self.dstdir, self.dstmask % {
-                'hostname': host,
-                'filepath': fn,
-                'filename': os.path.basename(fn)}))
-        if self.dstdir != os.path.commonprefix ([self.dstdir, dstfn]):
-            self.log.error ("suspicious file path, skipping %r", dstfn)
+        dstfn = self.pathcache.resolve (host, fn)
+        if dstfn is None:
+            self.log.error ("suspicious file path, skipping %r from %s", fn, host)
             return
-        subdir = os.path.dirname (dstfn)
-        if not os.path.isdir (subdir):
-            try:
-                os.makedirs (subdir)
-            except OSError, e:
-                if e.errno != errno.EEXIST:
-                    raise
 
-        # check if file exists and is older
-        try:
-            st = os.stat(dstfn)
-            if st.st_mtime == mtime:
+        # chunks and deltas go to disk directly
+        if data.get('chunks') or data.get('block_size'):
+            self.write_pending (dstfn)
+
+        # check if file exists and is older (first chunk only)
+        if not data.get('chunk'):
+            self.skipped.pop (dstfn, None)
+            old_mtime = self.mtimes.get (dstfn)
+            if old_mtime is None:
+                try:
+                    old_mtime = os.stat(dstfn).st_mtime
+                except OSError:
+                    pass
+            skip = False
+            if old_mtime is None:
+                pass
+            elif old_mtime == mtime:
                 self.log.info('%s mtime matches, skipping', dstfn)
-                return
-            elif st.st_mtime > mtime:
+                skip = True
+            elif old_mtime > mtime:
                 self.log.info('%s mtime newer, skipping', dstfn)
+                skip = True
+            if skip:
+                if data.get('chunks'):
+                    self.skipped[dstfn] = data['xfer_id']
                 return
-        except OSError:
-            pass
+        elif self.skipped.get (dstfn) == data['xfer_id']:
+            # rest of transfer skipped at first chunk
+            if data['chunk'] + 1 >= data['chunks']:
+                del self.skipped[dstfn]
+            self.stat_inc ('chunks_skipped')
+            return
 
         raw = cmsg.get_part3() # blob
         if not raw:
@@ -205,16 +285,179 @@ class InfoWriter_Worker (threading.Thread):
             else:
                 body = raw
 
-        # write file, apply original mtime
+        if data.get('chunks'):
+            self.write_chunk (data, dstfn, raw, body, mode)
+            return
+        if data.get('block_size'):
+            self.apply_delta (data, dstfn, body, mode)
+            return
+
+        if self.coalesce_window > 0:
+            self.queue_write (dstfn, body, mtime, mode)
+        else:
+            self.write_file (dstfn, body, mtime, mode)
+
+    def write_file (self, dstfn, body, mtime, mode):
+        """ Write file, apply original mtime. """
         self.log.debug ('writing %i bytes to %s', len(body), dstfn)
-        cc.util.write_atomic (dstfn, body, bakext = self.bakext, mode = mode)
+        try:
+            cc.util.write_atomic (dstfn, body, bakext = self.bakext, mode = mode, fsync = self.write_sync)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            # directory removed under us
+            self.pathcache.invalidate (dstfn)
+            cc.util.write_atomic (dstfn, body, bakext = self.bakext, mode = mode, fsync = self.write_sync)
         os.utime(dstfn, (mtime, mtime))
+        self.mtimes[dstfn] = mtime
+
+        self.stat_inc ('written_bytes', len(body))
+        self.stat_inc ('written_files')
+        self.stat_inc ('renames')
+
+    def queue_write (self, dstfn, body, mtime, mode):
+        """ Keep latest version of file for coalesce-window, then write it. """
+        pw = self.pending.get (dstfn)
+        if not pw:
+            self.pending[dstfn] = [time.time() + self.coalesce_window, mtime, body, mode]
+            return
+        self.stat_inc ('coalesced')
+        if mtime > pw[1]:
+            pw[1:] = [mtime, body, mode]
+
+    def write_pending (self, dstfn):
+        pw = self.pending.pop (dstfn, None)
+        if pw:
+            self.write_file (dstfn, pw[2], pw[1], pw[3])
+
+    def flush_pending (self, force = False):
+        """ Write coalesced files whose window has passed. """
+        now = time.time()
+        for dstfn, pw in self.pending.items():
+            if force or pw[0] <= now:
+                self.write_pending (dstfn)
+
+    def write_chunk (self, data, dstfn, raw, body, mode):
+        """ Append chunk to transfer's temp file, rename it when complete. """
+        xf = self.xfers.get (dstfn)
+        seq = data['chunk']
+        if seq == 0:
+            if xf:
+                self.log.info ('%s: new transfer, dropping unfinished one', dstfn)
+                self.abort_xfer (dstfn)
+            # not .new, that is used by write_atomic
+            self.xfer_seq += 1
+            tmpfn = '%s.xfer-%i' % (dstfn, self.xfer_seq)
+            xf = { 'id': data['xfer_id'], 'seq': 0, 'tmpfn': tmpfn,
+                   'obj': open (tmpfn, 'w' + mode), 'hash': hashlib.sha1(),
+                   'size': 0, 'atime': time.time() }
+            self.xfers[dstfn] = xf
+        elif not xf or xf['id'] != data['xfer_id'] or xf['seq'] != seq:
+            self.log.warning ('%s: unexpected chunk %i, dropping transfer', dstfn, seq)
+            self.stat_inc ('chunks_failed')
+            if xf:
+                self.abort_xfer (dstfn)
+            return
 
+        xf['obj'].write (body)
+        xf['hash'].update (raw)
+        xf['seq'] += 1
+        xf['size'] += len(body)
+        xf['atime'] = time.time()
         self.stat_inc ('written_bytes', len(body))
+        self.stat_inc ('written_chunks')
+
+        if xf['seq'] < data['chunks']:
+            return
+
+        # last chunk, verify and rename
+        del self.xfers[dstfn]
+        if self.write_sync:
+            cc.util.sync_file (xf['obj'], self.write_sync)
+        xf['obj'].close()
+        if xf['hash'].hexdigest() != data['xfer_hash']:
+            self.log.error ('%s: transfer hash mismatch, dropping', dstfn)
+            self.stat_inc ('chunks_failed')
+            os.unlink (xf['tmpfn'])
+            return
+        if self.write_compressed in [None, '', 'no'] and xf['size'] != data['size']:
+            self.log.error ('%s: size mismatch (%i <> %i), dropping', dstfn, xf['size'], data['size'])
+            self.stat_inc ('chunks_failed')
+            os.unlink (xf['tmpfn'])
+            return
+        self.log.debug ('wrote %i bytes to %s in %i chunks', xf['size'], dstfn, data['chunks'])
+        cc.util.replace_atomic (xf['tmpfn'], dstfn, bakext = self.bakext,
+                                fsync = self.write_sync == 'fsync')
+        os.utime (dstfn, (data['mtime'], data['mtime']))
+        self.mtimes[dstfn] = data['mtime']
         self.stat_inc ('written_files')
+        self.stat_inc ('renames')
+
+    def apply_delta (self, data, dstfn, body, mode):
+        """ Patch changed blocks into current copy of file.
+        Mismatching base is left alone until sender does full resend.
+        """
+        if self.write_compressed not in [None, '', 'no']:
+            self.log.warning ('%s: delta with write-compressed, skipping', dstfn)
+            self.stat_inc ('delta_skipped')
+            return
+        try:
+            f = open (dstfn, 'r' + mode)
+            old = f.read()
+            f.close()
+        except IOError:
+            old = None
+        if old is None or hashlib.sha1 (old).hexdigest() != data['base_hash']:
+            self.log.info ('%s: delta base mismatch, skipping', dstfn)
+            self.stat_inc ('delta_skipped')
+            return
+
+        bs = data['block_size']
+        size = data['size']
+        blocks = [int (i) for i in data['delta'].split (',') if i]
+        new = bytearray (old[:size])
+        if len(new) < size:
+            new.extend ('\0' * (size - len(new)))
+        for n, i in enumerate (blocks):
+            blk = body[n*bs : (n+1)*bs]
+            new[i*bs : i*bs + len(blk)] = blk
+        new = str(new)
+        if hashlib.sha1 (new).hexdigest() != data['content_hash']:
+            self.log.error ('%s: delta result hash mismatch, skipping', dstfn)
+            self.stat_inc ('delta_failed')
+            return
+
+        self.log.debug ('patched %i blocks of %s', len(blocks), dstfn)
+        cc.util.write_atomic (dstfn, new, bakext = self.bakext, mode = mode, fsync = self.write_sync)
+        os.utime (dstfn, (data['mtime'], data['mtime']))
+        self.mtimes[dstfn] = data['mtime']
+        self.stat_inc ('written_bytes', len(body))
+        self.stat_inc ('written_files')
+        self.stat_inc ('delta_files')
+        self.stat_inc ('renames')
+
+    def abort_xfer (self, dstfn):
+        xf = self.xfers.pop (dstfn)
+        xf['obj'].close()
+        try:
+            os.unlink (xf['tmpfn'])
+        except OSError:
+            pass
+
+    def expire_xfers (self):
+        """ Drop transfers that have not progressed in time. """
+        now = self.xfer_check = time.time()
+        for dstfn, xf in self.xfers.items():
+            if now - xf['atime'] > self.xfer_timeout:
+                self.log.warning ('%s: transfer timed out', dstfn)
+                self.stat_inc ('chunks_failed')
+                self.abort_xfer (dstfn)
 
     def stop (self):
         self.looping = False
 
     def shutdown (self):
         self.log.info ("%s stopping", self.name)
+        self.flush_pending (True)
+        for dstfn in self.xfers.keys():
+            self.abort_xfer (dstfn)
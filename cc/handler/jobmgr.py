@@ -5,13 +5,12 @@ import signal
 import subprocess
 import time
 
-from zmq.eventloop.ioloop import PeriodicCallback
-
 from cc.crypto import CryptoContext
 from cc.handler import CCHandler
 from cc.message import CCMessage
 from cc.reqs import ErrorMessage, JobConfigReplyMessage
 from cc.job import make_job_defaults
+from cc.timer import get_timer_wheel
 
 import skytools
 
@@ -35,6 +34,7 @@ class JobState:
         self.cc_url = cc_url
         self.timer = None
         self.ioloop = ioloop
+        self.wheel = get_timer_wheel (ioloop)
         self.pidfile = jcf.getfile('pidfile')
         self.start_count = 0
         self.start_time = None
@@ -48,6 +48,15 @@ class JobState:
             y = self.watchdog_formula_cap
         return y
 
+    def on_timer(self):
+        self.timer = None
+        try:
+            self.handle_timer()
+        finally:
+            # keep watching even if check failed
+            if self.timer is None:
+                self.timer = self.wheel.call_later (TIMER_TICK, self.on_timer)
+
     def handle_timer(self):
         if self.proc:
             self.log.debug('checking on %s (%i)', self.jname, self.proc.pid)
@@ -76,8 +85,6 @@ class JobState:
                 if self.dead_since is None:
                     self.dead_since = time.time()
                 if time.time() >= self.dead_since + self._watchdog_wait():
-                    self.timer.stop()
-                    self.timer = None
                     self.start()
 
     def start (self, args_extra = []):
@@ -116,8 +123,9 @@ class JobState:
         self.watchdog_formula_cap = self.jcf.getint ('watchdog-formula-cap', 0)
         if self.watchdog_formula_cap <= 0: self.watchdog_formula_cap = None
 
-        self.timer = PeriodicCallback (self.handle_timer, TIMER_TICK * 1000, self.ioloop)
-        self.timer.start()
+        if self.timer:
+            self.timer.cancel()
+        self.timer = self.wheel.call_later (TIMER_TICK, self.on_timer)
 
     def stop(self):
         try:
@@ -0,0 +1,213 @@
+"""
+Live tail subscriptions for log messages passing through CC.
+"""
+
+import collections
+import fnmatch
+import time
+
+import skytools
+
+from cc.handler import CCHandler
+from cc.message import CCMessage
+from cc.reqs import ErrorMessage, TailSubscribeReplyMessage
+from cc.timer import get_timer_wheel
+from cc.util import stat_put
+
+__all__ = ['LiveTail']
+
+CC_HANDLER = 'LiveTail'
+
+DROP_POLICIES = ('oldest', 'newest', 'cancel')
+
+
+class Subscription (object):
+    """ One subscriber with its filters and buffer """
+
+    def __init__ (self, sub_id, route):
+        self.sub_id = sub_id
+        self.route = route
+        self.credit = 0
+        self.buffer = collections.deque()
+        self.dropped = 0
+        self.expire = 0
+
+    def update (self, msg, maxbuf, drop, lifetime):
+        self.host = msg.get ('sub_host') or '*'
+        self.file = msg.get ('sub_file') or '*'
+        self.job = msg.get ('sub_job') or '*'
+        self.dest = msg.get ('sub_dest') or '*'
+        self.maxbuf = maxbuf
+        self.drop = drop
+        self.expire = time.time() + lifetime
+        self.credit += msg.get ('credit') or 0
+
+    def match (self, dest, data):
+        if self.dest != '*' and not fnmatch.fnmatchcase (dest, self.dest):
+            return False
+        if self.host != '*' and not fnmatch.fnmatchcase (data.get ('hostname') or '', self.host):
+            return False
+        if self.file != '*' and not fnmatch.fnmatchcase (data.get ('filename') or '', self.file):
+            return False
+        if self.job != '*' and not fnmatch.fnmatchcase (data.get ('job_name') or '', self.job):
+            return False
+        return True
+
+
+class LiveTail (CCHandler):
+    """ Sends copies of passing messages to subscribed clients.
+
+    Clients subscribe with tail.subscribe (filters on dest, hostname,
+    filename and job_name) and get matching messages as they are,
+    routed back to them.  Flow is credit based: client says how many
+    more messages it can take, the rest are buffered up to buffer size,
+    then dropped by policy.  Subscriptions expire unless renewed.
+
+    Handler does not forward messages, it should be added to routes
+    next to existing handlers (pub.logtail = h:livetail, h:tailwriter).
+    """
+
+    CC_ROLES = ['local', 'remote']
+
+    log = skytools.getLogger ('h:LiveTail')
+
+    def __init__ (self, hname, hcf, ccscript):
+        super(LiveTail, self).__init__(hname, hcf, ccscript)
+
+        self.max_subscribers = self.cf.getint ('max-subscribers', 100)
+        self.buffer_size = self.cf.getint ('buffer-size', 1000)
+        self.max_buffer_size = self.cf.getint ('max-buffer-size', 10000)
+        self.drop_policy = self.cf.get ('drop-policy', 'oldest')
+        self.lifetime = self.cf.getint ('lifetime', 60)
+        self.max_lifetime = self.cf.getint ('max-lifetime', 3600)
+        if self.drop_policy not in DROP_POLICIES:
+            raise skytools.UsageError ('unknown drop-policy: %s' % self.drop_policy)
+
+        self.subs = {}  # sub_id -> Subscription
+        self.wheel = get_timer_wheel (self.ioloop)
+
+    def handle_msg (self, cmsg):
+        """ Got message -- either subscription request or one to pass on. """
+        dest = cmsg.get_dest()
+        if dest == 'tail.subscribe':
+            self.subscribe (cmsg)
+        elif dest == 'tail.unsubscribe':
+            self.unsubscribe (cmsg)
+        elif self.subs:
+            self.publish (dest, cmsg)
+
+    def subscribe (self, cmsg):
+        """ New subscription, or renewal and credit for existing one. """
+        msg = cmsg.get_payload (self.xtx)
+        if not msg: return
+        sub_id = msg.get ('sub_id')
+        if not sub_id:
+            self.ccerror (cmsg, 'sub_id missing')
+            return
+        drop = msg.get ('drop') or self.drop_policy
+        if drop not in DROP_POLICIES:
+            self.ccerror (cmsg, 'unknown drop policy: %s' % drop)
+            return
+        maxbuf = min (msg.get ('buffer') or self.buffer_size, self.max_buffer_size)
+        lifetime = min (msg.get ('lifetime') or self.lifetime, self.max_lifetime)
+
+        sub = self.subs.get (sub_id)
+        if sub is None:
+            if len(self.subs) >= self.max_subscribers:
+                self.ccerror (cmsg, 'too many subscribers')
+                return
+            sub = self.subs[sub_id] = Subscription (sub_id, cmsg.get_route())
+            self.wheel.call_at (time.time() + lifetime, self.check_expiry, sub)
+            self.log.info ('new subscription: %s', sub_id)
+            self.stat_inc ('livetail.subscribed')
+        else:
+            sub.route = cmsg.get_route()
+        sub.update (msg, maxbuf, drop, lifetime)
+        while len(sub.buffer) > sub.maxbuf:
+            sub.buffer.popleft()
+            sub.dropped += 1
+        self.send_status (sub, 'ok')
+        self.send_buffered (sub)
+        stat_put ('livetail.subscribers', len(self.subs))
+
+    def unsubscribe (self, cmsg):
+        msg = cmsg.get_payload (self.xtx)
+        if not msg: return
+        sub = self.subs.get (msg.get ('sub_id'))
+        if sub is not None:
+            self.cancel (sub, 'unsubscribed')
+
+    def cancel (self, sub, status):
+        self.log.info ('subscription %s: %s', sub.sub_id, status)
+        del self.subs[sub.sub_id]
+        sub.buffer.clear()
+        self.send_status (sub, status)
+        stat_put ('livetail.subscribers', len(self.subs))
+
+    def check_expiry (self, sub):
+        if self.subs.get (sub.sub_id) is not sub:
+            return
+        if sub.expire > time.time():
+            self.wheel.call_at (sub.expire, self.check_expiry, sub)
+        else:
+            self.stat_inc ('livetail.expired')
+            self.cancel (sub, 'expired')
+
+    def publish (self, dest, cmsg):
+        """ Pass copy of message to matching subscribers. """
+        data = cmsg.get_payload (self.xtx)
+        if not data: return
+        zmsg = None
+        for sub in self.subs.values():
+            if not sub.match (dest, data):
+                continue
+            if zmsg is None:
+                zmsg = [''] + cmsg.get_non_route()
+            if sub.credit > 0 and not sub.buffer:
+                self.send_to_sub (sub, zmsg)
+            elif len(sub.buffer) < sub.maxbuf:
+                sub.buffer.append (zmsg)
+            elif sub.drop == 'oldest':
+                sub.buffer.popleft()
+                sub.buffer.append (zmsg)
+                self.count_drop (sub)
+            elif sub.drop == 'newest':
+                self.count_drop (sub)
+            else:
+                self.count_drop (sub)
+                self.cancel (sub, 'cancelled')
+
+    def count_drop (self, sub):
+        sub.dropped += 1
+        self.stat_inc ('livetail.dropped')
+
+    def send_to_sub (self, sub, zmsg):
+        rcm = CCMessage (sub.route + zmsg)
+        rcm.send_to (self.cclocal)
+        sub.credit -= 1
+        self.stat_inc ('livetail.sent')
+
+    def send_buffered (self, sub):
+        while sub.buffer and sub.credit > 0:
+            self.send_to_sub (sub, sub.buffer.popleft())
+
+    def send_status (self, sub, status):
+        rep = TailSubscribeReplyMessage (
+                sub_id = sub.sub_id,
+                status = status,
+                buffered = len(sub.buffer),
+                dropped = sub.dropped)
+        rcm = self.xtx.create_cmsg (rep)
+        rcm.set_route (sub.route)
+        rcm.send_to (self.cclocal)
+
+    def ccerror (self, cmsg, errmsg):
+        self.log.info (errmsg)
+        rcm = self.xtx.create_cmsg (ErrorMessage (msg = errmsg))
+        rcm.take_route (cmsg)
+        rcm.send_to (self.cclocal)
+
+    def stop (self):
+        super(LiveTail, self).stop()
+        for sub in self.subs.values():
+            self.cancel (sub, 'cancelled')
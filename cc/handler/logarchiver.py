@@ -0,0 +1,80 @@
+"""
+Appends log messages to columnar archive (see cc.logarchive).
+"""
+
+import Queue
+
+import skytools
+
+from cc.batchwriter import BatchWriter
+from cc.handler import CCHandler
+from cc.logarchive import ArchiveWriter
+
+__all__ = ['LogArchiver']
+
+CC_HANDLER = 'LogArchiver'
+
+
+class LogArchiver_Writer (BatchWriter):
+    """ Collects queued messages into blocks and writes them out. """
+
+    log = skytools.getLogger ('h:LogArchiver_Writer')
+
+    def __init__ (self, name, queue, writer, block_records, flush_interval, stat_inc):
+        super(LogArchiver_Writer, self).__init__(name, queue, block_records,
+                                                 flush_interval, stat_inc)
+        self.writer = writer
+
+    def write_batch (self, msgs):
+        try:
+            self.writer.write (msgs)
+            self.stat_inc ('logarchiver.records.written', len(msgs))
+            self.stat_inc ('logarchiver.blocks')
+        except Exception:
+            self.log.exception ('write failed, dropping %i records', len(msgs))
+            self.stat_inc ('logarchiver.records.failed', len(msgs))
+
+
+class LogArchiver (CCHandler):
+    """ Appends log messages to columnar archive.
+
+    Messages are written by background thread in blocks of up to
+    block-records messages, or whatever arrived within flush-interval.
+    Archive is partitioned into segments of partition-period seconds.
+    """
+
+    CC_ROLES = ['remote']
+
+    log = skytools.getLogger ('h:LogArchiver')
+
+    def __init__ (self, hname, hcf, ccscript):
+        super(LogArchiver, self).__init__(hname, hcf, ccscript)
+
+        writer = ArchiveWriter (self.cf.getfile ('dstdir'),
+                                self.cf.getint ('partition-period', 3600),
+                                self.cf.getint ('compression-level', 6))
+        self.queue = Queue.Queue (self.cf.getint ('queue-size', 100000))
+        self.writer = LogArchiver_Writer (self.hname + '.writer', self.queue, writer,
+                                          self.cf.getint ('block-records', 4096),
+                                          self.cf.getfloat ('flush-interval', 10),
+                                          self.stat_inc)
+        self.writer.start()
+
+    def handle_msg (self, cmsg):
+        """ Got message from client -- queue it for writer.
+        """
+        msg = cmsg.get_payload (self.xtx)
+        if msg is None or not hasattr (msg, 'log_level'):
+            self.stat_inc ('logarchiver.records.skipped')
+            return
+        try:
+            self.queue.put_nowait (msg)
+            self.stat_inc ('logarchiver.records.queued')
+        except Queue.Full:
+            self.stat_inc ('logarchiver.records.dropped')
+
+    def stop (self):
+        """ Let writer flush remaining records. """
+        super(LogArchiver, self).stop()
+        self.queue.put (None)
+        self.writer.join()
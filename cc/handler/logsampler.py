@@ -0,0 +1,140 @@
+"""
+Condenses log message floods, then dispatches them to another handler.
+"""
+
+import re
+import time
+
+import skytools
+
+from cc.handler import CCHandler
+from cc.json import Struct
+from cc.timer import get_timer_wheel
+
+__all__ = ['LogSampler']
+
+CC_HANDLER = 'LogSampler'
+
+# variable parts of log messages, replaced when building message template
+_rc_variable = re.compile (r'0x[0-9a-fA-F]+|\d+(?:\.\d+)?')
+
+def log_template (txt):
+    """ Return message text with numbers replaced by placeholder. """
+    return _rc_variable.sub ('#', txt)
+
+
+class LogGroup (object):
+    """ Repeated log messages with same template """
+    __slots__ = ('msg', 'count', 'last', 'timer')
+
+    def __init__ (self, msg):
+        self.msg = msg      # first message (forwarded)
+        self.count = 0      # suppressed repeats
+        self.last = msg.log_time
+        self.timer = None   # end of window
+
+
+class LogSampler (CCHandler):
+    """ Condenses log message floods, then dispatches them to another handler.
+
+    Messages with same (job_name, log_level, template) are forwarded only
+    once per window (starting from first message of group), repeats are
+    replaced by summary message sent at the end of window.  Additionally,
+    distinct messages may be sampled per level (level-sample = debug:100
+    passes 1 of 100 debug messages, rest are dropped).
+    """
+
+    CC_ROLES = ['local', 'remote']
+
+    log = skytools.getLogger ('h:LogSampler')
+
+    def __init__ (self, hname, hcf, ccscript):
+        super(LogSampler, self).__init__(hname, hcf, ccscript)
+
+        self.fwd_hname = self.cf.get ('forward-to')
+        self.fwd_handler = ccscript.get_handler (self.fwd_hname)
+
+        self.window = self.cf.getfloat ('window', 10)
+        self.max_groups = self.cf.getint ('max-groups', 10000)
+        self.level_sample = {}
+        for item in self.cf.getlist ('level-sample', []):
+            lev, n = item.rsplit (':', 1)
+            self.level_sample[lev.strip().upper()] = int (n)
+        self.level_count = {}
+        self.groups = {}    # (job_name, log_level, template) -> LogGroup
+        self.wheel = get_timer_wheel (self.ioloop)
+
+    def handle_msg (self, cmsg):
+        """ Got message from client -- forward, count or drop it.
+        """
+        msg = cmsg.get_payload (self.xtx)
+        if msg is None or not hasattr (msg, 'log_level'):
+            self.forward (cmsg)
+            return
+
+        key = (msg.job_name, msg.log_level, log_template (msg.log_msg))
+        g = self.groups.get (key)
+        if g is not None:
+            g.count += 1
+            g.last = msg.log_time
+            self.count ('suppressed', cmsg)
+            return
+
+        n = self.level_sample.get (msg.log_level.upper(), 1)
+        if n > 1:
+            c = self.level_count.get (msg.log_level, 0) + 1
+            self.level_count[msg.log_level] = c
+            if c % n:
+                self.count ('sampled_dropped', cmsg)
+                return
+
+        if len(self.groups) >= self.max_groups:
+            self.flush()
+        g = self.groups[key] = LogGroup (msg)
+        g.timer = self.wheel.call_later (self.window, self.end_group, key, g)
+        self.forward (cmsg)
+
+    def forward (self, cmsg):
+        try:
+            self.fwd_handler.handle_msg (cmsg)
+            stat = 'ok'
+        except Exception:
+            self.log.exception ('crashed, dropping msg: %s', cmsg.get_dest())
+            stat = 'crashed'
+        self.count (stat, cmsg)
+
+    def count (self, stat, cmsg):
+        size = cmsg.get_size()
+        self.stat_inc ('logsampler.count.%s' % stat)
+        self.stat_inc ('logsampler.bytes.%s' % stat, size)
+
+    def end_group (self, key, g):
+        """ End of group's window -- send summary of repeated messages. """
+        if self.groups.get (key) is not g:
+            return
+        del self.groups[key]
+        self.summarize (g)
+
+    def flush (self):
+        """ End all windows now. """
+        groups = self.groups
+        self.groups = {}
+        for g in groups.itervalues():
+            g.timer.cancel()
+            self.summarize (g)
+
+    def summarize (self, g):
+        if not g.count:
+            return
+        msg = Struct (g.msg)
+        msg.time = time.time()
+        msg.log_time = g.last
+        msg.log_msg = '%s [repeated %i times in %.0f s]' % (
+                g.msg.log_msg, g.count, g.last - g.msg.log_time)
+        msg.log_repeat = g.count
+        self.stat_inc ('logsampler.summaries')
+        self.forward (self.xtx.create_cmsg (msg))
+
+    def stop (self):
+        super(LogSampler, self).stop()
+        self.flush()
@@ -0,0 +1,157 @@
+"""
+Writes log messages as structured records to rotating files.
+
+Records are buffered in memory and written in batches by background
+thread, so the handler never blocks on file I/O.  Formats:
+
+  json - one JSON object per line
+  tnetstring - tnetstring list per record: [time, hostname, job_name,
+               service_type, level, pid, line, function, msg]
+"""
+
+import os
+import os.path
+import Queue
+
+import skytools
+
+from cc.batchwriter import BatchWriter
+from cc.handler import CCHandler
+from cc.json import dumps
+from cc.util import hsize_to_bytes
+
+# use fast implementation if available, otherwise fall back to reference one
+try:
+    import tnetstring as tnetstrings
+except ImportError:
+    import cc.tnetstrings as tnetstrings
+
+__all__ = ['LogSink']
+
+CC_HANDLER = 'LogSink'
+
+LOG_FIELDS = ['log_time', 'hostname', 'job_name', 'service_type', 'log_level',
+              'log_pid', 'log_line', 'log_function', 'log_msg']
+
+def _utf8 (v):
+    if isinstance (v, unicode):
+        return v.encode ('utf8')
+    return v
+
+def format_json (msg):
+    return dumps (dict ((f, msg.get (f)) for f in LOG_FIELDS)) + '\n'
+
+def format_tnetstring (msg):
+    return tnetstrings.dump ([_utf8 (msg.get (f)) for f in LOG_FIELDS])
+
+FORMATS = {
+    'json': format_json,
+    'tnetstring': format_tnetstring,
+}
+
+
+class LogSink_Writer (BatchWriter):
+    """ Writes queued records in batches, rotates files by size. """
+
+    log = skytools.getLogger ('h:LogSink_Writer')
+
+    def __init__ (self, name, queue, fn, fmt, params, stat_inc):
+        super(LogSink_Writer, self).__init__(name, queue, params['flush_records'],
+                                             params['flush_interval'], stat_inc)
+        self.fn = fn
+        self.prepare = FORMATS[fmt]
+        self.max_bytes = params['max_bytes']
+        self.backup_count = params['backup_count']
+        self.f = None
+        self.size = 0
+
+    def write_batch (self, buf):
+        data = ''.join (buf)
+        try:
+            if self.f is None:
+                self.open()
+            if self.max_bytes > 0 and self.size > 0 and self.size + len(data) > self.max_bytes:
+                self.rotate()
+            self.f.write (data)
+            self.f.flush()
+            self.size += len(data)
+            self.stat_inc ('logsink.records.written', len(buf))
+            self.stat_inc ('logsink.bytes.written', len(data))
+        except (IOError, OSError):
+            self.log.exception ('write failed, dropping %i records', len(buf))
+            self.stat_inc ('logsink.records.failed', len(buf))
+            self.close()
+
+    def open (self):
+        dn = os.path.dirname (self.fn)
+        if dn and not os.path.isdir (dn):
+            os.makedirs (dn)
+        self.f = open (self.fn, 'ab')
+        self.size = self.f.tell()
+
+    def finish (self):
+        self.close()
+
+    def close (self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+    def rotate (self):
+        """ Rename fn -> fn.1 -> fn.2 ..., dropping oldest. """
+        self.close()
+        if self.backup_count > 0:
+            for i in range (self.backup_count - 1, 0, -1):
+                src = '%s.%i' % (self.fn, i)
+                if os.path.exists (src):
+                    os.rename (src, '%s.%i' % (self.fn, i + 1))
+            os.rename (self.fn, self.fn + '.1')
+        else:
+            os.unlink (self.fn)
+        self.stat_inc ('logsink.rotated')
+        self.open()
+
+
+class LogSink (CCHandler):
+    """ Writes log messages as structured records to rotating files. """
+
+    CC_ROLES = ['local', 'remote']
+
+    log = skytools.getLogger ('h:LogSink')
+
+    def __init__ (self, hname, hcf, ccscript):
+        super(LogSink, self).__init__(hname, hcf, ccscript)
+
+        fn = self.cf.getfile ('logfile')
+        fmt = self.cf.get ('format', 'json')
+        if fmt not in FORMATS:
+            raise skytools.UsageError ('unknown format: %s' % fmt)
+        params = {
+            'flush_interval': self.cf.getfloat ('flush-interval', 1),
+            'flush_records': self.cf.getint ('flush-records', 1000),
+            'max_bytes': hsize_to_bytes (self.cf.get ('max-bytes', '100 MB')),
+            'backup_count': self.cf.getint ('backup-count', 5),
+        }
+        self.queue = Queue.Queue (self.cf.getint ('queue-size', 100000))
+        self.writer = LogSink_Writer (self.hname + '.writer', self.queue, fn, fmt, params,
+                                      self.stat_inc)
+        self.writer.start()
+
+    def handle_msg (self, cmsg):
+        """ Got message from client -- queue it for writer.
+        """
+        msg = cmsg.get_payload (self.xtx)
+        if msg is None or not hasattr (msg, 'log_level'):
+            self.stat_inc ('logsink.records.skipped')
+            return
+        try:
+            self.queue.put_nowait (msg)
+            self.stat_inc ('logsink.records.queued')
+        except Queue.Full:
+            self.stat_inc ('logsink.records.dropped')
+
+    def stop (self):
+        """ Let writer flush remaining records. """
+        super(LogSink, self).stop()
+        self.queue.put (None)
+        self.writer.join()
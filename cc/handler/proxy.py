@@ -6,12 +6,13 @@ import skytools
 import zmq
 from zmq.eventloop.ioloop import PeriodicCallback
 
+from cc.diskqueue import DiskQueue
 from cc.handler import CCHandler
 from cc.handler.echo import EchoState
 from cc.message import CCMessage, zmsg_size
 from cc.reqs import EchoRequestMessage
-from cc.stream import CCStream
-from cc.util import hsize_to_bytes
+from cc.stream import CCStream, lanes_from_config
+from cc.util import HashRing, hsize_to_bytes
 
 __all__ = ['ProxyHandler', 'BaseProxyHandler']
 
@@ -42,8 +43,8 @@ class BaseProxyHandler (CCHandler):
         super(BaseProxyHandler, self).__init__(hname, hcf, ccscript)
 
         s = self.make_socket()
-        self.stream = CCStream(s, ccscript.ioloop, qmaxsize = self.zmq_hwm)
-        self.stream.on_recv(self.on_recv)
+        self.spill = self.make_spill()
+        self.stream = self.make_stream(s, self.spill)
 
         self.startup()
         self.launch_workers()
@@ -54,7 +55,14 @@ class BaseProxyHandler (CCHandler):
     def launch_workers(self):
         pass
 
-    def make_socket(self):
+    def make_stream(self, sock, spill = None):
+        stream = CCStream(sock, self.ioloop, qmaxsize = self.zmq_hwm,
+                          spill = spill,
+                          lanes = lanes_from_config (self.cf, self.zmq_hwm))
+        stream.on_recv(self.on_recv)
+        return stream
+
+    def make_socket(self, url = None):
         self.zmq_hwm = self.cf.getint ('zmq_hwm', self.zmq_hwm)
         self.zmq_linger = self.cf.getint ('zmq_linger', self.zmq_linger)
         self.zmq_rcvbuf = hsize_to_bytes (self.cf.get ('zmq_rcvbuf', str(self.zmq_rcvbuf)))
@@ -63,7 +71,8 @@ class BaseProxyHandler (CCHandler):
         self.zmq_tcp_keepalive_intvl = self.cf.getint ('zmq_tcp_keepalive_intvl', self.zmq_tcp_keepalive_intvl)
         self.zmq_tcp_keepalive_idle = self.cf.getint ('zmq_tcp_keepalive_idle', self.zmq_tcp_keepalive_idle)
         self.zmq_tcp_keepalive_cnt = self.cf.getint ('zmq_tcp_keepalive_cnt', self.zmq_tcp_keepalive_cnt)
-        self.remote_url = self.cf.get ('remote-cc')
+        self.remote_urls = self.cf.getlist ('remote-cc')
+        self.remote_url = self.remote_urls[0]
         s = self.zctx.socket(zmq.XREQ)
         s.setsockopt (zmq.HWM, self.zmq_hwm)
         s.setsockopt (zmq.LINGER, self.zmq_linger)
@@ -77,9 +86,23 @@ class BaseProxyHandler (CCHandler):
                 s.setsockopt(zmq.TCP_KEEPALIVE_INTVL, self.zmq_tcp_keepalive_intvl)
                 s.setsockopt(zmq.TCP_KEEPALIVE_IDLE, self.zmq_tcp_keepalive_idle)
                 s.setsockopt(zmq.TCP_KEEPALIVE_CNT, self.zmq_tcp_keepalive_cnt)
-        s.connect (self.remote_url)
+        s.connect (url or self.remote_url)
         return s
 
+    def make_spill(self, suffix = ''):
+        """Create disk queue for messages over HWM, if configured."""
+        spill_dir = self.cf.getfile ('spill-dir', '')
+        if not spill_dir:
+            return None
+        if self.cf.getlist ('lanes', []):
+            self.log.warning ("spill-dir is not used together with lanes, ignoring")
+            return None
+        maxbytes = hsize_to_bytes (self.cf.get ('spill-max-bytes', '1 GB'))
+        segbytes = hsize_to_bytes (self.cf.get ('spill-segment-bytes', '16 MB'))
+        name = self.hname.replace(':', '_') + suffix
+        self.log.info ("spilling to %s (max %i bytes)", spill_dir, maxbytes)
+        return DiskQueue (spill_dir, name, maxbytes, segbytes)
+
     def on_recv(self, zmsg):
         """Got message from remote CC, send to client."""
         try:
@@ -95,10 +118,23 @@ class BaseProxyHandler (CCHandler):
         self.log.trace('')
         self.stream.send_cmsg(cmsg)
 
+    def stop(self):
+        super(BaseProxyHandler, self).stop()
+        if self.spill is not None:
+            self.spill.close()
+
 #
 # full featured message proxy
 #
 
+class Upstream (object):
+    """ Pooled connection to remote CC """
+    __slots__ = ('url', 'stream')
+
+    def __init__ (self, url, stream):
+        self.url = url
+        self.stream = stream
+
 class ProxyHandler (BaseProxyHandler):
     """ Simply proxies further """
 
@@ -109,12 +145,69 @@ class ProxyHandler (BaseProxyHandler):
     def __init__ (self, hname, hcf, ccscript):
         super(ProxyHandler, self).__init__(hname, hcf, ccscript)
 
+        # pool of connections to (possibly several) remote CCs
+        self.pool_size = max (1, self.cf.getint ('pool-size', 1))
+        self.pool_key = self.cf.getlist ('pool-key', [])
+        self.pool = []
+        for url in self.remote_urls:
+            for i in range (self.pool_size):
+                if not self.pool:
+                    stream = self.stream
+                else:
+                    stream = self.make_stream (self.make_socket (url), self.make_spill ('.%i' % len(self.pool)))
+                self.pool.append (Upstream (url, stream))
+        self.ring = HashRing (["%s#%i" % (up.url, i) for i, up in enumerate (self.pool)])
+        self.rr_pos = 0
+        self.dead_urls = set()
+        if len(self.pool) > 1:
+            self.log.info ("using %i connections to %s", len(self.pool), ', '.join(self.remote_urls))
+
         self.ping_remote = self.cf.getbool ("ping", False)
         if self.ping_remote:
-            self.echo_stats = EchoState (self.remote_url)
+            self.echo_stats = {}
+            for url in self.remote_urls:
+                self.echo_stats[url] = EchoState (url)
+                self.log.debug ("will ping %s", url)
             self.echo_timer = PeriodicCallback (self.ping, self.ping_tick * 1000, self.ioloop)
             self.echo_timer.start()
-            self.log.debug ("will ping %s", self.remote_url)
+
+    def handle_msg (self, cmsg):
+        """ Got message from client, send to remote CC (picked from pool). """
+        self.log.trace ('')
+        if len(self.pool) == 1:
+            self.stream.send_cmsg (cmsg)
+        else:
+            self.pick_upstream (cmsg).stream.send_cmsg (cmsg)
+
+    def _is_alive (self, n):
+        return self.pool[n].url not in self.dead_urls
+
+    def pick_upstream (self, cmsg):
+        """ Hash message key onto pool, or round-robin if no key configured. """
+        if self.pool_key:
+            n = self.ring.lookup (self.get_pool_key (cmsg), self._is_alive)
+            return self.pool[n]
+        for i in range (len(self.pool)):
+            self.rr_pos = (self.rr_pos + 1) % len(self.pool)
+            if self._is_alive (self.rr_pos):
+                break
+        return self.pool[self.rr_pos]
+
+    def get_pool_key (self, cmsg):
+        """ Build hash key from message dest and/or payload fields. """
+        msg = None
+        key = []
+        for f in self.pool_key:
+            if f == 'dest':
+                key.append (cmsg.get_dest())
+                continue
+            if msg is None:
+                msg = cmsg.get_payload (self.xtx) or {}
+            v = msg.get (f, '')
+            if not isinstance (v, basestring):
+                v = str (v)
+            key.append (v)
+        return '\0'.join (key)
 
     def on_recv (self, zmsg):
         """ Got message from remote CC, process it. """
@@ -139,39 +232,56 @@ class ProxyHandler (BaseProxyHandler):
         msg = cmsg.get_payload (self.xtx)
         if not msg: return
 
-        if msg.orig_target != self.remote_url:
-            self.log.warn ("unknown pong: %s", msg.orig_target)
+        url = msg.orig_target
+        if url not in self.echo_stats:
+            self.log.warn ("unknown pong: %s", url)
             return
-        echo = self.echo_stats
+        echo = self.echo_stats[url]
         echo.update_pong (msg)
 
+        if url in self.dead_urls:
+            self.log.info ("%s is back, resuming", url)
+            self.dead_urls.discard (url)
+            self.stat_inc ('pool.recovered')
+
         rtt = echo.time_pong - msg.orig_time
         if msg.orig_time == echo.time_ping:
-            self.log.trace ("echo time: %f s (%s)", rtt, self.remote_url)
+            self.log.trace ("echo time: %f s (%s)", rtt, url)
         elif rtt <= 5 * self.ping_tick:
-            self.log.debug ("late pong: %f s (%s)", rtt, self.remote_url)
+            self.log.debug ("late pong: %f s (%s)", rtt, url)
         else:
-            self.log.info ("too late pong: %f s (%s)", rtt, self.remote_url)
+            self.log.info ("too late pong: %f s (%s)", rtt, url)
 
-    def _send_ping (self):
+    def _send_ping (self, url):
         """ Send ping to remote CC. """
         msg = EchoRequestMessage(
-                target = self.remote_url)
+                target = url)
         cmsg = self.xtx.create_cmsg (msg)
-        self.stream.send_cmsg (cmsg)
-        self.echo_stats.update_ping (msg)
+        for up in self.pool:
+            if up.url == url:
+                up.stream.send_cmsg (cmsg)
+                break
+        self.echo_stats[url].update_ping (msg)
         self.log.trace ("%r", msg)
 
     def ping (self):
         """ Echo requesting and monitoring. """
         self.log.trace ("")
-        miss = self.echo_stats.time_ping - self.echo_stats.time_pong
-        if miss > 5 * self.ping_tick:
-            self.log.warn ("no pong from %s for %f s", self.remote_url, miss)
-        self._send_ping ()
+        for url, echo in self.echo_stats.items():
+            miss = echo.time_ping - echo.time_pong
+            if miss > 5 * self.ping_tick:
+                self.log.warn ("no pong from %s for %f s", url, miss)
+                if len(self.remote_urls) > 1 and url not in self.dead_urls:
+                    self.log.warn ("failing over from %s", url)
+                    self.dead_urls.add (url)
+                    self.stat_inc ('pool.failover')
+            self._send_ping (url)
 
     def stop (self):
         super(ProxyHandler, self).stop()
         self.log.info ("stopping")
         if hasattr (self, "echo_timer"):
             self.echo_timer.stop()
+        for up in self.pool[1:]:
+            if up.stream.spill is not None:
+                up.stream.spill.close()
@@ -0,0 +1,193 @@
+"""
+Rate-limits received messages with token buckets, then dispatches them to another handler.
+"""
+
+import collections
+import fnmatch
+import functools
+import time
+
+import skytools
+
+from cc.handler import CCHandler
+from cc.timer import get_timer_wheel
+
+__all__ = ['Shaper']
+
+CC_HANDLER = 'Shaper'
+
+IDLE_TIMEOUT = 5 * 60   # forget idle buckets after (seconds)
+
+class ShapeRule (object):
+    """ Bucket settings, matched by destination and hostname patterns """
+
+    def __init__ (self, name, cf):
+        self.name = name
+        pfx = 'bucket-%s-' % name
+        self.dest = cf.get (pfx + 'dest', '*')
+        self.host = cf.get (pfx + 'host', '*')
+        self.rate = cf.getfloat (pfx + 'rate')
+        self.burst = cf.getint (pfx + 'burst', max (1, int (self.rate)))
+        self.key = cf.getlist (pfx + 'key', [])
+        self.policy = cf.get (pfx + 'policy', 'drop')
+        self.sample = cf.getint (pfx + 'sample', 100)
+        self.qsize = cf.getint (pfx + 'queue-size', 1000)
+        if self.rate <= 0:
+            raise skytools.UsageError ('%s: rate must be positive' % name)
+        if self.policy not in ('drop', 'queue', 'sample'):
+            raise skytools.UsageError ('%s: unknown policy: %s' % (name, self.policy))
+        for k in self.key:
+            if k not in ('dest', 'host'):
+                raise skytools.UsageError ('%s: unknown key: %s' % (name, k))
+
+    def match (self, dest, host):
+        return (fnmatch.fnmatchcase (dest, self.dest)
+                and (self.host == '*' or fnmatch.fnmatchcase (host, self.host)))
+
+    def make_key (self, dest, host):
+        """ Bucket key within rule """
+        return ':'.join ([k == 'dest' and dest or host for k in self.key])
+
+
+class TokenBucket (object):
+    """ Token bucket state for one key """
+    __slots__ = ('rule', 'key', 'tokens', 'stamp', 'queue', 'over', 'timeout')
+
+    def __init__ (self, rule, key):
+        self.rule = rule
+        self.key = key
+        self.tokens = float (rule.burst)
+        self.stamp = time.time()
+        self.queue = collections.deque()
+        self.over = 0           # over-limit msgs (for sampling)
+        self.timeout = None     # ioloop timeout for draining queue
+
+    def refill (self, now):
+        self.tokens = min (self.rule.burst, self.tokens + (now - self.stamp) * self.rule.rate)
+        self.stamp = now
+
+
+class Shaper (CCHandler):
+    """ Rate-limits received messages, then dispatches them to another handler.
+
+    Each message goes to first bucket rule whose dest/host patterns match,
+    rule's key (dest and/or host) splits it further into separate buckets.
+    Messages matching no rule are passed as is.  Over limit, messages are
+    dropped, queued until tokens are available or sampled (1 of N passed).
+    """
+
+    CC_ROLES = ['local', 'remote']
+
+    log = skytools.getLogger ('h:Shaper')
+
+    def __init__ (self, hname, hcf, ccscript):
+        super(Shaper, self).__init__(hname, hcf, ccscript)
+
+        self.fwd_hname = self.cf.get ('forward-to')
+        self.fwd_handler = ccscript.get_handler (self.fwd_hname)
+
+        self.rules = [ShapeRule (name, self.cf) for name in self.cf.getlist ('buckets')]
+        self.need_host = False
+        for r in self.rules:
+            if r.host != '*' or 'host' in r.key:
+                self.need_host = True
+
+        self.buckets = {}   # (rule name, key) -> TokenBucket
+        self.wheel = get_timer_wheel (self.ioloop)
+
+    def handle_msg (self, cmsg):
+        """ Got message from client -- pass it on if within limits.
+        """
+        dest = cmsg.get_dest()
+        host = '?'
+        if self.need_host:
+            data = cmsg.get_payload (self.xtx)
+            if data:
+                host = data.get ('hostname') or '?'
+
+        for rule in self.rules:
+            if rule.match (dest, host):
+                break
+        else:
+            self.forward (cmsg, None)
+            return
+
+        bk = (rule.name, rule.make_key (dest, host))
+        b = self.buckets.get (bk)
+        if b is None:
+            b = self.buckets[bk] = TokenBucket (rule, bk[1])
+            self.wheel.call_later (IDLE_TIMEOUT, self.check_idle, bk)
+        now = time.time()
+        b.refill (now)
+
+        if b.tokens >= 1 and not b.queue:
+            b.tokens -= 1
+            self.forward (cmsg, b)
+        elif rule.policy == 'queue':
+            if len(b.queue) < rule.qsize:
+                b.queue.append (cmsg)
+                self.count (b, 'queued', cmsg)
+                self.schedule_drain (b)
+            else:
+                self.count (b, 'dropped', cmsg)
+        elif rule.policy == 'sample':
+            b.over += 1
+            if b.over % rule.sample == 0:
+                self.count (b, 'sampled', cmsg)
+                self.forward (cmsg, b)
+            else:
+                self.count (b, 'dropped', cmsg)
+        else:
+            self.count (b, 'dropped', cmsg)
+
+    def forward (self, cmsg, b):
+        try:
+            self.fwd_handler.handle_msg (cmsg)
+            stat = 'ok'
+        except Exception:
+            self.log.exception ('crashed, dropping msg: %s', cmsg.get_dest())
+            stat = 'crashed'
+        self.count (b, stat, cmsg)
+
+    def count (self, b, stat, cmsg):
+        size = cmsg.get_size()
+        self.stat_inc ('shaper.count.%s' % stat)
+        self.stat_inc ('shaper.bytes.%s' % stat, size)
+        if b is None:
+            return
+        self.stat_inc ('shaper.%s.count.%s' % (b.rule.name, stat))
+        if b.key:
+            self.stat_inc ('shaper.%s.%s.count.%s' % (b.rule.name, b.key, stat))
+
+    def schedule_drain (self, b):
+        if b.timeout is None:
+            wait = max (0, (1 - b.tokens) / b.rule.rate)
+            b.timeout = self.ioloop.add_timeout (time.time() + wait,
+                                                 functools.partial (self.drain, b))
+
+    def drain (self, b):
+        """ Pass queued messages as tokens become available. """
+        b.timeout = None
+        b.refill (time.time())
+        while b.queue and b.tokens >= 1:
+            b.tokens -= 1
+            self.forward (b.queue.popleft(), b)
+        if b.queue:
+            self.schedule_drain (b)
+
+    def check_idle (self, bk):
+        """ Forget bucket that has been full and idle for a while. """
+        b = self.buckets.get (bk)
+        if b is None:
+            return
+        if b.queue or time.time() - b.stamp < IDLE_TIMEOUT:
+            self.wheel.call_later (IDLE_TIMEOUT, self.check_idle, bk)
+        else:
+            del self.buckets[bk]
+
+    def stop (self):
+        super(Shaper, self).stop()
+        for b in self.buckets.itervalues():
+            if b.timeout is not None:
+                self.ioloop.remove_timeout (b.timeout)
+                b.timeout = None
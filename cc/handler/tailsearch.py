@@ -0,0 +1,141 @@
+"""
+Searches TailWriter output files using their side index (see cc.tailindex).
+"""
+
+import fnmatch
+import functools
+import os
+import os.path
+import time
+
+import skytools
+
+from cc.handler import CCHandler
+from cc.reqs import TailSearchReplyMessage
+from cc.tailindex import search_file
+
+__all__ = ['TailSearch']
+
+CC_HANDLER = 'TailSearch'
+
+
+class SearchJob (object):
+    """ Search request in progress """
+
+    def __init__ (self, cmsg, results, max_lines):
+        self.cmsg = cmsg
+        self.results = results
+        self.max_lines = max_lines
+        self.lines = []
+        self.total = 0
+        self.start = time.time()
+
+
+class TailSearch (CCHandler):
+    """ Answers tail.search requests over indexed TailWriter files.
+
+    Matching lines are sent back in batches of reply-lines, last reply
+    has done=1.  Work is done in short slices on IOLoop, so other
+    messages are not held up by long searches.
+    """
+
+    CC_ROLES = ['remote']
+
+    log = skytools.getLogger ('h:TailSearch')
+
+    def __init__ (self, hname, hcf, ccscript):
+        super(TailSearch, self).__init__(hname, hcf, ccscript)
+
+        self.dstdir = self.cf.getfile ('dstdir')
+        self.dstmask = self.cf.get ('dstmask', '')
+        if self.dstmask == '': # legacy
+            if self.cf.getbool ('host-subdirs', 0):
+                self.dstmask = '%(hostname)s/%(filename)s'
+            else:
+                self.dstmask = '%(hostname)s--%(filename)s'
+        self.max_lines = self.cf.getint ('max-lines', 1000)
+        self.reply_lines = self.cf.getint ('reply-lines', 100)
+        self.slice_time = self.cf.getfloat ('slice-time', 0.05)
+
+    def handle_msg (self, cmsg):
+        """ Got search request -- start processing it. """
+        msg = cmsg.get_payload (self.xtx)
+        if not msg: return
+
+        host = msg.get ('search_host') or '*'
+        fn = msg.get ('search_file') or '*'
+        text = (msg.get ('text') or u'').encode ('utf8')
+        max_lines = min (msg.get ('max_lines') or self.max_lines, self.max_lines)
+        files = self.find_files (host.replace ('/', '_'), fn.replace ('\\', '/'))
+        self.log.debug ("search %r in %s/%s", text, host, fn)
+
+        results = self.iter_results (files, msg.get ('tmin'), msg.get ('tmax'), text)
+        job = SearchJob (cmsg, results, max_lines)
+        self.stat_inc ('tailsearch.requests')
+        self.ioloop.add_callback (functools.partial (self.run_search, job))
+
+    def find_files (self, host, fn):
+        """ Yield indexed files matching host and filename patterns.
+        Directories are listed lazily, as search proceeds, None is
+        yielded after each one so caller can give way to others.
+        """
+        pat = os.path.normpath (self.dstmask % {
+                'hostname': host,
+                'filepath': fn,
+                'filename': os.path.basename (fn)})
+        for dn, subdirs, names in os.walk (self.dstdir):
+            subdirs.sort()
+            for name in sorted (names):
+                if not name.endswith ('.cidx'):
+                    continue
+                path = os.path.join (dn, name[:-5])
+                rel = os.path.relpath (path, self.dstdir)
+                if fnmatch.fnmatchcase (rel, pat) and os.path.isfile (path):
+                    yield rel
+            yield None
+
+    def iter_results (self, files, tmin, tmax, text):
+        """ Yield (file, [(offset, line), ...]) per scanned block. """
+        for rel in files:
+            if rel is None:
+                yield rel, []
+                continue
+            try:
+                for found in search_file (os.path.join (self.dstdir, rel), tmin, tmax, text):
+                    yield rel, found
+            except (IOError, OSError), e:
+                self.log.warning ("cannot search %s: %s", rel, e)
+
+    def run_search (self, job):
+        """ Process search for a while, then give way to others. """
+        deadline = time.time() + self.slice_time
+        try:
+            while time.time() < deadline:
+                try:
+                    rel, found = job.results.next()
+                except StopIteration:
+                    self.send_reply (job, done = 1)
+                    return
+                for ofs, ln in found:
+                    job.lines.append ({'file': rel, 'offset': ofs, 'line': ln.decode ('utf8', 'replace')})
+                    job.total += 1
+                    if job.total >= job.max_lines:
+                        self.send_reply (job, done = 1, truncated = 1)
+                        return
+                if len(job.lines) >= self.reply_lines:
+                    self.send_reply (job)
+        except Exception:
+            self.log.exception ('search crashed')
+            self.send_reply (job, done = 1)
+            return
+        self.ioloop.add_callback (functools.partial (self.run_search, job))
+
+    def send_reply (self, job, done = 0, truncated = 0):
+        rep = TailSearchReplyMessage (lines = job.lines, done = done, truncated = truncated)
+        rcm = self.xtx.create_cmsg (rep)
+        rcm.take_route (job.cmsg)
+        rcm.send_to (self.cclocal)
+        job.lines = []
+        if done:
+            self.stat_inc ('tailsearch.lines', job.total)
+            self.stat_inc ('tailsearch.time', time.time() - job.start)
@@ -3,7 +3,7 @@ import errno
 import os
 import threading
 import time
-from collections import deque
+from collections import deque, OrderedDict
 
 import skytools
 import zmq
@@ -12,8 +12,11 @@ from zmq.eventloop.ioloop import PeriodicCallback
 import cc.util
 from cc.handler import CCHandler
 from cc.message import CCMessage
-from cc.reqs import ReplyMessage
+from cc.reqs import LogtailAckMessage, ReplyMessage
 from cc.stream import CCStream
+from cc.tailindex import TailIndexWriter
+from cc.timer import get_timer_wheel
+from cc.util import HashRing, PathCache
 
 __all__ = ['TailWriter']
 
@@ -25,7 +28,7 @@ CC_HANDLER = 'TailWriter'
 
 BUF_MINBYTES = 64 * 1024
 DATETIME_SUFFIX = ".%Y-%m-%d_%H-%M-%S"
-FLUSH_DELAY = 3     # since last write
+FLUSH_DELAY = 3     # since last flush
 CLOSE_DELAY = 30    # since last write
 
 comp_ext = {
@@ -35,15 +38,16 @@ comp_ext = {
 
 class FileState (object):
     """ File tracking state (master) """
-    __slots__ = ('ident', 'wname', 'waddr', 'queue', 'count', 'ctime', 'atime')
+    __slots__ = ('ident', 'wname', 'waddr', 'queue', 'count', 'ctime', 'atime', 'route')
 
-    def __init__ (self, ident, count=0):
+    def __init__ (self, ident, count=0, wname=None):
         self.atime = self.ctime = time.time()
         self.queue = deque()    # msgs yet to send
         self.count = count      # sent and not ack'd
-        self.waddr = None       # socket identity
-        self.wname = None       # thread name
+        self.waddr = wname      # socket identity
+        self.wname = wname      # thread name
         self.ident = ident
+        self.route = None       # client route (for acks)
 
     def send_to (self, sock):
         while self.queue:
@@ -65,6 +69,9 @@ class TailWriter (CCHandler):
 
         self.files = {}
         self.workers = []
+        self.ready = set()  # workers that have connected
+        self.waiting = {}   # wname -> files waiting for worker to connect
+        self.wload = {}     # wname -> msgs sent and not ack'd
         self.wparams = {} # passed to workers
 
         self.wparams['dstdir'] = self.cf.getfile ('dstdir')
@@ -75,8 +82,21 @@ class TailWriter (CCHandler):
             else:
                 self.wparams['dstmask'] = '%(hostname)s--%(filename)s'
         self.wparams['maint_period'] = self.cf.getint ('maint-period', 3)
+        self.wparams['flush_delay'] = self.cf.getfloat ('flush-delay', FLUSH_DELAY)
+        self.wparams['close_delay'] = self.cf.getfloat ('close-delay', CLOSE_DELAY)
+        self.wparams['write_batch_bytes'] = cc.util.hsize_to_bytes (self.cf.get ('write-batch-bytes', '64 KB'))
+        self.wparams['max_open_files'] = self.cf.getint ('max-open-files', 1000)
+        self.rebalance_depth = self.cf.getint ('rebalance-depth', 100)
+        self.wparams['pathcache'] = PathCache (self.wparams['dstdir'], self.wparams['dstmask'],
+                                               self.cf.getint ('path-cache-size', 10000))
         self.wparams['write_compressed'] = self.cf.get ('write-compressed', '')
         assert self.wparams['write_compressed'] in [None, '', 'no', 'keep', 'yes']
+        self.wparams['write_index'] = self.cf.getbool ('write-index', False)
+        if self.wparams['write_index'] and self.wparams['write_compressed'] not in [None, '', 'no']:
+            self.log.warning ("index not supported for compressed files")
+            self.wparams['write_index'] = False
+        self.wparams['index_block_bytes'] = cc.util.hsize_to_bytes (self.cf.get ('index-block-bytes', '64 KB'))
+        self.wparams['index_bloom_bits'] = self.cf.getint ('index-bloom-bits', 65536)
         if self.wparams['write_compressed'] in ('keep', 'yes'):
             self.log.info ("position checking not supported for compressed files")
         if self.wparams['write_compressed'] == 'yes':
@@ -89,12 +109,13 @@ class TailWriter (CCHandler):
                 self.log.info ("buffer-bytes too low, adjusting: %i -> %i", self.wparams['buf_maxbytes'], BUF_MINBYTES)
                 self.wparams['buf_maxbytes'] = BUF_MINBYTES
 
-        # initialise sockets for communication with workers
-        self.dealer_stream, self.dealer_url = self.init_comm (zmq.XREQ, 'inproc://workers-dealer', self.dealer_on_recv)
+        # initialise socket for communication with workers
         self.router_stream, self.router_url = self.init_comm (zmq.XREP, 'inproc://workers-router', self.router_on_recv)
 
         self.launch_workers()
 
+        self.wheel = get_timer_wheel (self.ioloop)
+
         self.timer_maint = PeriodicCallback (self.do_maint, self.wparams['maint_period'] * 1000, self.ioloop)
         self.timer_maint.start()
 
@@ -115,10 +136,12 @@ class TailWriter (CCHandler):
             self.log.info ("starting %s", wname)
             w = TailWriter_Worker(
                     wname, self.xtx, self.zctx, self.ioloop,
-                    self.dealer_url, self.router_url, self.wparams)
+                    self.router_url, self.wparams)
             w.stat_inc = self.stat_inc # XXX
             self.workers.append (w)
+            self.wload[wname] = 0
             w.start()
+        self.ring = HashRing ([w.name for w in self.workers])
 
     def handle_msg (self, cmsg):
         """ Got message from client, process it. """
@@ -132,54 +155,91 @@ class TailWriter (CCHandler):
         st_ino = data.get('st_ino')
 
         fi = (host, st_dev, st_ino, fn)
-        if fi in self.files:
-            fd = self.files[fi]
-            if fd.waddr: # already accepted ?
-                self.log.trace ("passing %r to %s", fn, fd.wname)
-                fd.queue.append (cmsg)
-                fd.send_to (self.router_stream)
-            else:
-                self.log.trace ("queueing %r", fn)
-                fd.queue.append (cmsg)
-        else:
-            fd = FileState (fi, 1)
+        fd = self.files.get (fi)
+        if fd is None:
+            fd = FileState (fi, 0, self.assign_worker (fi))
             self.files[fi] = fd
-            self.log.trace ("offering %r", fn)
-            self.dealer_stream.send_cmsg (cmsg)
-
-    def dealer_on_recv (self, zmsg):
-        """ Got reply from worker via "dealer" connection """
-        self.log.warning ("reply via dealer: %s", zmsg)
+            self.wheel.call_later (2 * self.wparams['close_delay'], self.check_expiry, fi)
+            self.log.trace ("assigned %r to %s", fn, fd.wname)
+        if data.get('want_ack'):
+            fd.route = cmsg.get_route()
+        fd.queue.append (cmsg)
+        if fd.wname in self.ready:
+            self.log.trace ("passing %r to %s", fn, fd.wname)
+            self.send_queue (fd)
+        else:
+            self.log.trace ("queueing %r", fn)
+            self.waiting.setdefault (fd.wname, set()).add (fi)
+
+    def assign_worker (self, fi):
+        """ Pick worker for new file by hash, unless it is overloaded. """
+        wname = self.workers[self.ring.lookup ("%s:%s:%s:%s" % fi)].name
+        load = self.wload[wname]
+        if load > self.rebalance_depth and load * len(self.wload) > 2 * sum (self.wload.values()):
+            least = min (self.wload, key = self.wload.get)
+            self.log.debug ("%s overloaded (%i), using %s", wname, load, least)
+            self.stat_inc ('rebalanced')
+            wname = least
+        return wname
+
+    def send_queue (self, fd):
+        self.wload[fd.wname] += len(fd.queue)
+        fd.send_to (self.router_stream)
 
     def router_on_recv (self, zmsg):
         """ Got reply from worker via "router" connection """
         cmsg = CCMessage (zmsg)
         data = cmsg.get_payload (self.xtx)
+        if 'd_hostname' not in data:
+            # worker announces itself on startup
+            wname = zmsg[0]
+            self.log.debug ("%s ready", wname)
+            self.ready.add (wname)
+            for fi in self.waiting.pop (wname, ()):
+                if fi in self.files:
+                    self.send_queue (self.files[fi])
+            return
         fi = (data['d_hostname'], data['d_st_dev'], data['d_st_ino'], data['d_filename'])
         fd = self.files[fi]
-        if fd.waddr is None:
-            fd.waddr = zmsg[0]
-            fd.wname = data['worker']
-        else:
-            assert fd.waddr == zmsg[0] and fd.wname == data['worker']
+        assert fd.waddr == zmsg[0] and fd.wname == data['worker']
         fd.atime = time.time()
         fd.count -= 1
+        self.wload[fd.wname] -= 1
         assert fd.count >= 0
+        if data.get('d_ack') and fd.route:
+            self.send_client_ack (fd, data)
+
+    def send_client_ack (self, fd, data):
+        """ Pass worker's ack back to tailer (flow control) """
+        ack = LogtailAckMessage(
+                filename = data['d_filename'],
+                fpos = data['d_fpos'],
+                st_dev = data['d_st_dev'],
+                st_ino = data['d_st_ino'])
+        acm = self.xtx.create_cmsg (ack)
+        acm.set_route (fd.route)
+        acm.send_to (self.cclocal)
+        self.stat_inc ('acks_sent')
+
+    def check_expiry (self, fi):
+        """ Drop file if inactive, otherwise check again later. """
+        fd = self.files.get (fi)
+        if fd is None:
+            return
+        limit = 2 * self.wparams['close_delay']
+        idle = time.time() - fd.atime
+        if fd.count == 0 and not fd.queue and idle > limit:
+            self.log.debug ("forgetting %r", fd.ident)
+            del self.files[fi]
+        elif fd.count or fd.queue:
+            self.wheel.call_later (limit, self.check_expiry, fi)
+        else:
+            self.wheel.call_later (limit - idle, self.check_expiry, fi)
 
     def do_maint (self):
-        """ Check & flush queues; drop inactive files. """
-        self.log.trace ('cleanup')
-        now = time.time()
-        zombies = []
-        for k, fd in self.files.iteritems():
-            if fd.queue and fd.waddr:
-                self.log.trace ("passing %r to %s", fd.ident, fd.wname)
-                fd.send_to (self.router_stream)
-            if (fd.count == 0) and (now - fd.atime > 2 * CLOSE_DELAY): # you'd better use msg for this
-                self.log.debug ("forgetting %r", fd.ident)
-                zombies.append(k)
-        for k in zombies:
-                self.files.pop(k)
+        """ Report worker load. """
+        for wname, load in self.wload.iteritems():
+            cc.util.stat_put ('%s.queue' % wname, load)
 
     def stop (self):
         """ Signal workers to shut down. """
@@ -199,7 +259,7 @@ class TailWriter_Worker (threading.Thread):
 
     log = skytools.getLogger ('h:TailWriter_Worker')
 
-    def __init__ (self, name, xtx, zctx, ioloop, dealer_url, router_url, params = {}):
+    def __init__ (self, name, xtx, zctx, ioloop, url, params = {}):
         super(TailWriter_Worker, self).__init__(name=name)
 
         self.log = skytools.getLogger ('h:TailWriter_Worker' + name[name.rfind('-'):])
@@ -209,30 +269,28 @@ class TailWriter_Worker (threading.Thread):
         self.xtx = xtx
         self.zctx = zctx
         self.ioloop = ioloop
-        self.shared_url = dealer_url
-        self.direct_url = router_url
+        self.master_url = url
 
         for k, v in params.items():
             self.log.trace ("setattr: %s -> %r", k, v)
             setattr (self, k, v)
 
-        self.files = {}
+        self.files = OrderedDict() # in LRU order
         self.looping = True
 
     def startup (self):
-        # announce channel (for new files)
-        self.sconn = self.zctx.socket (zmq.XREP)
-        self.sconn.connect (self.shared_url)
-        # direct channel (for grabbed files)
+        # channel to master, files are assigned to us by name
         self.dconn = self.zctx.socket (zmq.XREQ)
-        self.dconn.connect (self.direct_url)
+        self.dconn.setsockopt (zmq.IDENTITY, self.name)
+        self.dconn.connect (self.master_url)
         # polling interface
         self.poller = zmq.Poller()
-        self.poller.register (self.sconn, zmq.POLLIN)
         self.poller.register (self.dconn, zmq.POLLIN)
-        # schedule regular maintenance
-        self.timer_maint = PeriodicCallback (self.do_maint, self.maint_period * 1000, self.ioloop)
-        self.timer_maint.start()
+        # regular maintenance is done in our own thread
+        self.maint_time = time.time()
+        # let master know we are connected
+        rcm = self.xtx.create_cmsg (ReplyMessage (worker = self.name))
+        rcm.send_to (self.dconn)
 
     def run (self):
         self.log.info ("%s running", self.name)
@@ -246,10 +304,10 @@ class TailWriter_Worker (threading.Thread):
 
     def work (self):
         socks = dict (self.poller.poll (1000))
+        if time.time() - self.maint_time >= self.maint_period:
+            self.do_maint()
         if self.dconn in socks and socks[self.dconn] == zmq.POLLIN:
             zmsg = self.dconn.recv_multipart()
-        elif self.sconn in socks and socks[self.sconn] == zmq.POLLIN:
-            zmsg = self.sconn.recv_multipart()
         else: # timeout
             return
         try:
@@ -265,16 +323,34 @@ class TailWriter_Worker (threading.Thread):
         data = cmsg.get_payload (self.xtx)
         if not data: return
 
-        mode = data['mode']
         host = data['hostname'].replace('/', '_')
+        want_ack = data.get('want_ack')
+        try:
+            fd = self._write_msg (cmsg, data, host)
+            if want_ack and fd is not None:
+                # data must be written out (to OS, not fsynced) before
+                # delivery is confirmed, so it survives our restart
+                if fd['buf']:
+                    self._append (fd, self._process_buffer (fd))
+                self._flush (fd)
+        except:
+            want_ack = False
+            raise
+        finally:
+            # master waits for reply in any case, tailer only if acked
+            self._send_ack (host, data.get('st_dev'), data.get('st_ino'),
+                            data['filename'], data.get('fpos'), want_ack)
+
+    def _write_msg (self, cmsg, data, host):
+        """ Append message data to its file, return file state
+        or None if message was rejected.
+        """
+        mode = data['mode']
         fn = data['filename'].replace('\\', '/')
         op_mode = data.get('op_mode')
         st_dev = data.get('st_dev')
         st_ino = data.get('st_ino')
 
-        # let master know asap :-)
-        self._send_ack (host, st_dev, st_ino, data['filename'], data.get('fpos'))
-
         # sanitize
         if mode not in ['', 'b']:
             self.log.warning ("unsupported fopen mode (%r), ignoring it", mode)
@@ -293,41 +369,47 @@ class TailWriter_Worker (threading.Thread):
         # Cache open files
         fi = (host, st_dev, st_ino, fn)
         if fi in self.files:
-            fd = self.files[fi]
+            fd = self.files.pop (fi)
+            self.files[fi] = fd
             if mode != fd['mode']:
                 self.log.error ("fopen mode mismatch (%s -> %s)", mode, fd['mode'])
-                return
+                return None
             if op_mode != fd['op_mode']:
                 self.log.error ("operation mode mismatch (%s -> %s)", op_mode, fd['op_mode'])
-                return
+                return None
         else:
             # decide destination file
-            dstfn = os.path.normpath (os.path.join (self.dstdir, self.dstmask % {
-                    'hostname': host,
-                    'filepath': fn,
-                    'filename': os.path.basename(fn)}))
-            if self.dstdir != os.path.commonprefix ([self.dstdir, dstfn]):
-                self.log.error ("suspicious file path, skipping %r", dstfn)
-                return
-            subdir = os.path.dirname (dstfn)
-            if not os.path.isdir (subdir):
-                try:
-                    os.makedirs (subdir)
-                except OSError, e:
-                    if e.errno != errno.EEXIST:
-                        raise
+            dstfn = self.pathcache.resolve (host, fn)
+            if dstfn is None:
+                self.log.error ("suspicious file path, skipping %r from %s", fn, host)
+                return None
             if op_mode == 'rotated':
                 dt = datetime.datetime.today()
                 dstfn += dt.strftime (DATETIME_SUFFIX)
 
-            fobj = open (dstfn, 'a' + mode)
+            try:
+                fno = self._open (dstfn, mode)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                # directory removed under us
+                self.pathcache.invalidate (dstfn)
+                fno = self._open (dstfn, mode)
             self.log.info ('opened %s', dstfn)
 
             now = time.time()
-            fd = { 'obj': fobj, 'mode': mode, 'path': dstfn,
+            fd = { 'fd': fno, 'mode': mode, 'path': dstfn,
                    'wtime': now, 'ftime': now, 'buf': [], 'bufsize': 0,
-                   'offset': 0, 'op_mode': op_mode }
+                   'wbuf': [], 'wbytes': 0, 'size': os.fstat(fno).st_size,
+                   'offset': 0, 'op_mode': op_mode, 'fpos_end': None, 'index': None }
+            if self.write_index:
+                fd['index'] = TailIndexWriter (dstfn + '.cidx', fd['size'],
+                                               self.index_block_bytes, self.index_bloom_bits)
             self.files[fi] = fd
+            while self.max_open_files > 0 and len(self.files) > self.max_open_files:
+                k, old = self.files.popitem (last = False)
+                self._close (old)
+                self.stat_inc ('lru_closed')
 
         raw = cmsg.get_part3() # blob
         if not raw:
@@ -347,24 +429,76 @@ class TailWriter_Worker (threading.Thread):
                 fd['buf'].append(deco)
                 fd['bufsize'] += len(deco)
                 if fd['bufsize'] < self.buf_maxbytes:
-                    return
+                    return fd
                 body = self._process_buffer(fd)
             else:
                 body = raw
 
         if hasattr (data, 'fpos') and (self.write_compressed in [None, '', 'no']
                 or (self.write_compressed == 'keep' and data['comp'] in [None, '', 'none'])):
-            fpos = fd['obj'].tell()
-            if data['fpos'] != fpos + fd['offset']:
-                self.log.warning ("sync lost: %i -> %i", fpos, data['fpos'])
-                fd['offset'] = data['fpos'] - fpos
+            src_fpos = data['fpos']
+            # drop data already written (re-sent by tailer after restart from checkpoint)
+            end = fd['fpos_end']
+            if end is not None and src_fpos < end:
+                skip = min (end - src_fpos, len(body))
+                self.log.info ("skipping %i re-sent bytes for %s", skip, fd['path'])
+                self.stat_inc ('duplicate_bytes', skip)
+                body = body[skip:]
+                src_fpos += skip
+                if not body:
+                    return fd
+            fd['fpos_end'] = src_fpos + len(body)
+            fpos = fd['size']
+            if src_fpos != fpos + fd['offset']:
+                self.log.warning ("sync lost: %i -> %i", fpos, src_fpos)
+                fd['offset'] = src_fpos - fpos
 
         # append to file
-        self.log.debug ('appending %i bytes to %s', len(body), fd['path'])
-        fd['obj'].write (body)
+        if fd['index'] is not None:
+            fd['index'].add (fd['size'], body, data['time'])
+        self._append (fd, body)
+        self.stat_inc ('appended_bytes', len(body))
+        return fd
+
+    def _open (self, dstfn, mode):
+        """ Open raw fd for appending """
+        flags = os.O_WRONLY | os.O_APPEND | os.O_CREAT
+        if mode == 'b':
+            flags |= getattr (os, 'O_BINARY', 0)
+        return os.open (dstfn, flags, 0644)
+
+    def _append (self, fd, body):
+        """ Add data to write buffer, write it out when batch is full """
+        fd['wbuf'].append (body)
+        fd['wbytes'] += len(body)
+        fd['size'] += len(body)
         fd['wtime'] = time.time()
+        if fd['wbytes'] >= self.write_batch_bytes:
+            self._flush (fd)
 
-        self.stat_inc ('appended_bytes', len(body))
+    def _flush (self, fd):
+        """ Write out buffered data with one syscall """
+        if not fd['wbuf']:
+            return
+        self.log.debug ('writing %i bytes to %s', fd['wbytes'], fd['path'])
+        data = ''.join (fd['wbuf'])
+        fd['wbuf'] = []
+        fd['wbytes'] = 0
+        while data:
+            n = os.write (fd['fd'], data)
+            data = data[n:]
+        fd['ftime'] = time.time()
+        self.stat_inc ('writes')
+
+    def _close (self, fd):
+        """ Write out all buffers and close file """
+        if fd['buf']:
+            self._append (fd, self._process_buffer (fd))
+        self._flush (fd)
+        os.close (fd['fd'])
+        if fd['index'] is not None:
+            fd['index'].close()
+        self.log.info ('closed %s', fd['path'])
 
     def _process_buffer (self, fd):
         """ Compress and reset write buffer """
@@ -375,7 +509,7 @@ class TailWriter_Worker (threading.Thread):
         fd['bufsize'] = 0
         return out
 
-    def _send_ack (self, hostname, st_dev, st_ino, filename, fpos):
+    def _send_ack (self, hostname, st_dev, st_ino, filename, fpos, ack = False):
         """ Send ack to master """
         rep = ReplyMessage(
                 worker = self.name,
@@ -383,28 +517,22 @@ class TailWriter_Worker (threading.Thread):
                 d_st_dev = st_dev,
                 d_st_ino = st_ino,
                 d_filename = filename,
-                d_fpos = fpos)
+                d_fpos = fpos,
+                d_ack = ack)
         rcm = self.xtx.create_cmsg (rep)
         rcm.send_to (self.dconn)
 
     def do_maint (self):
-        """ Close long-open files; flush inactive files. """
+        """ Close inactive files; write out buffers held too long. """
         self.log.trace ('cleanup')
-        now = time.time()
+        now = self.maint_time = time.time()
         zombies = []
         for k, fd in self.files.iteritems():
-            if now - fd['wtime'] > CLOSE_DELAY:
-                if fd['buf']:
-                    body = self._process_buffer(fd)
-                    fd['obj'].write(body)
-                fd['obj'].close()
-                self.log.info ('closed %s', fd['path'])
+            if now - fd['wtime'] > self.close_delay:
+                self._close (fd)
                 zombies.append(k)
-            elif (fd['wtime'] > fd['ftime']) and (now - fd['wtime'] > FLUSH_DELAY):
-                # note: think about small writes within flush period
-                fd['obj'].flush()
-                self.log.debug ('flushed %s', fd['path'])
-                fd['ftime'] = now
+            elif fd['wbuf'] and now - fd['ftime'] > self.flush_delay:
+                self._flush (fd)
         for k in zombies:
                 self.files.pop(k)
 
@@ -415,8 +543,4 @@ class TailWriter_Worker (threading.Thread):
         """ Close all open files """
         self.log.info ('%s stopping', self.name)
         for fd in self.files.itervalues():
-            if fd['buf']:
-                body = self._process_buffer(fd)
-                fd['obj'].write(body)
-            fd['obj'].close()
-            self.log.info ('closed %s', fd['path'])
+            self._close (fd)
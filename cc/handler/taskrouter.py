@@ -1,10 +1,9 @@
 
 import time
 
-from zmq.eventloop.ioloop import PeriodicCallback
-
 from cc.handler import CCHandler
 from cc.reqs import TaskReplyMessage, ErrorMessage
+from cc.timer import get_timer_wheel
 
 import skytools
 
@@ -57,10 +56,8 @@ class TaskRouter(CCHandler):
         # 1 hr? XXX
         self.route_lifetime = self.cf.getint ('route-lifetime', 1 * 60 * 60)
         self.reply_timeout = self.cf.getint ('reply-timeout', 5 * 60)
-        self.maint_period = self.cf.getint ('maint-period', 1 * 60)
 
-        self.timer = PeriodicCallback(self.do_maint, self.maint_period*1000, self.ioloop)
-        self.timer.start()
+        self.wheel = get_timer_wheel (self.ioloop)
 
 
     def handle_msg(self, cmsg):
@@ -83,27 +80,24 @@ class TaskRouter(CCHandler):
             self.log.warning('unknown msg: %s', req)
 
 
-    def do_maint(self):
-        """Drop old routes"""
-        self.log.debug('cleanup')
-        now = time.time()
-        zombies = []
-        for hr in self.route_map.itervalues():
-            if now - hr.create_time > self.route_lifetime:
-                zombies.append(hr)
-        for hr in zombies:
+    def expire_route(self, hr):
+        """Drop old route (unless replaced by newer registration)"""
+        if self.route_map.get(hr.host) is hr:
             self.log.info('deleting route for %s', hr.host)
             del self.route_map[hr.host]
             self.stat_inc('dropped_routes')
 
-        zombies = []
-        for rr in self.reply_map.itervalues():
-            if now - rr.atime > self.reply_timeout:
-                zombies.append(rr)
-        for rr in zombies:
-            self.log.info('deleting reply route for %s', rr.uid)
-            del self.reply_map[rr.uid]
-            self.stat_inc('dropped_tasks')
+    def expire_reply(self, rr):
+        """Drop reply route without recent feedback"""
+        if self.reply_map.get(rr.uid) is not rr:
+            return
+        idle = time.time() - rr.atime
+        if idle < self.reply_timeout:
+            self.wheel.call_later(self.reply_timeout - idle, self.expire_reply, rr)
+            return
+        self.log.info('deleting reply route for %s', rr.uid)
+        del self.reply_map[rr.uid]
+        self.stat_inc('dropped_tasks')
 
 
     def register_host (self, cmsg):
@@ -117,6 +111,7 @@ class TaskRouter(CCHandler):
         self.log.info('Got registration for %s', host)
         hr = HostRoute (host, route)
         self.route_map[hr.host] = hr
+        self.wheel.call_later (self.route_lifetime, self.expire_route, hr)
 
         self.stat_inc ('task.register')
 
@@ -149,6 +144,7 @@ class TaskRouter(CCHandler):
         uid = req.split('.')[2]
         rr = ReplyRoute (uid, inr)
         self.reply_map[uid] = rr
+        self.wheel.call_later (self.reply_timeout, self.expire_reply, rr)
 
         # send ack to client
         rep = TaskReplyMessage(
@@ -196,4 +192,3 @@ class TaskRouter(CCHandler):
     def stop (self):
         super(TaskRouter, self).stop()
         self.log.info ("stopping")
-        self.timer.stop()
@@ -0,0 +1,295 @@
+"""Columnar archive of log messages.
+
+Archive directory contains time-partitioned segment files
+(<YYYYMMDD-HHMMSS>.cla, start time in UTC), each with index file
+(<segment>.idx).  Segment is sequence of blocks, block stores rows
+column by column, each column compressed separately:
+
+  block header: magic, row count, column count
+  per column: compressed length, zlib (encoded column)
+
+Numeric columns are packed binary, string columns are JSON lists.
+
+Index has one JSON line per block with its offset and size, time range
+and distinct values of hostname, job_name and log_level.  Queries use
+index to skip blocks and decompress only columns they need.
+
+Index line is written after block data, so partially written block
+at end of segment is never seen by readers.
+"""
+
+import calendar
+import glob
+import optparse
+import os
+import os.path
+import re
+import struct
+import sys
+import time
+import zlib
+
+from cc.json import dumps, loads
+
+__all__ = ['COLUMNS', 'ArchiveWriter', 'query', 'main']
+
+COLUMNS = [
+    ('log_time', 'd'),
+    ('hostname', 's'),
+    ('job_name', 's'),
+    ('service_type', 's'),
+    ('log_level', 's'),
+    ('log_pid', 'q'),
+    ('log_line', 'q'),
+    ('log_function', 's'),
+    ('log_msg', 's'),
+]
+COLUMN_NAMES = [c for c, t in COLUMNS]
+
+# columns with distinct values kept in index
+INDEXED = ['hostname', 'job_name', 'log_level']
+
+BLOCK_MAGIC = 'CLA1'
+BLOCK_HDR = struct.Struct ('!4sII')
+COL_HDR = struct.Struct ('!I')
+
+_rc_segment = re.compile (r'^(\d{8}-\d{6})\.cla$')
+
+
+def encode_column (vals, typ):
+    if typ == 's':
+        return dumps (vals)
+    return struct.pack ('!%d%s' % (len(vals), typ), *vals)
+
+def decode_column (buf, typ, rows):
+    if typ == 's':
+        return loads (buf)
+    return list (struct.unpack ('!%d%s' % (rows, typ), buf))
+
+def _str (v):
+    if v is None:
+        return ''
+    return v
+
+
+class ArchiveWriter (object):
+    """ Appends blocks of log records to segment files. """
+
+    def __init__ (self, dstdir, period = 3600, complevel = 6):
+        self.dstdir = dstdir
+        self.period = period
+        self.complevel = complevel
+        if not os.path.isdir (dstdir):
+            os.makedirs (dstdir)
+
+    def segment_name (self, t):
+        start = int (t) - int (t) % self.period
+        return time.strftime ('%Y%m%d-%H%M%S', time.gmtime (start)) + '.cla'
+
+    def write (self, msgs):
+        """ Write list of log messages, partitioned into segments by log_time. """
+        parts = {}
+        for msg in msgs:
+            fn = self.segment_name (msg.get ('log_time') or 0)
+            parts.setdefault (fn, []).append (msg)
+        for fn, rows in sorted (parts.items()):
+            self.write_block (os.path.join (self.dstdir, fn), rows)
+
+    def write_block (self, fn, msgs):
+        cols = []
+        for name, typ in COLUMNS:
+            if typ == 's':
+                vals = [_str (m.get (name)) for m in msgs]
+            elif typ == 'd':
+                vals = [float (m.get (name) or 0) for m in msgs]
+            else:
+                vals = [int (m.get (name) or 0) for m in msgs]
+            cols.append (vals)
+
+        buf = [BLOCK_HDR.pack (BLOCK_MAGIC, len(msgs), len(COLUMNS))]
+        for (name, typ), vals in zip (COLUMNS, cols):
+            data = zlib.compress (encode_column (vals, typ), self.complevel)
+            buf.append (COL_HDR.pack (len(data)))
+            buf.append (data)
+        data = ''.join (buf)
+
+        times = cols[0]
+        entry = {'rows': len(msgs), 'tmin': min (times), 'tmax': max (times)}
+        for name in INDEXED:
+            entry[name] = sorted (set (cols[COLUMN_NAMES.index (name)]))
+
+        f = open (fn, 'ab')
+        try:
+            entry['offset'] = f.tell()
+            entry['size'] = len(data)
+            f.write (data)
+        finally:
+            f.close()
+        f = open (fn + '.idx', 'ab')
+        try:
+            f.write (dumps (entry) + '\n')
+        finally:
+            f.close()
+        return entry
+
+
+def read_index (fn):
+    """ Return list of block entries of segment. """
+    entries = []
+    try:
+        f = open (fn + '.idx', 'rb')
+    except IOError:
+        return entries
+    for ln in f:
+        if ln.endswith ('\n'):
+            entries.append (loads (ln))
+    f.close()
+    return entries
+
+def read_block (f, entry, columns):
+    """ Read and decode given columns of block. """
+    f.seek (entry['offset'])
+    data = f.read (entry['size'])
+    magic, rows, ncols = BLOCK_HDR.unpack_from (data, 0)
+    if magic != BLOCK_MAGIC:
+        raise ValueError ('bad block at %i' % entry['offset'])
+    res = {}
+    pos = BLOCK_HDR.size
+    for name, typ in COLUMNS[:ncols]:
+        clen, = COL_HDR.unpack_from (data, pos)
+        pos += COL_HDR.size
+        if name in columns:
+            res[name] = decode_column (zlib.decompress (data[pos : pos + clen]), typ, rows)
+        pos += clen
+    return rows, res
+
+def list_segments (dstdir, tmax = None):
+    """ Return segment files in time order, skipping ones starting after tmax. """
+    res = []
+    for fn in sorted (glob.glob (os.path.join (dstdir, '*.cla'))):
+        m = _rc_segment.match (os.path.basename (fn))
+        if not m:
+            continue
+        start = calendar.timegm (time.strptime (m.group(1), '%Y%m%d-%H%M%S'))
+        if tmax is not None and start > tmax:
+            continue
+        res.append (fn)
+    return res
+
+def _block_matches (entry, tmin, tmax, filters):
+    if tmin is not None and entry['tmax'] < tmin:
+        return False
+    if tmax is not None and entry['tmin'] > tmax:
+        return False
+    for name, vals in filters.items():
+        if not vals.intersection (entry[name]):
+            return False
+    return True
+
+def query (dstdir, tmin = None, tmax = None, hostname = None, job_name = None,
+           log_level = None, text = None):
+    """ Yield matching log records (dicts) from archive.
+
+    hostname, job_name and log_level are lists of accepted values,
+    text is substring to look for in log_msg.
+    """
+    filters = {}
+    for name, vals in (('hostname', hostname), ('job_name', job_name), ('log_level', log_level)):
+        if vals:
+            filters[name] = set (vals)
+    # columns needed for filtering, rest is decoded only for matching blocks
+    fcols = set (filters) | set (['log_time'])
+    if text:
+        fcols.add ('log_msg')
+    rest = [c for c in COLUMN_NAMES if c not in fcols]
+
+    for fn in list_segments (dstdir, tmax):
+        entries = [e for e in read_index (fn) if _block_matches (e, tmin, tmax, filters)]
+        if not entries:
+            continue
+        f = open (fn, 'rb')
+        try:
+            for e in entries:
+                rows, cols = read_block (f, e, fcols)
+                sel = []
+                for i in xrange (rows):
+                    t = cols['log_time'][i]
+                    if (tmin is not None and t < tmin) or (tmax is not None and t > tmax):
+                        continue
+                    for name, vals in filters.items():
+                        if cols[name][i] not in vals:
+                            break
+                    else:
+                        if text and text not in cols['log_msg'][i]:
+                            continue
+                        sel.append (i)
+                if not sel:
+                    continue
+                cols.update (read_block (f, e, rest)[1])
+                for i in sel:
+                    yield dict ((name, cols[name][i]) for name in COLUMN_NAMES)
+        finally:
+            f.close()
+
+
+_usage = """
+%prog [options] ARCHIVE_DIR
+
+Query columnar log archive written by cc.handler.logarchiver.
+Times are local, given as 'YYYY-MM-DD HH:MM[:SS]' or unix timestamp.
+"""
+
+def _parse_time (s):
+    """ Return unix time for string, None if not recognized. """
+    try:
+        return float (s)
+    except ValueError:
+        pass
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return time.mktime (time.strptime (s, fmt))
+        except ValueError:
+            pass
+    return None
+
+def _format_time (t):
+    # round once, so .9996 goes to next second, not to ",000" of this one
+    secs, ms = divmod (int (round (t * 1000)), 1000)
+    return time.strftime ("%Y-%m-%d %H:%M:%S", time.localtime (secs)) + ",%03d" % ms
+
+def main (args = None):
+    p = optparse.OptionParser (usage = _usage.strip())
+    p.add_option ('-f', '--from', dest = 'tmin', help = 'start time')
+    p.add_option ('-t', '--to', dest = 'tmax', help = 'end time')
+    p.add_option ('-H', '--host', action = 'append', help = 'hostname (may be repeated)')
+    p.add_option ('-j', '--job', action = 'append', help = 'job name (may be repeated)')
+    p.add_option ('-l', '--level', action = 'append', help = 'log level (may be repeated)')
+    p.add_option ('-g', '--grep', help = 'substring of log message')
+    p.add_option ('--json', action = 'store_true', help = 'output JSON lines')
+    opts, args = p.parse_args (args)
+    if len(args) != 1:
+        p.error ('need archive directory')
+
+    tmin = tmax = None
+    if opts.tmin is not None:
+        tmin = _parse_time (opts.tmin)
+        if tmin is None:
+            p.error ('invalid time: %s' % opts.tmin)
+    if opts.tmax is not None:
+        tmax = _parse_time (opts.tmax)
+        if tmax is None:
+            p.error ('invalid time: %s' % opts.tmax)
+    hosts = opts.host and [h.decode ('utf8') for h in opts.host]
+    jobs = opts.job and [j.decode ('utf8') for j in opts.job]
+    levels = opts.level and [l.upper() for l in opts.level]
+    text = opts.grep and opts.grep.decode ('utf8')
+    for rec in query (args[0], tmin, tmax, hosts, jobs, levels, text):
+        if opts.json:
+            ln = dumps (rec)
+        else:
+            ln = u'%s [%s@%s] %s %s' % (_format_time (rec['log_time']), rec['job_name'],
+                                        rec['hostname'], rec['log_level'], rec['log_msg'])
+        sys.stdout.write (ln.encode ('utf8') + '\n')
+
+if __name__ == '__main__':
+    main()
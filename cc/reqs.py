@@ -54,6 +54,15 @@ class InfofileMessage(BaseMessage):
     data = Field(str)                   # file contents (data fork)
     comp = Field(str)                   # compression method used
     mode = Field(str, 'b')              # file mode to use for fopen
+    xfer_id = Field(str, '')            # chunked transfer id
+    chunk = Field(int, 0)               # chunk sequence number (from 0)
+    chunks = Field(int, 0)              # number of chunks (0 if not chunked)
+    size = Field(int, 0)                # file size (chunked and delta only)
+    xfer_hash = Field(str, '')          # sha1 of all chunk blobs (last chunk only)
+    delta = Field(str, '')              # changed block numbers, comma-separated (delta only)
+    block_size = Field(int, 0)          # delta block size (0 if full content)
+    base_hash = Field(str, '')          # sha1 of contents the delta applies to
+    content_hash = Field(str, '')       # sha1 of contents after applying delta
 
 class LogtailMessage (BaseMessage):
     req = Field(str, "pub.logtail")
@@ -65,6 +74,52 @@ class LogtailMessage (BaseMessage):
     op_mode = Field(str)                # classic, rotated
     st_dev = Field(long)                # device number
     st_ino = Field(int)                 # inode number
+    want_ack = Field(int, 0)            # reply with LogtailAckMessage
+
+class LogtailAckMessage (ReplyMessage):
+    req = Field(str, "logtail.ack")
+    filename = Field(str)
+    fpos = Field(int)                   # position of acked fragment
+    st_dev = Field(long)
+    st_ino = Field(int)
+
+class TailSearchMessage (BaseMessage):
+    req = Field(str, "tail.search")
+    search_host = Field(str, '*')       # hostname pattern
+    search_file = Field(str, '*')       # filename pattern
+    tmin = Field(float, 0)              # message time range (0 - unlimited)
+    tmax = Field(float, 0)
+    text = Field(str, '')               # substring to look for
+    max_lines = Field(int, 0)           # 0 - server default
+
+class TailSearchReplyMessage (ReplyMessage):
+    req = Field(str, "tail.search.reply")
+    lines = Field(list, list)           # matching lines: {file, offset, line}
+    done = Field(int, 0)                # last reply to request
+    truncated = Field(int, 0)           # stopped at max_lines
+
+class TailSubscribeMessage (BaseMessage):
+    req = Field(str, "tail.subscribe")
+    sub_id = Field(str)                 # client-chosen subscription id
+    sub_host = Field(str, '*')          # hostname pattern
+    sub_file = Field(str, '*')          # filename pattern (pub.logtail)
+    sub_job = Field(str, '*')           # job name pattern (log.*)
+    sub_dest = Field(str, '*')          # message dest pattern
+    credit = Field(int, 0)              # more messages client is ready to receive
+    buffer = Field(int, 0)              # max buffered messages (0 - server default)
+    drop = Field(str, '')               # when buffer is full: oldest, newest, cancel
+    lifetime = Field(int, 0)            # seconds until expiry, renewed by re-subscribing
+
+class TailUnsubscribeMessage (BaseMessage):
+    req = Field(str, "tail.unsubscribe")
+    sub_id = Field(str)
+
+class TailSubscribeReplyMessage (ReplyMessage):
+    req = Field(str, "tail.subscribe.reply")
+    sub_id = Field(str)
+    status = Field(str)                 # ok, cancelled, expired, unsubscribed
+    buffered = Field(int, 0)            # messages waiting for credit
+    dropped = Field(int, 0)             # messages dropped so far
 
 class JobConfigRequestMessage(BaseMessage):
     req = Field(str, "job.config")
@@ -23,7 +23,7 @@ from cc import __version__
 from cc.crypto import CryptoContext
 from cc.handler import cc_handler_lookup
 from cc.message import CCMessage
-from cc.stream import CCStream
+from cc.stream import CCStream, lanes_from_config
 from cc.util import hsize_to_bytes, reset_stats, write_atomic
 
 
@@ -55,6 +55,11 @@ class CCServer(skytools.BaseScript):
         #zmq_tcp_keepalive_intvl = 15
         #zmq_tcp_keepalive_idle = 240
         #zmq_tcp_keepalive_cnt = 4
+
+        # priority lanes for replies (by msg dest prefix)
+        #lanes = ctl
+        #lane-ctl-prefix = echo, task.reply
+        #lane-ctl-weight = 10
     """
     extra_ini = """
     Extra segments::
@@ -165,7 +170,8 @@ class CCServer(skytools.BaseScript):
             else:
                 self.log.info("TCP_KEEPALIVE not available")
         s.bind(self.local_url)
-        self.local = CCStream(s, self.ioloop, qmaxsize = self.zmq_hwm)
+        self.local = CCStream(s, self.ioloop, qmaxsize = self.zmq_hwm,
+                              lanes = lanes_from_config (self.cf, self.zmq_hwm))
         self.local.on_recv(self.handle_cc_recv)
 
         self.handlers = {}
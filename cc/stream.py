@@ -3,6 +3,7 @@
 
 import sys
 import time
+from collections import deque
 
 import zmq
 from zmq.eventloop import IOLoop
@@ -13,7 +14,44 @@ import skytools
 from cc.message import CCMessage, zmsg_size
 from cc.util import stat_inc
 
-__all__ = ['CCStream', 'CCReqStream']
+__all__ = ['CCStream', 'CCReqStream', 'SendLane', 'lanes_from_config']
+
+#
+# priority lanes for send path
+#
+
+class SendLane (object):
+    """Bounded send queue for one class of messages."""
+
+    __slots__ = ('name', 'prefixes', 'weight', 'maxsize', 'drop_old', 'queue', 'current')
+
+    def __init__ (self, name, prefixes, weight = 1, maxsize = 1000, drop_old = False):
+        self.name = name
+        self.prefixes = prefixes    # list of dest prefixes ('task.reply', 'echo')
+        self.weight = weight
+        self.maxsize = maxsize
+        self.drop_old = drop_old    # drop oldest instead of new msg when full
+        self.queue = deque()
+        self.current = 0            # weighted round-robin state
+
+def lanes_from_config (cf, qmaxsize):
+    """Build lane list from handler config.
+
+    Config::
+        lanes = ctl, bulk
+        lane-ctl-prefix = echo, task.reply
+        lane-ctl-weight = 10
+        lane-ctl-size = 100
+        lane-ctl-drop = old
+    """
+    lanes = []
+    for name in cf.getlist ('lanes', []):
+        lanes.append (SendLane (name,
+                cf.getlist ('lane-%s-prefix' % name, []),
+                cf.getint ('lane-%s-weight' % name, 1),
+                cf.getint ('lane-%s-size' % name, qmaxsize),
+                cf.get ('lane-%s-drop' % name, 'new') == 'old'))
+    return lanes
 
 #
 # simple wrapper around ZMQStream
@@ -23,23 +61,127 @@ class CCStream (ZMQStream):
     """
     Adds CCMessage methods to ZMQStream as well as protection (on by default)
     against unlimited memory (send queue) growth.
+
+    If spill queue (DiskQueue) is given, messages over qmaxsize are
+    written to disk instead of dropped.  While spill is not empty, new
+    messages go behind it to keep order, send queue is refilled from
+    spill as it drains below replay_low.  Once spill is empty, messages
+    are sent directly again.
+
+    If lanes (list of SendLane) are given, messages are queued by dest
+    prefix into separate bounded lanes, which are drained into ZMQStream
+    send queue by weighted round-robin, lane_feed msgs at a time.
+    Unmatched messages go to implicit 'default' lane.  Lane limits and
+    drop policies replace qmaxsize, spill is not used with lanes.
     """
 
+    log = skytools.getLogger ('CCStream')
+
+    lane_feed = 2
+
     def __init__ (self, *args, **kwargs):
         self.qmaxsize = kwargs.pop ('qmaxsize', None)
         if self.qmaxsize is None:
             self.qmaxsize = 1000
         elif self.qmaxsize <= 0:
             self.qmaxsize = sys.maxsize
+        self.spill = kwargs.pop ('spill', None)
+        self.replay_low = max (1, self.qmaxsize // 2)
+        self.lanes = list (kwargs.pop ('lanes', None) or [])
+        if self.lanes and self.spill is not None:
+            self.log.warning ("both lanes and spill configured, spill is ignored")
+            self.spill = None
+        self.lane_map = {}
+        if self.lanes:
+            for lane in self.lanes:
+                for p in lane.prefixes:
+                    self.lane_map[tuple(p.split('.'))] = lane
+            self.lanes.append (SendLane ('default', [], 1, self.qmaxsize))
         super(CCStream, self).__init__(*args, **kwargs)
+        if self.spill is not None and len(self.spill):
+            self.replay()
 
     def send_multipart (self, msg, *args, **kwargs):
-        if self._send_queue.qsize() < self.qmaxsize:
+        if self.lanes:
+            self.send_lane (msg)
+        elif self.spill is not None and (len(self.spill) or self._send_queue.qsize() >= self.qmaxsize):
+            # keep order: while spill has backlog, new msgs go behind it
+            if self.spill.push (msg):
+                stat_inc ('count.spilled', 1)
+                stat_inc ('bytes.spilled', zmsg_size (msg))
+                self.replay()
+            else:
+                stat_inc ('count.dropped', 1)
+                stat_inc ('bytes.dropped', zmsg_size (msg))
+        elif self._send_queue.qsize() < self.qmaxsize:
             super(CCStream, self).send_multipart (msg, *args, **kwargs)
         else:
             stat_inc ('count.dropped', 1)
             stat_inc ('bytes.dropped', zmsg_size (msg))
 
+    def send_lane (self, msg):
+        """Queue message into its lane, apply lane's drop policy."""
+        lane = self.get_lane (msg)
+        if len(lane.queue) >= lane.maxsize:
+            if lane.drop_old:
+                old = lane.queue.popleft()
+            else:
+                old = msg
+            stat_inc ('count.dropped', 1)
+            stat_inc ('bytes.dropped', zmsg_size (old))
+            stat_inc ('lane.%s.count.dropped' % lane.name, 1)
+            stat_inc ('lane.%s.bytes.dropped' % lane.name, zmsg_size (old))
+            if old is msg:
+                return
+        lane.queue.append (msg)
+        stat_inc ('lane.%s.count' % lane.name, 1)
+        self.feed_lanes()
+
+    def get_lane (self, msg):
+        """Pick lane by longest matching dest prefix."""
+        try:
+            dst = msg[msg.index('') + 1].split('.')
+        except (ValueError, IndexError):
+            return self.lanes[-1]
+        for n in range (len(dst), 0, -1):
+            lane = self.lane_map.get (tuple (dst[:n]))
+            if lane:
+                return lane
+        return self.lanes[-1]
+
+    def feed_lanes (self):
+        """Move messages from lanes to send queue (smooth weighted round-robin)."""
+        while self._send_queue.qsize() < self.lane_feed:
+            best = None
+            total = 0
+            for lane in self.lanes:
+                if lane.queue:
+                    lane.current += lane.weight
+                    total += lane.weight
+                    if best is None or lane.current > best.current:
+                        best = lane
+            if best is None:
+                break
+            best.current -= total
+            super(CCStream, self).send_multipart (best.queue.popleft())
+
+    def _handle_send (self):
+        super(CCStream, self)._handle_send()
+        if self.lanes:
+            self.feed_lanes()
+        elif self.spill is not None and len(self.spill) and self._send_queue.qsize() < self.replay_low:
+            self.replay()
+
+    def replay (self):
+        """Move spilled messages back to send queue, as space permits."""
+        while len(self.spill) and self._send_queue.qsize() < self.qmaxsize:
+            msg = self.spill.pop()
+            if msg is None:
+                break
+            super(CCStream, self).send_multipart (msg)
+            stat_inc ('count.replayed', 1)
+            stat_inc ('bytes.replayed', zmsg_size (msg))
+
     def send_cmsg(self, cmsg):
         """Send CCMessage to socket"""
         self.send_multipart(cmsg.zmsg)
@@ -0,0 +1,229 @@
+"""Side index for files written by TailWriter.
+
+Index of <file> is kept in <file>.cidx, one JSON line per block of
+file data:
+
+  start, end - byte range of block in file
+  t0, t1 - range of message times (sender clock) of data in block
+  bits, bloom - Bloom filter of word tokens in block (base64)
+
+Blocks end at line boundaries (very long lines are cut between
+tokens), so tokens are never split between blocks.  Data not covered
+by index (written before indexing was enabled or not yet in complete
+block) is scanned without pruning.  Data is read in pieces of
+SCAN_BYTES, so search can give way to others between them.
+"""
+
+import os
+import os.path
+import re
+import string
+import struct
+from hashlib import md5
+
+from cc.json import dumps, loads
+
+__all__ = ['TailIndexWriter', 'read_index', 'search_file']
+
+BLOOM_HASHES = 4
+BITS_PER_TOKEN = 10
+MIN_TOKEN = 3
+MAX_PARTIAL = 64 * 1024     # index partial line anyway if longer
+SCAN_BYTES = 256 * 1024     # read size when searching
+
+_rc_token = re.compile (r'\w{%i,}' % MIN_TOKEN)
+_rc_word = re.compile (r'\w+')
+_word_chars = string.ascii_letters + string.digits + '_'
+
+
+def _bloom_positions (token, bits):
+    h = struct.unpack ('>4I', md5 (token).digest())
+    return [x % bits for x in h[:BLOOM_HASHES]]
+
+def bloom_make (tokens, maxbits):
+    """ Return (bits, filter bytes) for set of tokens. """
+    bits = min (maxbits, max (512, len(tokens) * BITS_PER_TOKEN))
+    bits = (bits + 7) & ~7
+    buf = bytearray (bits // 8)
+    for t in tokens:
+        for p in _bloom_positions (t, bits):
+            buf[p >> 3] |= 1 << (p & 7)
+    return bits, str (buf)
+
+def bloom_check (bloom, bits, tokens):
+    """ Return False if some token is surely missing. """
+    for t in tokens:
+        for p in _bloom_positions (t, bits):
+            if not ord (bloom[p >> 3]) & (1 << (p & 7)):
+                return False
+    return True
+
+def query_tokens (text):
+    """ Return tokens that must be present in data containing text.
+    Words touching ends of text may be parts of longer words, so skipped.
+    """
+    res = []
+    for m in _rc_word.finditer (text):
+        if m.start() > 0 and m.end() < len(text) and m.end() - m.start() >= MIN_TOKEN:
+            res.append (m.group())
+    return res
+
+
+class TailIndexWriter (object):
+    """ Builds index blocks for data appended to file. """
+
+    def __init__ (self, fn, pos, block_bytes, bloom_bits):
+        self.fn = fn
+        self.block_bytes = block_bytes
+        self.bloom_bits = bloom_bits
+        self.f = None
+        self.start = pos        # start of current block
+        self.pos = pos          # end of data seen
+        self.partial = ''       # incomplete last line
+        self.nbytes = 0         # complete lines in current block
+        self.tokens = set()
+        self.t0 = self.t1 = None
+
+    def add (self, pos, body, t):
+        """ Add data that goes to file at pos, received at time t. """
+        if pos != self.pos:
+            # not continuation of what we have seen, start over
+            self.end_block (True)
+            self.start = pos
+        self.pos = pos + len(body)
+        if self.t0 is None:
+            self.t0 = t
+        self.t1 = max (self.t1, t)
+
+        data = self.partial + body
+        nl = data.rfind ('\n')
+        if nl < 0 and len(data) < MAX_PARTIAL:
+            self.partial = data
+            return
+        if nl < 0:
+            # cut before last word, so it stays whole in next block
+            nl = len (data.rstrip (_word_chars)) - 1
+            if nl < 0 and len(data) < 4 * MAX_PARTIAL:
+                self.partial = data
+                return
+            if nl < 0:
+                nl = len(data) - 1
+        self.tokens.update (_rc_token.findall (data, 0, nl + 1))
+        self.nbytes += nl + 1
+        self.partial = data[nl + 1:]
+        if self.nbytes >= self.block_bytes:
+            self.end_block (False)
+            if self.partial:
+                self.t0 = self.t1 = t
+
+    def end_block (self, whole):
+        """ Write out index entry for current block.  If whole is set,
+        incomplete last line is included, otherwise left for next block.
+        """
+        if whole and self.partial:
+            self.tokens.update (_rc_token.findall (self.partial))
+            self.nbytes += len(self.partial)
+            self.partial = ''
+        if self.nbytes:
+            end = self.start + self.nbytes
+            bits, bloom = bloom_make (self.tokens, self.bloom_bits)
+            entry = {'start': self.start, 'end': end, 't0': self.t0, 't1': self.t1,
+                     'bits': bits, 'bloom': bloom.encode ('base64')}
+            if self.f is None:
+                self.f = open (self.fn, 'ab')
+            self.f.write (dumps (entry) + '\n')
+            self.f.flush()
+            self.start = end
+        self.nbytes = 0
+        self.tokens = set()
+        self.t0 = self.t1 = None
+
+    def close (self):
+        self.end_block (True)
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+
+def read_index (fn):
+    """ Return list of index entries for data file fn. """
+    entries = []
+    try:
+        f = open (fn + '.cidx', 'rb')
+    except IOError:
+        return entries
+    for ln in f:
+        if ln.endswith ('\n'):
+            e = loads (ln)
+            e['bloom'] = e['bloom'].decode ('base64')
+            entries.append (e)
+    f.close()
+    return entries
+
+def _scan_ranges (entries, size):
+    """ Index entries plus unindexed gaps (without time or bloom info). """
+    res = []
+    pos = 0
+    for e in sorted (entries, key = lambda e: e['start']):
+        if e['start'] > pos:
+            res.append ({'start': pos, 'end': e['start']})
+        if e['end'] > size:
+            e['end'] = size
+        if e['start'] < e['end']:
+            res.append (e)
+        pos = max (pos, e['end'])
+    if size > pos:
+        res.append ({'start': pos, 'end': size})
+    return res
+
+def _find_lines (data, pos, text):
+    """ Return (offset, line) for lines in data containing text. """
+    found = []
+    for ln in data.split ('\n'):
+        if ln and text in ln:
+            found.append ((pos, ln))
+        pos += len(ln) + 1
+    return found
+
+def search_file (fn, tmin = None, tmax = None, text = ''):
+    """ Generator of matching lines in file, yields list of
+    (offset, line) per piece of data read (possibly empty).
+
+    Time range is checked at block level only.
+    """
+    tokens = query_tokens (text)
+    size = os.path.getsize (fn)
+    f = open (fn, 'rb')
+    carry = ''      # incomplete last line read
+    cpos = 0        # its offset
+    try:
+        for e in _scan_ranges (read_index (fn), size):
+            if 'bloom' in e:
+                if tmin and e['t1'] < tmin:
+                    continue
+                if tmax and e['t0'] > tmax:
+                    continue
+                if tokens and not bloom_check (e['bloom'], e['bits'], tokens):
+                    continue
+            if carry and cpos + len(carry) != e['start']:
+                # rest of the line was skipped
+                yield _find_lines (carry, cpos, text)
+                carry = ''
+            if not carry:
+                cpos = e['start']
+            f.seek (e['start'])
+            left = e['end'] - e['start']
+            while left > 0:
+                data = f.read (min (SCAN_BYTES, left))
+                if not data:
+                    break
+                left -= len(data)
+                data = carry + data
+                nl = data.rfind ('\n') + 1
+                carry = data[nl:]
+                yield _find_lines (data[:nl], cpos, text)
+                cpos += nl
+        if carry:
+            yield _find_lines (carry, cpos, text)
+    finally:
+        f.close()
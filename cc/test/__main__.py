@@ -1,7 +1,7 @@
 """Hopefully this will work on installed CC too."""
 
-from cc.test import test_basic, test_infofile, test_task
-modlist = ['test_basic', 'test_infofile', 'test_task']
+from cc.test import test_basic, test_diskqueue, test_filter, test_infofile, test_logarchive, test_logtail, test_tailindex, test_task, test_timer, test_util
+modlist = ['test_basic', 'test_diskqueue', 'test_filter', 'test_infofile', 'test_logarchive', 'test_logtail', 'test_tailindex', 'test_task', 'test_timer', 'test_util']
 
 import unittest
 unittest.main(argv = ['cc.test', '-v'] + modlist)
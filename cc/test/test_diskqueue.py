@@ -0,0 +1,124 @@
+"""Tests for cc.diskqueue"""
+
+import glob
+import os
+import shutil
+import tempfile
+import unittest
+
+from cc.diskqueue import DiskQueue
+
+class TestDiskQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.qdir = tempfile.mkdtemp(prefix = 'ccdq-')
+
+    def tearDown(self):
+        shutil.rmtree(self.qdir)
+
+    def segfiles(self):
+        return glob.glob(os.path.join(self.qdir, '*.dat'))
+
+    def test_order(self):
+        q = DiskQueue(self.qdir, 'q')
+        for i in range(10):
+            self.assertTrue(q.push(['a%i' % i, '', 'msg%i' % i]))
+        self.assertEqual(len(q), 10)
+        for i in range(10):
+            self.assertEqual(q.pop(), ['a%i' % i, '', 'msg%i' % i])
+        self.assertEqual(len(q), 0)
+        self.assertEqual(q.pop(), None)
+        q.close()
+
+    def test_full(self):
+        q = DiskQueue(self.qdir, 'q', maxbytes = 100)
+        n = 0
+        while q.push(['x' * 20]):
+            n += 1
+        self.assertTrue(n > 0)
+        self.assertTrue(q.bytes <= 100)
+        q.pop()
+        self.assertTrue(q.push(['x' * 20]))
+        q.close()
+
+    def test_segments(self):
+        q = DiskQueue(self.qdir, 'q', segbytes = 100)
+        for i in range(20):
+            q.push(['%020i' % i])
+        self.assertTrue(len(self.segfiles()) > 1)
+        for i in range(20):
+            self.assertEqual(q.pop(), ['%020i' % i])
+        # only the segment being written is left
+        self.assertEqual(len(self.segfiles()), 1)
+        q.close()
+        self.assertEqual(self.segfiles(), [])
+
+    def test_interleaved(self):
+        # reader following writer does not create new segments
+        q = DiskQueue(self.qdir, 'q')
+        q.push(['first'])
+        for i in range(50):
+            q.push(['m%i' % i])
+            q.pop()
+            self.assertEqual(len(self.segfiles()), 1)
+        self.assertEqual(q.pop(), ['m49'])
+        self.assertEqual(q.pop(), None)
+        # segment being written is kept
+        self.assertEqual(len(self.segfiles()), 1)
+        q.push(['last'])
+        self.assertEqual(q.pop(), ['last'])
+        q.close()
+        self.assertEqual(self.segfiles(), [])
+
+    def test_interleaved_rotate(self):
+        # reader catching up with writer over segment rotations
+        q = DiskQueue(self.qdir, 'q', segbytes = 100)
+        n = 0
+        for i in range(30):
+            for j in range(i % 4):
+                q.push(['%020i' % n])
+                n += 1
+            for j in range(i % 3):
+                q.pop()
+            self.assertTrue(len(self.segfiles()) <= len(q) // 3 + 2)
+        q.close()
+        q = DiskQueue(self.qdir, 'q', segbytes = 100)
+        rest = []
+        while True:
+            m = q.pop()
+            if m is None:
+                break
+            rest.append(int(m[0]))
+        self.assertEqual(rest, range(n - len(rest), n))
+        self.assertEqual(len(q), 0)
+        q.close()
+        self.assertEqual(self.segfiles(), [])
+
+    def test_recover(self):
+        q = DiskQueue(self.qdir, 'q', segbytes = 100)
+        for i in range(20):
+            q.push(['%020i' % i, 'data'])
+        q.close()
+        q = DiskQueue(self.qdir, 'q', segbytes = 100)
+        self.assertEqual(len(q), 20)
+        self.assertEqual(q.pop(), ['%020i' % 0, 'data'])
+        q.close()
+
+    def test_recover_partial(self):
+        q = DiskQueue(self.qdir, 'q')
+        q.push(['one'])
+        q.push(['two'])
+        q.close()
+        fn = self.segfiles()[0]
+        f = open(fn, 'r+b')
+        f.truncate(os.path.getsize(fn) - 2)
+        f.close()
+        q = DiskQueue(self.qdir, 'q')
+        self.assertEqual(len(q), 1)
+        q.push(['three'])
+        self.assertEqual(q.pop(), ['one'])
+        self.assertEqual(q.pop(), ['three'])
+        q.close()
+
+if __name__ == '__main__':
+    unittest.main()
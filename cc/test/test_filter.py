@@ -0,0 +1,44 @@
+"""Tests for cc.handler.filter"""
+
+import fnmatch
+import unittest
+
+from cc.handler.filter import PatternSet
+
+class TestPatternSet(unittest.TestCase):
+
+    def test_exact(self):
+        ps = PatternSet(['log.info', 'echo'])
+        self.assertTrue(ps.match('echo'))
+        self.assertTrue(ps.match('log.info'))
+        self.assertFalse(ps.match('log.infox'))
+        self.assertFalse(ps.match('log'))
+        self.assertEqual(ps.rx, None)
+
+    def test_wildcard(self):
+        ps = PatternSet(['pub.*', 'task.?eply', 'log.[ew]*'])
+        self.assertTrue(ps.match('pub.infofile'))
+        self.assertTrue(ps.match('task.reply'))
+        self.assertTrue(ps.match('log.error'))
+        self.assertTrue(ps.match('log.warning'))
+        self.assertFalse(ps.match('log.info'))
+        self.assertFalse(ps.match('xpub.infofile'))
+        self.assertEqual(len(ps), 1)
+
+    def test_same_as_fnmatch(self):
+        pats = ['pub.*', 'log.*.db?', 'job.[a-c]*', 'echo', 'task.reply.*']
+        ps = PatternSet(pats)
+        dests = ['pub', 'pub.', 'pub.x', 'log.x.db1', 'log.x.db12', 'job.a',
+                 'job.d', 'echo', 'echo.x', 'task.reply', 'task.reply.q',
+                 'line\nbreak', 'pub.line\nbreak']
+        for d in dests:
+            expect = bool([p for p in pats if fnmatch.fnmatchcase(d, p)])
+            self.assertEqual(ps.match(d), expect, d)
+
+    def test_empty(self):
+        ps = PatternSet([])
+        self.assertEqual(len(ps), 0)
+        self.assertFalse(ps.match('echo'))
+
+if __name__ == '__main__':
+    unittest.main()
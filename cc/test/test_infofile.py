@@ -7,6 +7,30 @@ import unittest
 
 from cc.test import CCTestCase, VMAP, TMPDIR, waitfile
 
+def waitdata(fn, data, timeout = 10):
+    """Wait until file has given contents."""
+    end = time.time() + timeout
+    while time.time() < end:
+        if os.path.isfile(fn) and open(fn, 'rb').read() == data:
+            return True
+        time.sleep(0.2)
+    raise AssertionError('waitdata(%s): contents did not match' % fn)
+
+def waitlog(fn, text, timeout = 10):
+    """Wait until log file contains text."""
+    end = time.time() + timeout
+    while time.time() < end:
+        if os.path.isfile(fn) and open(fn).read().find(text) >= 0:
+            return True
+        time.sleep(0.2)
+    raise AssertionError('waitlog(%s): %r not found' % (fn, text))
+
+def writefile(fn, data, mtime):
+    f = open(fn, 'wb')
+    f.write(data)
+    f.close()
+    os.utime(fn, (mtime, mtime))
+
 class TestInfofile(CCTestCase):
     """Test infofile.
 
@@ -17,6 +41,7 @@ class TestInfofile(CCTestCase):
         pidfile = TMP/%(job_name)s.pid
         cc-role = remote
         cc-socket = PORT1
+        stats-period = 1
 
         [routes]
         pub.infofile = h:infowriter
@@ -54,6 +79,8 @@ class TestInfofile(CCTestCase):
         compression = gzip
         compression-level = 1
         use-blob = 1
+        chunk-bytes = 64 KB
+        delta-block-bytes = 1 KB
 
         [d:infoscript]
         module = cc.daemon.infoscript
@@ -88,5 +115,29 @@ class TestInfofile(CCTestCase):
         fn = os.path.join(TMPDIR, 'dst-infofile', 'me', 'info.1')
         waitfile(fn)
 
+        src = os.path.join(TMPDIR, 'src-infofile')
+        dst = os.path.join(TMPDIR, 'dst-infofile', hostname)
+        now = int(time.time())
+
+        # chunked transfer, over chunk-bytes
+        big = ''.join(['line %06i of big file\n' % i for i in range(10000)])
+        writefile(os.path.join(src, 'info.big'), big, now - 10)
+        waitdata(os.path.join(dst, 'info.big'), big)
+
+        # delta transfer, one block changed
+        data = ''.join(['line %06i of small file\n' % i for i in range(1000)])
+        writefile(os.path.join(src, 'info.delta'), data, now - 10)
+        waitdata(os.path.join(dst, 'info.delta'), data)
+        data = data[:5000] + 'CHANGED' + data[5007:]
+        writefile(os.path.join(src, 'info.delta'), data, now - 5)
+        waitdata(os.path.join(dst, 'info.delta'), data)
+        # patched on receiver, not resent in full
+        logfn = os.path.join(TMPDIR, 'info-recv.log')
+        waitlog(logfn, 'delta_files: 1')
+        self.assertEqual(open(logfn).read().find('delta base mismatch'), -1)
+
+        e = os.system('grep -q Except %s/*.log' % TMPDIR);
+        self.assertNotEqual(e, 0)
+
 if __name__ == '__main__':
     unittest.main()
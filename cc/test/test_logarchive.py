@@ -0,0 +1,87 @@
+"""Tests for cc.logarchive"""
+
+import os, os.path
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from StringIO import StringIO
+
+import cc.logarchive
+from cc.json import loads
+from cc.logarchive import ArchiveWriter, COLUMN_NAMES, query, read_index
+
+T0 = 1300000000.0
+
+def make_msg(i, t, **kw):
+    msg = {'log_time': t, 'hostname': u'db%i' % (i % 2), 'job_name': u'job%i' % (i % 3),
+           'service_type': u'svc', 'log_level': i % 5 and u'INFO' or u'ERROR',
+           'log_pid': 1000 + i, 'log_line': i, 'log_function': u'func',
+           'log_msg': u'message %i p\xe4ev' % i}
+    msg.update(kw)
+    return msg
+
+class TestLogArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix = 'cclarch-')
+        self.wr = ArchiveWriter(self.dir, period = 3600)
+        self.msgs = [make_msg(i, T0 + i * 60) for i in range(180)]
+        for i in range(0, len(self.msgs), 25):
+            self.wr.write(self.msgs[i : i + 25])
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_round_trip(self):
+        segs = sorted(os.listdir(self.dir))
+        self.assertEqual(len([fn for fn in segs if fn.endswith('.cla')]), 4)
+        res = list(query(self.dir))
+        self.assertEqual(res, self.msgs)
+        self.assertEqual(sorted(res[0].keys()), sorted(COLUMN_NAMES))
+
+    def test_time_range(self):
+        tmin, tmax = T0 + 50 * 60, T0 + 120 * 60
+        res = list(query(self.dir, tmin, tmax))
+        self.assertEqual(res, self.msgs[50:121])
+
+    def test_filters(self):
+        res = list(query(self.dir, hostname = [u'db1'], log_level = [u'ERROR']))
+        self.assertEqual(res, [m for m in self.msgs
+                               if m['hostname'] == u'db1' and m['log_level'] == u'ERROR'])
+        self.assertEqual(list(query(self.dir, job_name = [u'nojob'])), [])
+
+    def test_text(self):
+        res = list(query(self.dir, text = u'message 17 '))
+        self.assertEqual(res, [self.msgs[17]])
+        res = list(query(self.dir, text = u'p\xe4ev', tmax = T0 + 60))
+        self.assertEqual(res, self.msgs[:2])
+
+    def test_block_index(self):
+        fn = os.path.join(self.dir, self.wr.segment_name(T0))
+        entries = read_index(fn)
+        self.assertTrue(entries)
+        for e in entries:
+            self.assertTrue(e['tmin'] <= e['tmax'])
+            self.assertTrue(set(e['log_level']) <= set([u'INFO', u'ERROR']))
+
+    def test_format_time(self):
+        t = time.mktime((2011, 3, 13, 10, 20, 30, 0, 0, -1))
+        self.assertEqual(cc.logarchive._format_time(t + 0.25), '2011-03-13 10:20:30,250')
+        self.assertEqual(cc.logarchive._format_time(t + 0.9996), '2011-03-13 10:20:31,000')
+
+    def test_main(self):
+        out = StringIO()
+        orig = sys.stdout
+        sys.stdout = out
+        try:
+            cc.logarchive.main(['--json', '-g', 'message 5 ', '-f', str(T0), self.dir])
+        finally:
+            sys.stdout = orig
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(loads(lines[0])['log_line'], 5)
+
+if __name__ == '__main__':
+    unittest.main()
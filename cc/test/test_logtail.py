@@ -0,0 +1,94 @@
+"""Logtail tests"""
+
+import os, os.path
+import socket
+import time
+import unittest
+
+from cc.test import CCTestCase, TMPDIR, waitfile
+
+class TestLogtail(CCTestCase):
+    """Test acked logtail -> tailwriter.
+
+    tail-recv.ini::
+
+        [ccserver]
+        logfile = TMP/%(job_name)s.log
+        pidfile = TMP/%(job_name)s.pid
+        cc-role = remote
+        cc-socket = PORT1
+
+        [routes]
+        pub.logtail = h:tailwriter
+
+        [h:tailwriter]
+        handler = cc.handler.tailwriter
+        dstdir = TMP/dst-logtail
+        host-subdirs = yes
+
+    tail-send.ini::
+
+        [ccserver]
+        logfile = TMP/%(job_name)s.log
+        pidfile = TMP/%(job_name)s.pid
+        cc-role = local
+        cc-socket = PORT2
+
+        [routes]
+        pub = h:proxy
+        job = h:jobmgr
+
+        [h:proxy]
+        handler = cc.handler.proxy
+        remote-cc = PORT1
+
+        [h:jobmgr]
+        handler = cc.handler.jobmgr
+        daemons = d:logtail
+
+        [d:logtail]
+        module = cc.daemon.logtail
+        logdir = TMP/src-logtail
+        logmask = app-*.log
+        use-blob = 1
+        flow-window = 4
+        ack-timeout = 2
+    """
+
+    def setUp(self):
+        dir1 = os.path.join(TMPDIR, 'src-logtail')
+        dir2 = os.path.join(TMPDIR, 'dst-logtail')
+        os.system('rm -rf ' + dir1)
+        os.system('rm -rf ' + dir2)
+        os.system('mkdir -p %s %s' % (dir1, dir2))
+        # tailer starts at end of first file, so create it empty
+        open(os.path.join(dir1, 'app-1.log'), 'w').close()
+
+        CCTestCase.setUp(self)
+
+    def runTest(self):
+        hostname = socket.gethostname()
+
+        lines = ['line %i\n' % i for i in range(100)]
+        f = open(os.path.join(TMPDIR, 'src-logtail', 'app-1.log'), 'a')
+        for ln in lines:
+            f.write(ln)
+            f.flush()
+        f.close()
+
+        fn = os.path.join(TMPDIR, 'dst-logtail', hostname, 'app-1.log')
+        waitfile(fn)
+
+        # acked data is written out without flush-delay
+        end = time.time() + 5
+        while time.time() < end:
+            if open(fn).read() == ''.join(lines):
+                break
+            time.sleep(0.2)
+        self.assertEqual(open(fn).read(), ''.join(lines))
+
+        e = os.system('grep -q Except %s/*.log' % TMPDIR);
+        self.assertNotEqual(e, 0)
+
+if __name__ == '__main__':
+    unittest.main()
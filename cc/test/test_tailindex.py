@@ -0,0 +1,134 @@
+"""Tests for cc.tailindex"""
+
+import os, os.path
+import shutil
+import tempfile
+import unittest
+
+import cc.tailindex
+from cc.tailindex import (TailIndexWriter, bloom_make, bloom_check,
+                          query_tokens, read_index, search_file)
+
+class TestBloom(unittest.TestCase):
+
+    def test_present(self):
+        tokens = set(['word%i' % i for i in range(500)])
+        bits, bloom = bloom_make(tokens, 1 << 20)
+        for t in tokens:
+            self.assertTrue(bloom_check(bloom, bits, [t]))
+
+    def test_false_positives(self):
+        tokens = set(['word%i' % i for i in range(500)])
+        bits, bloom = bloom_make(tokens, 1 << 20)
+        fp = 0
+        for i in range(10000):
+            if bloom_check(bloom, bits, ['other%i' % i]):
+                fp += 1
+        # ~1% expected with 10 bits per token
+        self.assertTrue(fp < 300, 'false positives: %i' % fp)
+
+    def test_query_tokens(self):
+        self.assertEqual(query_tokens('ERROR: connection reset by peer'),
+                         ['connection', 'reset'])
+        self.assertEqual(query_tokens('abc'), [])
+
+class TestTailIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix = 'cctidx-')
+        self.fn = os.path.join(self.dir, 'app.log')
+        self.f = open(self.fn, 'wb')
+        self.idx = TailIndexWriter(self.fn + '.cidx', 0, 100, 4096)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, body, t):
+        self.idx.add(self.f.tell(), body, t)
+        self.f.write(body)
+        self.f.flush()
+
+    def close(self):
+        self.idx.close()
+        self.f.close()
+
+    def test_split_fragments(self):
+        # lines split between fragments and over block size
+        lines = ['line %03i some filler text here\n' % i for i in range(40)]
+        lines[25] = 'line 025 unique needle found here\n'
+        data = ''.join(lines)
+        for i in range(0, len(data), 7):
+            self.write(data[i : i + 7], 1000 + i)
+        self.close()
+
+        entries = read_index(self.fn)
+        self.assertTrue(len(entries) > 1)
+        pos = 0
+        for e in entries:
+            self.assertEqual(e['start'], pos)
+            self.assertEqual(data[e['end'] - 1], '\n')
+            pos = e['end']
+        self.assertEqual(pos, len(data))
+
+        found = []
+        for res in search_file(self.fn, text = ' needle found '):
+            found.extend(res)
+        self.assertEqual(found, [(data.index(lines[25]), lines[25][:-1])])
+
+    def test_unindexed_tail(self):
+        self.write('first line with needle inside\n', 1000)
+        self.idx.end_block(True)
+        self.write('second line with needle inside\n', 1001)
+        # last block not written to index yet
+        found = []
+        for res in search_file(self.fn, text = ' needle '):
+            found.extend(res)
+        self.assertEqual([ln for ofs, ln in found],
+                         ['first line with needle inside', 'second line with needle inside'])
+        self.close()
+
+    def test_time_range(self):
+        self.write('old line with needle\n' * 10, 1000)
+        self.idx.end_block(True)
+        self.write('new line with needle\n' * 10, 2000)
+        self.close()
+        found = []
+        for res in search_file(self.fn, tmin = 1500, text = ' needle'):
+            found.extend(res)
+        self.assertEqual(len(found), 10)
+        self.assertEqual(found[0][1], 'new line with needle')
+
+    def test_long_line_cut(self):
+        # line over MAX_PARTIAL is cut between tokens
+        line = ' '.join(['word%05i' % i for i in range(20000)]) + '\n'
+        for i in range(0, len(line), 997):
+            self.write(line[i : i + 997], 1000)
+        self.close()
+        entries = read_index(self.fn)
+        self.assertTrue(len(entries) > 1)
+        for e in entries[:-1]:
+            self.assertEqual(line[e['end'] - 1], ' ')
+        for e in entries:
+            tok = line[e['start'] : e['start'] + 9]
+            self.assertTrue(bloom_check(e['bloom'], e['bits'], [tok]), tok)
+
+    def test_chunked_scan(self):
+        # unindexed data is read in pieces, lines over piece ends are whole
+        orig = cc.tailindex.SCAN_BYTES
+        cc.tailindex.SCAN_BYTES = 50
+        try:
+            lines = ['line %03i with needle\n' % i for i in range(30)]
+            data = ''.join(lines)
+            self.f.write(data)
+            self.f.close()
+            res = list(search_file(self.fn, text = ' needle'))
+        finally:
+            cc.tailindex.SCAN_BYTES = orig
+        self.assertTrue(len(res) > 10)
+        found = []
+        for r in res:
+            found.extend(r)
+        self.assertEqual(found, [(data.index(ln), ln[:-1]) for ln in lines])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,160 @@
+"""Tests for cc.timer"""
+
+import errno
+import unittest
+
+import skytools
+from zmq.eventloop.ioloop import IOLoop
+
+import cc.timer
+from cc.timer import TimerWheel, get_timer_wheel
+from cc.daemon.taskrunner import TaskState
+from cc.handler.jobmgr import JobState
+
+class FakeTime(object):
+    def __init__(self, now):
+        self.now = now
+    def time(self):
+        return self.now
+
+class TestTimerWheel(unittest.TestCase):
+
+    def setUp(self):
+        self.start = 1300000000.0
+        self.clock = FakeTime(self.start)
+        self.orig_time = cc.timer.time
+        cc.timer.time = self.clock
+        self.wheel = TimerWheel(IOLoop())
+        self.fired = []
+
+    def tearDown(self):
+        cc.timer.time = self.orig_time
+
+    def run_at(self, secs):
+        self.clock.now = self.start + secs
+        self.wheel.run_timers()
+
+    def fire(self, *args):
+        self.fired.append(args)
+
+    def test_deadline(self):
+        self.wheel.call_later(0.5, self.fire, 'a')
+        self.run_at(0.4)
+        self.assertEqual(self.fired, [])
+        self.run_at(0.6)
+        self.assertEqual(self.fired, [('a',)])
+        self.assertFalse(self.wheel.running)
+
+    def test_order(self):
+        self.wheel.call_later(3, self.fire, 3)
+        self.wheel.call_later(1, self.fire, 1)
+        self.wheel.call_later(2, self.fire, 2)
+        self.run_at(5)
+        self.assertEqual(self.fired, [(1,), (2,), (3,)])
+
+    def test_cancel(self):
+        t = self.wheel.call_later(1, self.fire, 'x')
+        self.wheel.call_later(2, self.fire, 'y')
+        t.cancel()
+        self.run_at(3)
+        self.assertEqual(self.fired, [('y',)])
+        self.assertEqual(self.wheel.count, 0)
+
+    def test_levels(self):
+        # deadlines on higher levels cascade down in time
+        for secs in (7, 100, 3600, 86400):
+            self.wheel.call_at(self.start + secs, self.fire, secs)
+        n = 0
+        for secs in (7, 100, 3600, 86400):
+            self.run_at(secs - 0.2)
+            self.assertEqual(len(self.fired), n)
+            self.run_at(secs + 0.2)
+            n += 1
+            self.assertEqual(self.fired[-1], (secs,))
+            self.assertEqual(len(self.fired), n)
+
+    def test_crash(self):
+        def crash():
+            raise ValueError('boom')
+        self.wheel.call_later(1, crash)
+        self.wheel.call_later(1, self.fire, 'ok')
+        self.run_at(2)
+        self.assertEqual(self.fired, [('ok',)])
+
+    def test_shared(self):
+        ioloop = IOLoop()
+        self.assertTrue(get_timer_wheel(ioloop) is get_timer_wheel(ioloop))
+
+class FakeConfig(object):
+    def getfile(self, key):
+        return '/nonexistent/job.pid'
+
+class FailingStdout(object):
+    def __init__(self):
+        self.reads = 0
+    def read(self):
+        self.reads += 1
+        raise IOError(errno.EIO, 'read failed')
+
+class FailingTx(object):
+    def __init__(self):
+        self.sends = 0
+    def create_cmsg(self, msg):
+        self.sends += 1
+        raise IOError(errno.EPIPE, 'send failed')
+
+class FakeProc(object):
+    pid = 1
+    def __init__(self):
+        self.stdout = FailingStdout()
+
+class TestWatchdogTick(unittest.TestCase):
+    """Watchdogs must keep ticking when check crashes."""
+
+    def setUp(self):
+        self.start = 1300000000.0
+        self.clock = FakeTime(self.start)
+        self.orig_time = cc.timer.time
+        cc.timer.time = self.clock
+        self.ioloop = IOLoop()
+        self.wheel = get_timer_wheel(self.ioloop)
+        self.orig_signal = getattr(skytools, 'signal_pidfile', None)
+        self.live = True
+        skytools.signal_pidfile = lambda fn, sig: self.live
+
+    def tearDown(self):
+        skytools.signal_pidfile = self.orig_signal
+        cc.timer.time = self.orig_time
+
+    def run_at(self, secs):
+        self.clock.now = self.start + secs
+        self.wheel.run_timers()
+
+    def test_jobmgr(self):
+        job = JobState('d:test', FakeConfig(), None, self.ioloop, None)
+        job.proc = FakeProc()
+        job.timer = self.wheel.call_later(1, job.on_timer)
+        for secs in range(1, 12):
+            self.run_at(secs)
+        self.assertTrue(job.proc.stdout.reads >= 4, job.proc.stdout.reads)
+        self.assertTrue(job.timer is not None)
+
+    def test_taskrunner(self):
+        info = {'config': {'pidfile': '/nonexistent/task.pid'},
+                'task': {'task_handler': 'h', 'task_id': 1}}
+        tx = FailingTx()
+        task = TaskState('uid', 'task', info, self.ioloop, None, tx)
+        task.heartbeat = True
+        task.start()
+        for secs in range(1, 6):
+            self.run_at(secs)
+        self.assertTrue(tx.sends >= 4, tx.sends)
+
+        # finished task is not watched any more
+        self.live = False
+        self.run_at(7)
+        self.assertTrue(task.timer is None)
+        self.assertEqual(self.wheel.count, 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+"""Tests for cc.util"""
+
+import os, os.path
+import shutil
+import tempfile
+import unittest
+
+from cc.util import HashRing, PathCache
+
+class TestHashRing(unittest.TestCase):
+
+    def test_stable(self):
+        r1 = HashRing(['w0', 'w1', 'w2'])
+        r2 = HashRing(['w0', 'w1', 'w2'])
+        for i in range(100):
+            k = 'host%i/file.log' % i
+            self.assertEqual(r1.lookup(k), r2.lookup(k))
+
+    def test_spread(self):
+        r = HashRing(['w0', 'w1', 'w2', 'w3'])
+        nodes = set([r.lookup('key%i' % i) for i in range(200)])
+        self.assertEqual(nodes, set([0, 1, 2, 3]))
+
+    def test_accept(self):
+        r = HashRing(['w0', 'w1', 'w2'])
+        for i in range(50):
+            n = r.lookup('key%i' % i, lambda n: n != 1)
+            self.assertNotEqual(n, 1)
+
+    def test_unicode(self):
+        r = HashRing(['w0', 'w1', 'w2'])
+        k = u'db1//var/log/p\xe4ev.log'
+        self.assertEqual(r.lookup(k), r.lookup(k.encode('utf8')))
+        self.assertEqual(r.lookup(u'ascii'), r.lookup('ascii'))
+
+    def test_unicode_file_key(self):
+        # TailWriter key: hostname, st_dev, st_ino, filename
+        r = HashRing(['w0', 'w1', 'w2'])
+        fi = (u'h\xe4st', 2049, 131074, u'/var/log/p\xe4ev.log')
+        self.assertTrue(r.lookup("%s:%s:%s:%s" % fi) in (0, 1, 2))
+
+class TestPathCache(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix = 'ccpc-')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_resolve(self):
+        pc = PathCache(self.dir, '%(hostname)s/%(filename)s')
+        fn = pc.resolve('db1', '/var/log/app.log')
+        self.assertEqual(fn, os.path.join(self.dir, 'db1', 'app.log'))
+        self.assertTrue(os.path.isdir(os.path.dirname(fn)))
+        self.assertTrue(pc.resolve('db1', '/var/log/app.log') is fn)
+
+    def test_filepath(self):
+        pc = PathCache(self.dir, '%(hostname)s/%(filepath)s')
+        fn = pc.resolve('db1', 'sub/dir/app.log')
+        self.assertEqual(fn, os.path.join(self.dir, 'db1', 'sub', 'dir', 'app.log'))
+        self.assertTrue(os.path.isdir(os.path.dirname(fn)))
+
+    def test_outside(self):
+        pc = PathCache(self.dir, '%(hostname)s/%(filepath)s')
+        self.assertEqual(pc.resolve('db1', '../../etc/passwd'), None)
+
+    def test_bounded(self):
+        pc = PathCache(self.dir, '%(hostname)s--%(filename)s', 10)
+        for i in range(50):
+            pc.resolve('db%i' % i, 'app.log')
+        self.assertEqual(len(pc.paths), 10)
+        self.assertTrue(len(pc.dirs) <= 10)
+
+    def test_invalidate(self):
+        pc = PathCache(self.dir, '%(hostname)s/%(filename)s')
+        fn = pc.resolve('db1', 'app.log')
+        shutil.rmtree(os.path.dirname(fn))
+        pc.invalidate(fn)
+        self.assertTrue(os.path.isdir(os.path.dirname(fn)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+"""Timer service for per-object deadlines.
+
+Hierarchical timing wheel driven by single PeriodicCallback on IOLoop,
+so cost of a tick depends on number of expiring timers, not on number
+of registered ones.  Level 0 has one slot per tick, each next level
+covers whole previous level per slot.  Timers are moved to lower
+levels as their time approaches.  Cancelled timers are dropped lazily.
+"""
+
+import math
+import time
+
+import skytools
+from zmq.eventloop.ioloop import PeriodicCallback
+
+__all__ = ['Timer', 'TimerWheel', 'get_timer_wheel']
+
+SLOT_BITS = 6
+SLOTS = 1 << SLOT_BITS
+SLOT_MASK = SLOTS - 1
+LEVELS = 4
+
+
+class Timer (object):
+    """ Scheduled callback, returned by TimerWheel.call_at() """
+    __slots__ = ('tick', 'callback', 'args')
+
+    def __init__ (self, tick, callback, args):
+        self.tick = tick
+        self.callback = callback
+        self.args = args
+
+    def cancel (self):
+        self.callback = None
+        self.args = None
+
+
+class TimerWheel (object):
+    """ Timing wheel on IOLoop """
+
+    log = skytools.getLogger ('TimerWheel')
+
+    def __init__ (self, ioloop, tick = 100):
+        self.ioloop = ioloop
+        self.tick = tick # ms
+        self.wheels = [[[] for i in range (SLOTS)] for l in range (LEVELS)]
+        self.count = 0
+        self.cur = self._ticks (time.time())
+        self.running = False
+        self.timer = PeriodicCallback (self.run_timers, self.tick, self.ioloop)
+
+    def _ticks (self, t):
+        return int (t * 1000.0 / self.tick)
+
+    def call_later (self, delay, callback, *args):
+        """ Run callback after delay seconds. """
+        return self.call_at (time.time() + delay, callback, *args)
+
+    def call_at (self, when, callback, *args):
+        """ Run callback at given time, returns Timer (for cancelling). """
+        if not self.running:
+            self.cur = self._ticks (time.time())
+            self.timer.start()
+            self.running = True
+        t = Timer (int (math.ceil (when * 1000.0 / self.tick)), callback, args)
+        self._insert (t)
+        self.count += 1
+        return t
+
+    def _insert (self, t):
+        delta = max (t.tick - self.cur, 1)
+        tick = self.cur + delta
+        for level in range (LEVELS):
+            if delta < SLOTS << (SLOT_BITS * level) or level == LEVELS - 1:
+                slot = (tick >> (SLOT_BITS * level)) & SLOT_MASK
+                self.wheels[level][slot].append (t)
+                return
+
+    def _cascade (self, level):
+        """ Move timers of current slot at level to lower levels. """
+        slot = (self.cur >> (SLOT_BITS * level)) & SLOT_MASK
+        timers = self.wheels[level][slot]
+        self.wheels[level][slot] = []
+        for t in timers:
+            if t.callback is None:
+                self.count -= 1
+            else:
+                self._insert (t)
+
+    def run_timers (self):
+        """ Advance wheel to current time, run expired timers. """
+        now = self._ticks (time.time())
+        while self.cur < now and self.count > 0:
+            self.cur += 1
+            for level in range (1, LEVELS):
+                if (self.cur >> (SLOT_BITS * (level - 1))) & SLOT_MASK:
+                    break
+                self._cascade (level)
+            slot = self.cur & SLOT_MASK
+            timers = self.wheels[0][slot]
+            self.wheels[0][slot] = []
+            for t in timers:
+                if t.callback is None:
+                    self.count -= 1
+                elif t.tick > self.cur:
+                    # beyond top level range, went round
+                    self._insert (t)
+                else:
+                    self.count -= 1
+                    cb, args = t.callback, t.args
+                    t.cancel()
+                    try:
+                        cb (*args)
+                    except Exception:
+                        self.log.exception ('timer callback crashed: %r', cb)
+        if self.count == 0:
+            self.timer.stop()
+            self.running = False
+
+
+def get_timer_wheel (ioloop):
+    """ Return timer wheel shared by everything on ioloop. """
+    wheel = getattr (ioloop, '_cc_timer_wheel', None)
+    if wheel is None:
+        wheel = TimerWheel (ioloop)
+        ioloop._cc_timer_wheel = wheel
+    return wheel
@@ -1,21 +1,32 @@
 """Low-level utilities"""
 
+import bisect
 import bz2
 import errno
 import gzip
 import os
 import re
+import struct
+import sys
+import threading
+from collections import OrderedDict
+from hashlib import md5
 
 try:
     from cStringIO import StringIO
 except ImportError:
     from StringIO import StringIO
 
-__all__ = ['write_atomic', 'compress', 'decompress', 'hsize_to_bytes']
+__all__ = ['write_atomic', 'replace_atomic', 'sync_file', 'fsync_dir', 'compress', 'decompress', 'hsize_to_bytes', 'HashRing', 'PathCache']
 
 
-def write_atomic (fn, data, bakext = None, mode = 'b'):
-    """Write [text] file with rename."""
+def write_atomic (fn, data, bakext = None, mode = 'b', fsync = False):
+    """Write [text] file with rename.
+
+    If fsync is set, data is flushed to disk before rename
+    and the directory entry after it.  With fsync = 'fdatasync'
+    only file data is flushed.
+    """
 
     if mode not in ['', 'b', 't']:
         raise ValueError ("unsupported fopen mode")
@@ -24,8 +35,16 @@ def write_atomic (fn, data, bakext = None, mode = 'b'):
     fn2 = fn + '.new'
     f = open(fn2, 'w' + mode)
     f.write(data)
+    if fsync:
+        sync_file (f, fsync)
     f.close()
 
+    replace_atomic (fn2, fn, bakext, fsync and fsync != 'fdatasync')
+
+
+def replace_atomic (fn2, fn, bakext = None, fsync = False):
+    """Replace file fn with fn2 by rename, keep old one as fn + bakext."""
+
     # link old data to bak file
     if bakext:
         if bakext.find('/') >= 0:
@@ -44,6 +63,30 @@ def write_atomic (fn, data, bakext = None, mode = 'b'):
 
     # atomically replace file
     os.rename(fn2, fn)
+    if fsync:
+        fsync_dir (os.path.dirname(fn))
+
+
+def sync_file (f, how = 'fsync'):
+    """Flush file object to disk, using fdatasync if asked and available."""
+
+    f.flush()
+    if how == 'fdatasync' and hasattr(os, 'fdatasync'):
+        os.fdatasync(f.fileno())
+    else:
+        os.fsync(f.fileno())
+
+
+def fsync_dir (dn):
+    """Flush directory entries to disk (no-op on win32)."""
+
+    if sys.platform == 'win32':
+        return
+    fd = os.open(dn or '.', os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
 
 
 def compress (buffer, method, options = {}):
@@ -96,6 +139,104 @@ def hsize_to_bytes (input):
     return bytes
 
 
+class HashRing (object):
+    """ Consistent hashing of string keys to nodes (0 .. len(names)-1) """
+
+    def __init__ (self, names, replicas = 64):
+        ring = []
+        for i, name in enumerate (names):
+            for r in range (replicas):
+                ring.append ((_hash32 ("%s-%i" % (name, r)), i))
+        ring.sort()
+        self.hashes = [h for h, i in ring]
+        self.nodes = [i for h, i in ring]
+
+    def lookup (self, key, accept = None):
+        """ Return node for key; skip nodes not accepted by accept(node). """
+        n = len(self.nodes)
+        pos = bisect.bisect (self.hashes, _hash32 (key))
+        if accept is not None:
+            for k in range (n):
+                node = self.nodes[(pos + k) % n]
+                if accept (node):
+                    return node
+        return self.nodes[pos % n]
+
+def _hash32 (s):
+    if isinstance (s, unicode):
+        s = s.encode ('utf8')
+    return struct.unpack ('>I', md5(s).digest()[:4])[0]
+
+
+class PathCache (object):
+    """ Bounded cache of destination paths and known directories,
+    shared by writer threads.
+    """
+
+    def __init__ (self, dstdir, dstmask, maxsize = 10000):
+        self.dstdir = dstdir
+        self.dstmask = dstmask
+        self.maxsize = maxsize
+        self.paths = OrderedDict()  # (hostname, filename, mask) -> path
+        self.dirs = OrderedDict()   # dirs known to exist
+        self.lock = threading.Lock()
+
+    def resolve (self, hostname, filename):
+        """ Return destination path for file, with its directory created.
+        Returns None for paths outside dstdir.
+        """
+        key = (hostname, filename, self.dstmask)
+        self.lock.acquire()
+        try:
+            path = self.paths.pop (key, None)
+            if path is not None:
+                self.paths[key] = path
+                return path
+        finally:
+            self.lock.release()
+
+        path = os.path.normpath (os.path.join (self.dstdir, self.dstmask % {
+                'hostname': hostname,
+                'filepath': filename,
+                'filename': os.path.basename(filename)}))
+        if self.dstdir != os.path.commonprefix ([self.dstdir, path]):
+            return None
+        self.make_dir (os.path.dirname (path))
+        self._add (self.paths, key, path)
+        return path
+
+    def make_dir (self, subdir):
+        """ Create directory unless known to exist. """
+        if subdir in self.dirs:
+            return
+        if not os.path.isdir (subdir):
+            try:
+                os.makedirs (subdir)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        self._add (self.dirs, subdir, True)
+
+    def invalidate (self, path):
+        """ Forget directory of path (got ENOENT), create it again. """
+        subdir = os.path.dirname (path)
+        self.lock.acquire()
+        try:
+            self.dirs.pop (subdir, None)
+        finally:
+            self.lock.release()
+        self.make_dir (subdir)
+
+    def _add (self, od, key, value):
+        self.lock.acquire()
+        try:
+            od[key] = value
+            while len(od) > self.maxsize:
+                od.popitem (last = False)
+        finally:
+            self.lock.release()
+
+
 stat_dict = {}
 
 def stat_put (key, value):
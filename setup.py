@@ -21,6 +21,7 @@ setup(
     ],
     scripts = [
         'bin/ccserver.py',
+        'bin/cclogquery.py',
     ],
     data_files = [
         ('share/doc/cc', [